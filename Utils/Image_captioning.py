@@ -1,8 +1,118 @@
-# Load model directly
-from transformers import AutoProcessor, AutoModelForImageTextToText
+from Utils.model_registry import registry
+from Utils.inference_backend import backend_for, load_image_to_text_model
+from Utils.batching import get_batcher
+from Utils import tracing
+from collections import OrderedDict
+import hashlib
+import threading
 
-processor = AutoProcessor.from_pretrained("Salesforce/blip-image-captioning-large")
-model = AutoModelForImageTextToText.from_pretrained("Salesforce/blip-image-captioning-large")
+import numpy as np
+from PIL import Image
+
+CAPTIONING_MODEL_NAME = "Salesforce/blip-image-captioning-large"
+CAPTION_CACHE_SIZE = 1024
+
+_caption_cache: OrderedDict[str, str] = OrderedDict()  # Image hash -> caption, least recently used first
+_caption_cache_lock = threading.Lock()
+
+def load_captioner(backend: str | None = None):
+    """Loads the image captioning processor and model with a backend, by default the one selected for "captioner"."""
+    from transformers import AutoProcessor
+    processor = AutoProcessor.from_pretrained(CAPTIONING_MODEL_NAME)
+    model = load_image_to_text_model(CAPTIONING_MODEL_NAME, backend or backend_for("captioner"))
+    return processor, model
+
+registry.register("captioner", load_captioner)
+
+def image_hash(image) -> str:
+    """
+    Computes the SHA-256 content hash of an image.
+
+    PIL images are hashed by their decoded RGB pixels and size, so the same picture
+    re-uploaded, or saved losslessly in another format, maps to the same key while
+    any two different pictures never share a caption. Tensors and arrays are hashed
+    by their shape and raw content.
+
+    Args:
+        image (PIL.Image or torch.Tensor): The image to be hashed.
+
+    Returns:
+        str: The hash of the image.
+    """
+    if isinstance(image, Image.Image):
+        pixels = np.asarray(image.convert("RGB"))
+    else:
+        pixels = np.ascontiguousarray(image)
+    digest = hashlib.sha256(str(pixels.shape).encode("ascii"))
+    digest.update(pixels.tobytes())
+    return digest.hexdigest()
+
+def generate_captions(images: list, captioner: tuple | None = None) -> list[str]:
+    """
+    Captions a batch of images with a single generate call.
+
+    Args:
+        images (list): The images to be captioned, already converted to RGB.
+        captioner (tuple, optional): A (processor, model) pair to use instead of the registered one.
+
+    Returns:
+        list[str]: One caption per image.
+    """
+    import torch
+
+    processor, model = captioner or registry.get("captioner")
+    with tracing.span("caption_generate", images=len(images)):
+        inputs = processor(images=images, return_tensors="pt")
+        with torch.inference_mode():
+            caption_ids = model.generate(**inputs)
+    return [caption.strip() for caption in processor.batch_decode(caption_ids, skip_special_tokens=True)]
+
+def caption_images(images: list, batch_size: int = 8) -> list[str]:
+    """
+    Generates captions for many images, running the model only on images it has not captioned before.
+
+    Uncached images are captioned in batches of up to batch_size, shared with
+    concurrent requests. Captions are kept in a bounded LRU cache keyed by image_hash.
+
+    Args:
+        images (list): The images to be captioned (PIL.Image or torch.Tensor).
+        batch_size (int): Largest number of images passed to a single generate call.
+
+    Returns:
+        list[str]: One caption per image, in the same order.
+    """
+    with tracing.span("caption", images=len(images)) as caption_span:
+        with tracing.span("image_hash", images=len(images)):
+            keys = [image_hash(image) for image in images]
+        captions = {}
+        with _caption_cache_lock:
+            for key in keys:
+                if key in _caption_cache:
+                    _caption_cache.move_to_end(key)
+                    captions[key] = _caption_cache[key]
+
+        pending = {}
+        for key, image in zip(keys, images):
+            if key not in captions and key not in pending:
+                pending[key] = image.convert("RGB") if isinstance(image, Image.Image) else image
+        caption_span.set(cache_hits=len(images) - len(pending), generated=len(pending))
+        tracing.increment("cache_hits", len(images) - len(pending), cache="caption")
+        tracing.increment("cache_misses", len(pending), cache="caption")
+
+        if pending:
+            # Images of concurrent requests share generate calls through the "captioner" micro-batcher
+            batcher = get_batcher("captioner", generate_captions, max_batch_size=batch_size)
+            pending_keys = list(pending)
+            for key, caption in zip(pending_keys, batcher.map([pending[key] for key in pending_keys])):
+                captions[key] = caption
+
+            with _caption_cache_lock:
+                for key in pending_keys:
+                    _caption_cache[key] = captions[key]
+                while len(_caption_cache) > CAPTION_CACHE_SIZE:
+                    _caption_cache.popitem(last=False)
+
+        return [captions[key] for key in keys]
 
 # Define the image captioning function
 def query(image):
@@ -15,6 +125,4 @@ def query(image):
     Returns:
         str: The generated caption for the image.
     """
-    inputs = processor(image, return_tensors="pt", padding="max_length", max_length=128, truncation=True)
-    caption = model.generate(**inputs)
-    return processor.decode(caption[0], skip_special_tokens=True)
+    return caption_images([image])[0]
@@ -1,28 +1,171 @@
+import json
+import os
+from collections import deque
+from typing import Callable
+
+import numpy as np
 import speech_recognition as sr
-import tempfile
 
-def listen():
+from Utils import tracing
+from Utils.model_registry import registry
+
+VOSK_MODEL_PATH = os.environ.get("NISMOGEN_VOSK_MODEL")  # Directory of an unpacked Vosk model, e.g. vosk-model-small-en-us-0.15
+SAMPLE_RATE = 16000
+FRAME_MS = 30  # Audio is read and classified as speech or silence in frames of this length
+PRE_ROLL_MS = 300  # Audio kept from before speech was detected, so the first syllable is not cut off
+END_SILENCE_MS = 500  # Silence that ends an utterance
+NO_SPEECH_TIMEOUT_S = 8.0
+MAX_UTTERANCE_S = 30.0
+
+
+def load_vosk_model():
+    """Loads the offline Vosk speech recognition model from NISMOGEN_VOSK_MODEL."""
+    import vosk
+    if not VOSK_MODEL_PATH:
+        raise RuntimeError("Set NISMOGEN_VOSK_MODEL to the directory of a Vosk model to recognize speech offline")
+    vosk.SetLogLevel(-1)
+    return vosk.Model(VOSK_MODEL_PATH)
+
+registry.register("asr", load_vosk_model)
+
+
+def asr_engine() -> str:
+    """
+    Returns the speech recognition engine: "vosk" (offline, streaming) or "google".
+
+    Set with NISMOGEN_ASR_ENGINE; defaults to "vosk" when a Vosk model is configured.
+    """
+    return os.environ.get("NISMOGEN_ASR_ENGINE") or ("vosk" if VOSK_MODEL_PATH else "google")
+
+
+class VoiceActivitySegmenter:
+    """
+    Finds where an utterance starts and ends from the energy of short audio frames.
+
+    The noise floor is tracked while nobody speaks; a frame is voiced when its RMS
+    is well above it. Speech starts after start_ms of voiced frames and the
+    utterance ends after end_silence_ms of unvoiced frames.
+    """
+
+    def __init__(
+        self,
+        sample_rate: int,
+        start_ms: int = 90,
+        end_silence_ms: int = END_SILENCE_MS,
+        threshold_ratio: float = 3.0,
+        min_energy: float = 300.0,
+    ):
+        self.frame_ms = FRAME_MS
+        self.start_frames = max(start_ms // FRAME_MS, 1)
+        self.end_frames = max(end_silence_ms // FRAME_MS, 1)
+        self.threshold_ratio = threshold_ratio
+        self.min_energy = min_energy
+        self.noise_floor = min_energy / threshold_ratio
+        self.state = "waiting"  # "waiting" for speech, in "speech", or at the "end" of the utterance
+        self._run = 0  # Consecutive frames that argue for the next state
+
+    def feed(self, frame: bytes) -> str:
+        """Classifies one 16-bit mono frame and returns the new state."""
+        samples = np.frombuffer(frame, dtype=np.int16).astype(np.float32)
+        energy = float(np.sqrt(np.mean(samples ** 2))) if samples.size else 0.0
+        voiced = energy > max(self.min_energy, self.threshold_ratio * self.noise_floor)
+
+        if self.state == "waiting":
+            if voiced:
+                self._run += 1
+                if self._run >= self.start_frames:
+                    self.state, self._run = "speech", 0
+            else:
+                self._run = 0
+                self.noise_floor = 0.95 * self.noise_floor + 0.05 * energy
+        elif self.state == "speech":
+            self._run = 0 if voiced else self._run + 1
+            if self._run >= self.end_frames:
+                self.state = "end"
+        return self.state
+
+
+def _vosk_text(result: str, key: str = "text") -> str:
+    return json.loads(result).get(key, "")
+
+
+def listen(on_partial: Callable[[str], None] | None = None, engine: str | None = None) -> tuple[str, bytes | None]:
     """
-    Listens to audio input from the microphone and attempts to recognize the speech using Google's speech recognition API.
+    Records one utterance from the microphone and recognizes it.
+
+    Audio is read in short frames and segmented by voice activity, so recording
+    stops as soon as the user stops talking. With the offline "vosk" engine the
+    audio is recognized while it is being recorded: partial transcripts are passed
+    to on_partial, and the final transcript is ready when the utterance ends. The
+    recording is kept in memory; nothing is written to disk.
+
+    Args:
+        on_partial (Callable[[str], None], optional): Called with the transcript so far while the user speaks.
+        engine (str, optional): "vosk" or "google"; defaults to asr_engine().
 
     Returns:
         str: The recognized text from the audio input, or an error message if the recognition fails.
-        str: The path to the temporary audio file.
+        bytes: The recorded utterance as a WAV file, or None if nothing was recognized.
     """
-    recognizer = sr.Recognizer()
-    with sr.Microphone() as source:  # Use the default microphone as the audio source
-        print("Listening...")
-        audio = recognizer.listen(source)  # Listen for speech
-        try:
-            recognized_text = recognizer.recognize_google(audio)  # Recognize the speech using Google's speech recognition API
-            print(recognized_text)  # Print the recognized text
+    engine = engine or asr_engine()
+    with tracing.span("asr", engine=engine) as asr_span:
+        with sr.Microphone(sample_rate=SAMPLE_RATE) as source:  # Use the default microphone as the audio source
+            print("Listening...")
+            sample_rate, sample_width = source.SAMPLE_RATE, source.SAMPLE_WIDTH
+            frame_size = sample_rate * FRAME_MS // 1000
+            segmenter = VoiceActivitySegmenter(sample_rate)
+            recognizer = None
+            if engine == "vosk":
+                import vosk
+                recognizer = vosk.KaldiRecognizer(registry.get("asr"), sample_rate)
 
-            # Save the audio to a temporary file
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as temp_audio_file:
-                temp_audio_file.write(audio.get_wav_data())
-                temp_audio_path = temp_audio_file.name
+            pre_roll = deque(maxlen=max(PRE_ROLL_MS // FRAME_MS, 1))
+            utterance = bytearray()
+            final_texts, partial = [], ""
+            frames_read = 0
+            with tracing.span("asr_capture") as capture_span:
+                while segmenter.state != "end":
+                    frame = source.stream.read(frame_size)
+                    if not frame:  # The audio source ran out
+                        break
+                    frames_read += 1
+                    if frames_read * FRAME_MS > (NO_SPEECH_TIMEOUT_S + MAX_UTTERANCE_S) * 1000:
+                        break
+                    if segmenter.feed(frame) == "waiting":
+                        pre_roll.append(frame)
+                        if frames_read * FRAME_MS > NO_SPEECH_TIMEOUT_S * 1000:
+                            break
+                        continue
 
-            return recognized_text, temp_audio_path
+                    audio = b"".join(pre_roll) + frame
+                    pre_roll.clear()
+                    utterance += audio
+                    if recognizer is not None:
+                        if recognizer.AcceptWaveform(audio):
+                            final_texts.append(_vosk_text(recognizer.Result()))
+                        elif on_partial and (text := _vosk_text(recognizer.PartialResult(), "partial")) != partial:
+                            partial = text
+                            on_partial(" ".join(final_texts + [partial]).strip())
+                capture_span.set(speech_ms=len(utterance) * 1000 // (sample_rate * sample_width))
+
+        if not utterance:
+            error_message = "Sorry, I could not understand the audio."
+            print(error_message)
+            return error_message, None
+
+        audio_data = sr.AudioData(bytes(utterance), sample_rate, sample_width)
+        try:
+            with tracing.span("asr_recognize", engine=engine):
+                if recognizer is not None:
+                    final_texts.append(_vosk_text(recognizer.FinalResult()))
+                    recognized_text = " ".join(text for text in final_texts if text)
+                    if not recognized_text:
+                        raise sr.UnknownValueError()
+                else:
+                    recognized_text = sr.Recognizer().recognize_google(audio_data)  # One round trip, after the utterance
+            print(recognized_text)  # Print the recognized text
+            asr_span.set(chars=len(recognized_text))
+            return recognized_text, audio_data.get_wav_data()
         except sr.UnknownValueError:  # Handle the exception of unintelligible speech
             error_message = "Sorry, I could not understand the audio."
             print(error_message)
@@ -30,4 +173,4 @@ def listen():
         except sr.RequestError:  # Handle the exception of request error
             error_message = "Request failed, please try again."
             print(error_message)
-            return error_message, None
\ No newline at end of file
+            return error_message, None
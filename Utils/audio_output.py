@@ -1,12 +1,272 @@
-import pyttsx3
+import hashlib
+import io
+import itertools
+import os
+import queue
+import re
+import struct
+import tempfile
+import threading
+import wave
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Callable, Iterator
 
-def speak(text):
+import numpy as np
+
+from Utils import tracing
+
+TTS_CACHE_BYTES = int(os.environ.get("NISMOGEN_TTS_CACHE_BYTES", 64 * 2**20))
+TTS_MAX_PREFETCH = int(os.environ.get("NISMOGEN_TTS_MAX_PREFETCH", 32))  # Sentences waiting to be prefetched
+MAX_SENTENCE_CHARS = 300  # Longer sentences are split at commas or spaces
+
+PLAY, PREFETCH = 0, 1  # Render priorities; lower is rendered first
+
+
+def split_sentences(text: str, max_chars: int = MAX_SENTENCE_CHARS) -> list[str]:
+    """
+    Splits text into sentences that can be rendered one at a time.
+
+    Rendering sentence by sentence gets the first audio ready quickly, and each
+    sentence is cached on its own, so answers sharing sentences share clips too.
+    """
+    sentences = []
+    for sentence in re.split(r"(?<=[.!?;:])\s+|\n+", text):
+        sentence = sentence.strip()
+        while len(sentence) > max_chars:
+            cut = max(sentence.rfind(", ", 0, max_chars), sentence.rfind(" ", 0, max_chars))
+            cut = cut if cut > 0 else max_chars
+            sentences.append(sentence[:cut].strip())
+            sentence = sentence[cut:].lstrip(", ")
+        if sentence:
+            sentences.append(sentence)
+    return sentences
+
+
+def join_wav(clips: list[bytes]) -> bytes:
+    """Concatenates WAV clips rendered by the same engine into one WAV."""
+    if len(clips) == 1:
+        return clips[0]
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as output:
+        for i, clip in enumerate(clips):
+            with wave.open(io.BytesIO(clip), "rb") as part:
+                if i == 0:
+                    output.setparams(part.getparams())
+                output.writeframes(part.readframes(part.getnframes()))
+    return buffer.getvalue()
+
+
+def _extended_float(data: bytes) -> float:
+    """Decodes the 80-bit IEEE extended float AIFF uses for the sample rate."""
+    exponent = int.from_bytes(data[:2], "big")
+    mantissa = int.from_bytes(data[2:10], "big")
+    sign = -1 if exponent & 0x8000 else 1
+    return sign * mantissa * 2.0 ** ((exponent & 0x7FFF) - 16383 - 63)
+
+
+def aiff_to_wav(data: bytes) -> bytes:
+    """
+    Converts uncompressed AIFF or AIFF-C audio to WAV.
+
+    pyttsx3 on macOS writes AIFF whatever the file name, while the clips are
+    joined with the wave module and played as audio/wav.
+    """
+    if data[:4] != b"FORM" or data[8:12] not in (b"AIFF", b"AIFC"):
+        raise ValueError("Not an AIFF file")
+    chunks, position = {}, 12
+    while position + 8 <= len(data):
+        chunk_id, size = data[position:position + 4], int.from_bytes(data[position + 4:position + 8], "big")
+        chunks[chunk_id] = data[position + 8:position + 8 + size]
+        position += 8 + size + size % 2  # Chunks are padded to an even length
+
+    channels, frames, sample_bits = struct.unpack(">hLh", chunks[b"COMM"][:8])
+    sample_rate = _extended_float(chunks[b"COMM"][8:18])
+    compression = chunks[b"COMM"][18:22] if data[8:12] == b"AIFC" else b"NONE"
+    if compression not in (b"NONE", b"sowt"):
+        raise ValueError(f"Unsupported AIFF-C compression {compression!r}")
+    width = (sample_bits + 7) // 8
+    offset = int.from_bytes(chunks[b"SSND"][:4], "big")
+    samples = np.frombuffer(chunks[b"SSND"][8 + offset:8 + offset + frames * channels * width], dtype=np.uint8)
+    if width == 1:
+        samples = samples + np.uint8(128)  # WAV stores 8-bit samples unsigned
+    elif compression == b"NONE":
+        samples = samples.reshape(-1, width)[:, ::-1]  # Big-endian to little-endian
+
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as output:
+        output.setnchannels(channels)
+        output.setsampwidth(width)
+        output.setframerate(round(sample_rate))
+        output.writeframes(samples.tobytes())
+    return buffer.getvalue()
+
+
+def _create_engine() -> Any:
+    import pyttsx3
+    return pyttsx3.init()
+
+
+class TTSService:
     """
-    Convert the given text to speech and play it.
+    Renders speech to WAV bytes on a background thread that keeps one warm engine.
+
+    pyttsx3 engines are not thread-safe and slow to create, so a single worker owns
+    the engine and renders clips one after another. Clips are cached by a hash of
+    their text in an LRU bounded by cache_bytes, and requests for a clip that is
+    already being rendered wait for that render instead of starting another.
+    Clips someone is waiting to play are rendered before prefetched ones, and at
+    most max_prefetch prefetched sentences wait at a time; the rest are dropped.
+    """
+
+    def __init__(
+        self,
+        engine_factory: Callable[[], Any] = _create_engine,
+        cache_bytes: int = TTS_CACHE_BYTES,
+        max_prefetch: int = TTS_MAX_PREFETCH,
+    ):
+        self.engine_factory = engine_factory
+        self.cache_bytes = cache_bytes
+        self.max_prefetch = max_prefetch
+        self.cache: OrderedDict[str, bytes] = OrderedDict()
+        self.cached_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._pending: dict[str, Future] = {}
+        self._prefetching: set[str] = set()  # Keys queued by prefetch() and not started yet
+        self._queue: queue.PriorityQueue = queue.PriorityQueue()
+        self._order = itertools.count()  # Keeps clips of the same priority in arrival order
+        self._worker: threading.Thread | None = None
+        self._lock = threading.Lock()
+
+    def render(self, sentence: str, priority: int = PLAY) -> Future | None:
+        """
+        Returns a future for the WAV bytes of one sentence, rendering it unless cached or in progress.
+
+        A PLAY render of a sentence still waiting as a prefetch moves it to the front.
+        A PREFETCH render is dropped, returning None, when the prefetch limit is reached.
+        """
+        key = hashlib.sha1(sentence.encode("utf-8")).hexdigest()
+        with self._lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                tracing.increment("cache_hits", cache="tts")
+                future = Future()
+                future.set_result(self.cache[key])
+                return future
+            if key in self._pending:
+                future = self._pending[key]
+                if priority == PLAY and key in self._prefetching:
+                    self._prefetching.discard(key)  # The queued prefetch is skipped once this one renders
+                    self._queue.put((PLAY, next(self._order), key, sentence, future))
+                return future
+            if priority == PREFETCH:
+                if len(self._prefetching) >= self.max_prefetch:
+                    tracing.increment("tts_prefetch_dropped")
+                    return None
+                self._prefetching.add(key)
+            self.misses += 1
+            tracing.increment("cache_misses", cache="tts")
+            future = self._pending[key] = Future()
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="tts-worker", daemon=True)
+                self._worker.start()
+            self._queue.put((priority, next(self._order), key, sentence, future))
+        return future
+
+    def prefetch(self, text: str) -> None:
+        """Starts rendering text in the background so that a later speak() is served from the cache."""
+        for sentence in split_sentences(text):
+            self.render(sentence, PREFETCH)
+
+    def stream(self, text: str) -> Iterator[bytes]:
+        """Yields the WAV clip of each sentence in order, as soon as it is ready."""
+        futures = [self.render(sentence) for sentence in split_sentences(text)]
+        for future in futures:
+            yield future.result()
+
+    def synthesize(self, text: str) -> bytes:
+        """Returns the whole text as a single WAV."""
+        with tracing.span("tts", chars=len(text)) as tts_span:
+            clips = list(self.stream(text))
+            tts_span.set(sentences=len(clips))
+            return join_wav(clips) if clips else b""
+
+    def _store(self, key: str, clip: bytes) -> None:
+        with self._lock:
+            self._pending.pop(key, None)
+            if len(clip) > self.cache_bytes:
+                return
+            self.cache[key] = clip
+            self.cached_bytes += len(clip)
+            while self.cached_bytes > self.cache_bytes:
+                _, evicted = self.cache.popitem(last=False)
+                self.cached_bytes -= len(evicted)
+
+    def _render_clip(self, engine: Any, sentence: str) -> bytes:
+        # pyttsx3 can only write to a file; the file lives only as long as this render
+        handle, path = tempfile.mkstemp(suffix=".wav")
+        os.close(handle)
+        try:
+            engine.save_to_file(sentence, path)
+            engine.runAndWait()
+            with open(path, "rb") as f:
+                clip = f.read()
+        finally:
+            os.remove(path)
+        return aiff_to_wav(clip) if clip[:4] == b"FORM" else clip
+
+    def _run(self) -> None:
+        engine = None
+        while True:
+            _, _, key, sentence, future = self._queue.get()
+            with self._lock:
+                self._prefetching.discard(key)
+            if future.done():  # A prefetch that was moved to the front and already rendered
+                continue
+            try:
+                if engine is None:
+                    engine = self.engine_factory()
+                with tracing.span("tts_render", chars=len(sentence)):
+                    clip = self._render_clip(engine, sentence)
+            except Exception as e:
+                with self._lock:
+                    self._pending.pop(key, None)
+                future.set_exception(e)
+                continue
+            self._store(key, clip)
+            future.set_result(clip)
+
+    def stats(self) -> dict:
+        """Returns cache hits, misses, entries and bytes, and the number of clips waiting to be rendered."""
+        with self._lock:
+            return {
+                "hits": self.hits, "misses": self.misses, "entries": len(self.cache),
+                "bytes": self.cached_bytes, "queued": self._queue.qsize(),
+            }
+
+
+tts_service = TTSService()
+
+
+def _tts_metrics():
+    stats = tts_service.stats()
+    yield "tts_cache_bytes", {}, stats["bytes"]
+    yield "tts_queue_depth", {}, stats["queued"]
+
+
+tracing.register_collector(_tts_metrics)
+
+
+def speak(text: str) -> bytes:
+    """
+    Convert the given text to speech.
 
     Args:
         text (str): The text to be converted to speech.
+
+    Returns:
+        bytes: The speech as a WAV file, to be played by the client, e.g. with st.audio.
     """
-    engine = pyttsx3.init() # Initialize the Pyttsx3 engine
-    engine.say(text)    # Convert the text to speech
-    engine.runAndWait() # Play the speech
\ No newline at end of file
+    return tts_service.synthesize(text)
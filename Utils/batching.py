@@ -0,0 +1,189 @@
+import os
+import queue
+import threading
+import time
+import weakref
+from collections import Counter
+from concurrent.futures import Future
+from typing import Any, Callable
+
+from langchain_core.embeddings import Embeddings
+
+from Utils import tracing
+
+
+DEFAULT_MAX_BATCH_SIZE = int(os.environ.get("NISMOGEN_BATCH_MAX_SIZE", 8))
+DEFAULT_MAX_WAIT_MS = float(os.environ.get("NISMOGEN_BATCH_MAX_WAIT_MS", 10))
+
+
+class MicroBatcher:
+    """
+    Collects requests from many threads into batches for a single model call.
+
+    A worker thread takes the first waiting request, keeps collecting until the
+    batch is full or max_wait_ms has passed since that request arrived, runs
+    process_batch once on the whole batch and hands each caller its own result.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        process_batch: Callable[[list], list],
+        max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+        max_wait_ms: float = DEFAULT_MAX_WAIT_MS,
+    ):
+        self.name = name
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.batch_sizes = Counter()  # Batch size -> number of batches run with that size
+        self.max_queue_depth = 0
+        self._queue: queue.Queue = queue.Queue()
+        self._worker: threading.Thread | None = None
+        self._lock = threading.Lock()
+
+    def submit(self, item: Any) -> Future:
+        """Queues one request and returns a future for its result."""
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name=f"batcher-{self.name}", daemon=True)
+                self._worker.start()
+        future: Future = Future()
+        self._queue.put((item, future))
+        self.max_queue_depth = max(self.max_queue_depth, self._queue.qsize())
+        return future
+
+    def map(self, items: list) -> list:
+        """Queues several requests and waits for all of their results, in order."""
+        futures = [self.submit(item) for item in items]
+        return [future.result() for future in futures]
+
+    def _collect(self) -> list[tuple[Any, Future]]:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait_ms / 1000
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        try:
+            while True:
+                self._run_batch(self._collect())
+        finally:
+            with self._lock:  # The next submit starts a new worker for whatever is still queued
+                self._worker = None
+
+    def _run_batch(self, batch: list[tuple[Any, Future]]) -> None:
+        items = [item for item, _ in batch]
+        try:
+            with tracing.span(f"{self.name}_batch", items=len(items)):
+                results = list(self.process_batch(items))
+            if len(results) != len(items):
+                raise RuntimeError(f"{self.name} batch returned {len(results)} results for {len(items)} items")
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+            self.batch_sizes[len(batch)] += 1
+            labels = {"batcher": self.name, "max_batch_size": self.max_batch_size}
+            tracing.increment("batcher_batches", **labels)
+            tracing.increment("batcher_items", len(batch), **labels)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            # Reached on anything else that escapes, e.g. SystemExit; no caller is left waiting forever
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(RuntimeError(f"The {self.name} batcher stopped before running this batch"))
+
+    def stats(self) -> dict:
+        """Returns the current queue depth, the deepest queue seen and the batch size distribution."""
+        batches = sum(self.batch_sizes.values())
+        items = sum(size * count for size, count in self.batch_sizes.items())
+        return {
+            "queue_depth": self._queue.qsize(),
+            "max_queue_depth": self.max_queue_depth,
+            "batches": batches,
+            "items": items,
+            "mean_batch_size": items / batches if batches else 0.0,
+            "batch_sizes": dict(self.batch_sizes),
+        }
+
+
+batchers: dict[tuple[str, int, float], MicroBatcher] = {}  # (name, max_batch_size, max_wait_ms) -> batcher
+_batchers_lock = threading.Lock()
+
+
+def get_batcher(
+    name: str,
+    process_batch: Callable[[list], list],
+    max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+    max_wait_ms: float = DEFAULT_MAX_WAIT_MS,
+) -> MicroBatcher:
+    """
+    Returns the process-wide batcher with the given name and settings, creating it on first use.
+
+    Callers asking for the same name with different settings get separate batchers.
+    max_batch_size and max_wait_ms can be overridden per model with environment
+    variables such as NISMOGEN_SUMMARIZER_BATCH_MAX_SIZE and NISMOGEN_SUMMARIZER_BATCH_MAX_WAIT_MS.
+    """
+    prefix = f"NISMOGEN_{name.upper()}_BATCH"
+    max_batch_size = int(os.environ.get(f"{prefix}_MAX_SIZE", max_batch_size))
+    max_wait_ms = float(os.environ.get(f"{prefix}_MAX_WAIT_MS", max_wait_ms))
+    key = (name, max_batch_size, max_wait_ms)
+    with _batchers_lock:
+        if key in batchers:
+            batchers[key].process_batch = process_batch  # The model may have been reloaded since
+        else:
+            batchers[key] = MicroBatcher(name, process_batch, max_batch_size, max_wait_ms)
+        return batchers[key]
+
+
+def stats() -> dict[str, dict]:
+    """Returns the metrics of every batcher, keyed by name and maximum batch size, e.g. "captioner/8"."""
+    with _batchers_lock:
+        return {
+            f"{name}/{max_batch_size}": batcher.stats()
+            for (name, max_batch_size, _), batcher in batchers.items()
+        }
+
+
+def _batcher_metrics():
+    with _batchers_lock:
+        current = list(batchers.values())
+    for batcher in current:
+        batcher_stats = batcher.stats()
+        labels = {"batcher": batcher.name, "max_batch_size": batcher.max_batch_size}
+        for key in ("queue_depth", "max_queue_depth", "mean_batch_size"):
+            yield f"batcher_{key}", labels, batcher_stats[key]
+
+
+tracing.register_collector(_batcher_metrics)
+
+
+class BatchedEmbeddings(Embeddings):
+    """
+    Routes the texts of concurrent embedding calls through one shared MicroBatcher.
+
+    Queries from different sessions arriving together are embedded in a single
+    forward pass instead of one pass each. Queries are embedded like documents,
+    which is what HuggingFaceEmbeddings does without a query instruction.
+    """
+
+    def __init__(self, embeddings: Embeddings, name: str = "embeddings", max_batch_size: int = 64):
+        self.embeddings = embeddings
+        # The batcher outlives this wrapper; a weak reference lets an unloaded model be freed
+        wrapper = weakref.ref(self)
+        self.batcher = get_batcher(
+            name, lambda texts: wrapper().embeddings.embed_documents(texts), max_batch_size=max_batch_size
+        )
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self.batcher.map(texts)
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.batcher.submit(text).result()
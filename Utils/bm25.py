@@ -0,0 +1,134 @@
+import json
+import math
+import os
+import re
+from array import array
+from collections import Counter
+
+import numpy as np
+
+
+# Keeps identifiers such as part numbers ("AB-1234") and error codes ("E_042.7") in one token
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[-_./][a-z0-9]+)*")
+
+
+def tokenize(text: str) -> list[str]:
+    """Splits text into lowercase terms for lexical search."""
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+class BM25Index:
+    """
+    Compact BM25 inverted index over a set of chunks.
+
+    Each term maps to a pair of typed arrays holding the rows of the chunks it
+    occurs in and how often it occurs there, so the index costs a few bytes per
+    posting rather than a Python object per posting. Only chunk ids are kept;
+    the texts stay in the vector store's docstore. Chunks can be added and
+    removed without tokenizing the rest of the corpus again.
+    """
+
+    def __init__(self, ids: list[str], texts: list[str], k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.ids: list[str] = []
+        self.doc_lengths = array("I")
+        self.postings: dict[str, tuple[array, array]] = {}
+        self.avg_length = 0.0
+        self.add(ids, texts)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def _update_avg_length(self) -> None:
+        self.avg_length = sum(self.doc_lengths) / len(self.doc_lengths) if self.doc_lengths else 0.0
+
+    def add(self, ids: list[str], texts: list[str]) -> None:
+        """Indexes more chunks."""
+        for chunk_id, text in zip(ids, texts):
+            row = len(self.ids)
+            self.ids.append(chunk_id)
+            terms = tokenize(text)
+            self.doc_lengths.append(len(terms))
+            for term, count in Counter(terms).items():
+                rows, counts = self.postings.setdefault(term, (array("I"), array("H")))
+                rows.append(row)
+                counts.append(min(count, 65535))
+        self._update_avg_length()
+
+    def remove(self, ids: list[str]) -> None:
+        """Drops chunks from the index, renumbering the remaining rows."""
+        removed = set(ids)
+        kept = [row for row, chunk_id in enumerate(self.ids) if chunk_id not in removed]
+        if len(kept) == len(self.ids):
+            return
+        new_rows = [-1] * len(self.ids)
+        for new_row, row in enumerate(kept):
+            new_rows[row] = new_row
+
+        self.ids = [self.ids[row] for row in kept]
+        self.doc_lengths = array("I", (self.doc_lengths[row] for row in kept))
+        for term, (rows, counts) in list(self.postings.items()):
+            postings = [(new_rows[row], count) for row, count in zip(rows, counts) if new_rows[row] >= 0]
+            if postings:
+                self.postings[term] = (array("I", (row for row, _ in postings)), array("H", (c for _, c in postings)))
+            else:
+                del self.postings[term]
+        self._update_avg_length()
+
+    def search(self, query: str, k: int = 6) -> list[tuple[str, float]]:
+        """Returns the ids and BM25 scores of the k best matching chunks."""
+        scores: dict[int, float] = {}
+        n = len(self.ids)
+        for term in set(tokenize(query)):
+            if term not in self.postings:
+                continue
+            rows, counts = self.postings[term]
+            idf = math.log(1 + (n - len(rows) + 0.5) / (len(rows) + 0.5))
+            for row, count in zip(rows, counts):
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[row] / self.avg_length)
+                scores[row] = scores.get(row, 0.0) + idf * count * (self.k1 + 1) / (count + norm)
+
+        best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+        return [(self.ids[row], score) for row, score in best]
+
+    def save(self, path: str) -> None:
+        """
+        Writes the index to a directory: the postings of all terms as flat numpy
+        arrays, and the terms, chunk ids and parameters as JSON.
+        """
+        os.makedirs(path, exist_ok=True)
+        terms = list(self.postings)
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(self.postings[term][0]) for term in terms])
+        rows = np.empty(offsets[-1], dtype=np.uint32)
+        counts = np.empty(offsets[-1], dtype=np.uint16)
+        for term, start, end in zip(terms, offsets[:-1], offsets[1:]):
+            rows[start:end], counts[start:end] = self.postings[term]
+
+        np.save(os.path.join(path, "rows.npy"), rows)
+        np.save(os.path.join(path, "counts.npy"), counts)
+        np.save(os.path.join(path, "offsets.npy"), offsets)
+        np.save(os.path.join(path, "doc_lengths.npy"), np.asarray(self.doc_lengths, dtype=np.uint32))
+        with open(os.path.join(path, "index.json"), "w", encoding="utf-8") as f:
+            json.dump({"k1": self.k1, "b": self.b, "ids": self.ids, "terms": terms}, f)
+
+    @staticmethod
+    def load(path: str) -> "BM25Index":
+        """Reads an index written by save()."""
+        with open(os.path.join(path, "index.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        rows = np.load(os.path.join(path, "rows.npy"))
+        counts = np.load(os.path.join(path, "counts.npy"))
+        offsets = np.load(os.path.join(path, "offsets.npy"))
+
+        index = BM25Index([], [], k1=meta["k1"], b=meta["b"])
+        index.ids = meta["ids"]
+        index.doc_lengths = array("I", np.load(os.path.join(path, "doc_lengths.npy")).astype(np.uint32).tobytes())
+        for term, start, end in zip(meta["terms"], offsets[:-1], offsets[1:]):
+            index.postings[term] = (
+                array("I", rows[start:end].astype(np.uint32).tobytes()),
+                array("H", counts[start:end].astype(np.uint16).tobytes()),
+            )
+        index._update_avg_length()
+        return index
@@ -0,0 +1,134 @@
+import re
+
+from langchain_core.documents import Document
+from langchain_core.messages import BaseMessage, HumanMessage
+
+from Utils import tracing
+
+
+CHARS_PER_TOKEN = 4  # Rough average for English text with the Gemini tokenizer
+MAX_CHUNK_OVERLAP = 200  # Twice the splitter's overlap, in characters
+
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimates the number of tokens in a text without running a tokenizer."""
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def _record(budget_span: tracing.Span, kind: str, before: int, after: int) -> None:
+    # This request's savings go on its span, for the trace log; the counters keep running totals
+    budget_span.set(tokens_before=before, tokens_after=after)
+    tracing.increment("budget_tokens", before, kind=kind, stage="before")
+    tracing.increment("budget_tokens", after, kind=kind, stage="after")
+
+
+def _overlap(first: str, second: str) -> int:
+    """Returns the length of the longest suffix of first that is a prefix of second."""
+    for size in range(min(len(first), len(second), MAX_CHUNK_OVERLAP), 0, -1):
+        if first.endswith(second[:size]):
+            return size
+    return 0
+
+
+def merge_overlapping(documents: list[Document]) -> list[Document]:
+    """
+    Removes duplicated text between retrieved chunks.
+
+    Chunks contained in a better ranked chunk are dropped, and neighbouring chunks
+    of the same source that share the splitter's overlap are stitched into one
+    passage that keeps the better rank.
+    """
+    passages: list[Document] = []
+    for document in documents:
+        text = document.page_content
+        for i, passage in enumerate(passages):
+            if text in passage.page_content:
+                break
+            if passage.metadata.get("source") != document.metadata.get("source"):
+                continue
+            if overlap := _overlap(passage.page_content, text):
+                passages[i] = Document(page_content=passage.page_content + text[overlap:], metadata=passage.metadata)
+                break
+            if overlap := _overlap(text, passage.page_content):
+                passages[i] = Document(page_content=text + passage.page_content[overlap:], metadata=passage.metadata)
+                break
+        else:
+            passages.append(document)
+    return passages
+
+
+def _truncate(text: str, max_tokens: int) -> str:
+    """Cuts text to a token budget, preferring to end on a sentence boundary."""
+    text = text[: max_tokens * CHARS_PER_TOKEN]
+    boundary = max(text.rfind(". "), text.rfind("\n"))
+    return text[: boundary + 1] if boundary > len(text) // 2 else text
+
+
+def compress_context(documents: list[Document], max_tokens: int = 1500) -> list[Document]:
+    """
+    Fits retrieved chunks into a token budget.
+
+    Chunks are deduplicated, kept in retrieval (relevance) order until the budget
+    runs out, and the last passage that fits only partially is trimmed.
+    """
+    with tracing.span("compress_context", documents=len(documents)) as budget_span:
+        before = sum(estimate_tokens(document.page_content) for document in documents)
+        kept, used = [], 0
+        for passage in merge_overlapping(documents):
+            tokens = estimate_tokens(passage.page_content)
+            if used + tokens > max_tokens:
+                remaining = max_tokens - used
+                if remaining > 50:  # Skip fragments too short to carry an answer
+                    text = _truncate(passage.page_content, remaining)
+                    kept.append(Document(page_content=text, metadata=passage.metadata))
+                break
+            kept.append(passage)
+            used += tokens
+
+        after = sum(estimate_tokens(document.page_content) for document in kept)
+        _record(budget_span, "context", before, after)
+        return kept
+
+
+def _first_sentence(text: str, max_chars: int = 120) -> str:
+    sentence = re.split(r"(?<=[.!?])\s", text.strip(), maxsplit=1)[0]
+    return sentence if len(sentence) <= max_chars else sentence[:max_chars].rstrip() + "..."
+
+
+def window_history(chat_history: list[BaseMessage], max_tokens: int = 1000) -> list[BaseMessage]:
+    """
+    Fits the chat history into a token budget.
+
+    The most recent turns are kept verbatim. Older turns are reduced to a digest of
+    the questions the user asked, which is prepended to the oldest kept user turn
+    so the conversation still alternates between user and assistant.
+    """
+    with tracing.span("window_history", messages=len(chat_history)) as budget_span:
+        before = sum(estimate_tokens(message.content) for message in chat_history)
+        if before <= max_tokens:
+            _record(budget_span, "history", before, before)
+            return chat_history
+
+        start, used = len(chat_history), 0
+        for i in range(len(chat_history) - 1, -1, -1):
+            used += estimate_tokens(chat_history[i].content)
+            if used > max_tokens:
+                break
+            start = i
+        while start < len(chat_history) and not isinstance(chat_history[start], HumanMessage):
+            start += 1  # Start the window on a user turn
+
+        older_questions = [_first_sentence(m.content) for m in chat_history[:start] if isinstance(m, HumanMessage)]
+        window = list(chat_history[start:])
+        if older_questions:
+            digest = "Earlier in this conversation the user asked: " + " | ".join(older_questions)
+            digest = _truncate(digest, max_tokens // 4)
+            if window:
+                window[0] = HumanMessage(content=f"({digest})\n\n{window[0].content}")
+            else:
+                window = [HumanMessage(content=digest)]
+
+        after = sum(estimate_tokens(message.content) for message in window)
+        _record(budget_span, "history", before, after)
+        return window
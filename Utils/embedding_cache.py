@@ -0,0 +1,253 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from Utils import tracing
+
+try:
+    import fcntl
+except ImportError:  # Windows: fall back to in-process locking only
+    fcntl = None
+
+
+DEFAULT_CACHE_DIR = os.environ.get(
+    "NISMOGEN_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "nismogen")
+)
+DEFAULT_MAX_ENTRIES = int(os.environ.get("NISMOGEN_EMBEDDING_CACHE_ENTRIES", 100_000))
+
+DIGEST_SIZE = 20  # SHA-1 digest of the chunk text
+JOURNAL_SIZE = 4096  # Recently written rows, so other processes can update their lookup without a rescan
+
+
+def text_digest(text: str) -> bytes:
+    """Returns the cache key of a chunk of text."""
+    return hashlib.sha1(text.encode("utf-8")).digest()
+
+
+class EmbeddingCache:
+    """
+    Disk-backed, size-bounded LRU cache of chunk embeddings for one model.
+
+    Vectors live in a fixed-capacity memory-mapped matrix (``vectors.bin``), the
+    digest of the text stored in every row in a parallel memory-mapped array
+    (``keys.bin``) and the time every row was last used in a third (``used.bin``),
+    so hits and writes only touch the rows involved. ``generation.bin`` counts the
+    rows ever written and ``journal.bin`` is a ring of the last ones, from which
+    other processes update their digest lookup; only a process that fell too far
+    behind rescans ``keys.bin``. A row's key is cleared while its vector is rewritten and checked again after
+    the vector is read, so a reader never pairs a digest with another text's vector.
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        cache_dir: str = DEFAULT_CACHE_DIR,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        dtype: str = "float16",
+    ):
+        slug = re.sub(r"[^A-Za-z0-9_.-]+", "_", model_name)
+        self.path = os.path.join(cache_dir, "embeddings", slug)
+        self.max_entries = max_entries
+        self.dtype = np.dtype(dtype)
+        self.dim: int | None = None
+        self.vectors: np.memmap | None = None
+        self.keys: np.memmap | None = None
+        self.used: np.memmap | None = None  # Last-used stamp per row, 0 for free rows
+        self.generation: np.memmap | None = None
+        self.journal: np.memmap | None = None
+        self.slots: dict[bytes, int] = {}  # Digest -> row, as of self._generation
+        self._slot_keys: dict[int, bytes] = {}  # The reverse of self.slots
+        self._generation = -1
+        self._last_stamp = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+        self._load_meta()
+
+    @contextmanager
+    def _file_lock(self):
+        """Serializes writers across threads and processes sharing the cache directory."""
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            with open(os.path.join(self.path, ".lock"), "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _load_meta(self) -> None:
+        """Opens the cache files if another process or an earlier run has created them."""
+        meta_path = os.path.join(self.path, "meta.json")
+        if not os.path.exists(meta_path):
+            return
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta["dtype"] != self.dtype.name or meta["capacity"] != self.max_entries:
+            return  # Layout changed: start over rather than misread the matrix
+        self._open(meta["dim"], create=False)
+
+    def _open(self, dim: int, create: bool) -> None:
+        mode = "w+" if create else "r+"
+
+        def array(name: str, dtype, shape: tuple) -> np.memmap:
+            return np.memmap(os.path.join(self.path, name), dtype=dtype, mode=mode, shape=shape)
+
+        self.dim = dim
+        self.vectors = array("vectors.bin", self.dtype, (self.max_entries, dim))
+        self.keys = array("keys.bin", np.uint8, (self.max_entries, DIGEST_SIZE))
+        self.used = array("used.bin", np.int64, (self.max_entries,))
+        self.generation = array("generation.bin", np.int64, (1,))
+        self.journal = array("journal.bin", np.int64, (JOURNAL_SIZE,))
+        self._generation = -1
+        if create:  # Written last, so other processes only open complete files
+            meta_path = os.path.join(self.path, "meta.json")
+            tmp_path = f"{meta_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"dim": dim, "dtype": self.dtype.name, "capacity": self.max_entries}, f)
+            os.replace(tmp_path, meta_path)
+
+    def _refresh(self, slot: int) -> None:
+        """Updates the digest lookup for one row from keys.bin."""
+        old = self._slot_keys.pop(slot, None)
+        if old is not None and self.slots.get(old) == slot:
+            del self.slots[old]
+        digest = self.keys[slot].tobytes()
+        if any(digest):  # Cleared while another process rewrites it; its journal entry follows
+            self.slots[digest] = slot
+            self._slot_keys[slot] = digest
+
+    def _sync(self) -> None:
+        """Brings the digest lookup up to date with the rows other processes have written."""
+        generation = int(self.generation[0])
+        if generation == self._generation:
+            return
+        # A writer journals at most half the ring beyond the published generation, so entries
+        # read while the generation stays within half a ring of ours cannot have been overwritten
+        if 0 <= self._generation and generation - self._generation <= JOURNAL_SIZE // 2:
+            written = [int(self.journal[g % JOURNAL_SIZE]) for g in range(self._generation, generation)]
+            if int(self.generation[0]) - self._generation <= JOURNAL_SIZE // 2:
+                for slot in written:
+                    self._refresh(slot)
+                self._generation = generation
+                return
+
+        raw = self.keys.tobytes()
+        self._slot_keys = {
+            int(slot): raw[slot * DIGEST_SIZE:(slot + 1) * DIGEST_SIZE] for slot in np.flatnonzero(self.keys.any(axis=1))
+        }
+        self.slots = {digest: slot for slot, digest in self._slot_keys.items()}
+        self._generation = generation
+
+    def _stamp(self) -> int:
+        self._last_stamp = max(time.time_ns(), self._last_stamp + 1)
+        return self._last_stamp
+
+    def get_many(self, digests: list[bytes]) -> dict[bytes, np.ndarray]:
+        """Returns the cached vectors for the digests that are present."""
+        found = {}
+        with self._lock:
+            if self.vectors is None:
+                self._load_meta()
+            if self.vectors is None:
+                self.misses += len(digests)
+                return found
+            self._sync()
+            for digest in digests:
+                slot = self.slots.get(digest)
+                if slot is None or self.keys[slot].tobytes() != digest:
+                    continue
+                vector = np.array(self.vectors[slot], dtype=np.float32)
+                if self.keys[slot].tobytes() == digest:  # Not rewritten while it was being read
+                    found[digest] = vector
+                    self.used[slot] = self._stamp()
+            self.hits += len(found)
+            self.misses += len(digests) - len(found)
+        return found
+
+    def put_many(self, items: dict[bytes, np.ndarray]) -> None:
+        """Stores vectors, evicting the least recently used rows when full."""
+        if not items:
+            return
+        with self._file_lock():
+            if self.vectors is None:
+                self._load_meta()
+            if self.vectors is None:
+                self._open(len(next(iter(items.values()))), create=True)
+            self._sync()  # Pick up rows written by other processes since we last looked
+
+            items = dict(list(items.items())[-self.max_entries:])
+            stamp = self._stamp()
+            slots = {digest: self.slots[digest] for digest in items if digest in self.slots}
+            self.used[list(slots.values())] = stamp  # Keeps rows being rewritten from being chosen for eviction
+            new = [digest for digest in items if digest not in slots]
+            if new:
+                # Free rows have stamp 0, so they are taken before any row is evicted
+                if len(new) < self.max_entries:
+                    victims = np.argpartition(self.used, len(new) - 1)[:len(new)]
+                else:
+                    victims = range(len(new))
+                slots.update(zip(new, (int(slot) for slot in victims)))
+
+            generation = int(self.generation[0])
+            journaled = len(slots) <= JOURNAL_SIZE // 2  # Larger writes make other processes rescan
+            for i, (digest, slot) in enumerate(slots.items()):
+                self.keys[slot] = 0  # Readers miss on this row until the new key is published
+                self.vectors[slot] = items[digest]
+                self.keys[slot] = np.frombuffer(digest, dtype=np.uint8)
+                self.used[slot] = stamp
+                self._refresh(slot)
+                if journaled:
+                    self.journal[(generation + i) % JOURNAL_SIZE] = slot
+            self.generation[0] = self._generation = generation + len(slots)
+            for array in (self.vectors, self.keys, self.used, self.journal, self.generation):
+                array.flush()
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Wraps an embeddings model with a persistent ``EmbeddingCache``.
+
+    Only chunks whose text has never been embedded by the same model are sent to
+    the underlying model; everything else is read back from disk.
+    """
+
+    def __init__(self, embeddings: Embeddings, model_name: str, cache: EmbeddingCache | None = None):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.cache = cache or EmbeddingCache(model_name)
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        """Embeds documents, computing only the vectors missing from the cache."""
+        with tracing.span("embed", texts=len(texts)) as embed_span:
+            digests = [text_digest(text) for text in texts]
+            found = self.cache.get_many(list(set(digests)))
+
+            missing = {}
+            for digest, text in zip(digests, texts):
+                if digest not in found and digest not in missing:
+                    missing[digest] = text
+            embed_span.set(cache_hits=len(texts) - len(missing), computed=len(missing))
+            tracing.increment("cache_hits", len(texts) - len(missing), cache="embedding")
+            tracing.increment("cache_misses", len(missing), cache="embedding")
+            if missing:
+                computed = self.embeddings.embed_documents(list(missing.values()))
+                new_vectors = {digest: np.asarray(vector, dtype=np.float32) for digest, vector in zip(missing, computed)}
+                self.cache.put_many(new_vectors)
+                found.update(new_vectors)
+
+            return [found[digest].tolist() for digest in digests]
+
+    def embed_query(self, text: str) -> list[float]:
+        """Embeds a query; queries are rarely repeated, so they bypass the cache."""
+        return self.embeddings.embed_query(text)
@@ -0,0 +1,138 @@
+import os
+import re
+import threading
+from collections import Counter
+from typing import Any, Callable
+
+from Utils.embedding_cache import DEFAULT_CACHE_DIR
+from Utils.model_registry import registry
+
+
+# "torch": fp32 PyTorch, as loaded from the hub
+# "int8":  PyTorch with dynamically quantized int8 Linear layers
+# "onnx":  ONNX Runtime export; generation reuses the encoder output and the decoder's KV cache
+BACKENDS = ("torch", "int8", "onnx")
+
+ONNX_DIR = os.path.join(DEFAULT_CACHE_DIR, "onnx")
+
+_backend_overrides: dict[str, str] = {}
+_backend_lock = threading.Lock()  # Serializes switches so the override and the unloaded model stay in step
+
+
+def backend_for(model_key: str) -> str:
+    """
+    Returns the inference backend selected for a registered model.
+
+    The backend is set per model with use_backend() or with an environment variable
+    such as NISMOGEN_SUMMARIZER_BACKEND=int8, and defaults to "torch".
+    """
+    backend = _backend_overrides.get(model_key) or os.environ.get(f"NISMOGEN_{model_key.upper()}_BACKEND", "torch")
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown inference backend {backend!r} for {model_key}; expected one of {BACKENDS}")
+    return backend
+
+
+def use_backend(model_key: str, backend: str) -> None:
+    """
+    Switches a registered model to another backend for the whole process; it is reloaded on next use.
+
+    Every session using the model switches with it. To try a backend without
+    affecting others, load a private copy instead, as compare_backends does.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown inference backend {backend!r}; expected one of {BACKENDS}")
+    with _backend_lock:
+        _backend_overrides[model_key] = backend
+        registry.unload(model_key)
+
+
+def quantize_int8(model: Any) -> Any:
+    """Quantizes the Linear layers of a PyTorch model to int8 with dynamic activation scaling."""
+    import torch
+    quantization = getattr(torch, "ao", torch).quantization
+    return quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def load_seq2seq_model(model_name: str, backend: str) -> Any:
+    """
+    Loads a sequence-to-sequence model with the given backend.
+
+    ONNX exports are cached on disk, so only the first load pays for the export.
+    """
+    if backend == "onnx":
+        from optimum.onnxruntime import ORTModelForSeq2SeqLM
+        export_path = os.path.join(ONNX_DIR, re.sub(r"[^A-Za-z0-9_.-]+", "_", model_name))
+        if os.path.isdir(export_path):
+            return ORTModelForSeq2SeqLM.from_pretrained(export_path, use_cache=True)
+        model = ORTModelForSeq2SeqLM.from_pretrained(model_name, export=True, use_cache=True)
+        model.save_pretrained(export_path)
+        return model
+
+    from transformers import AutoModelForSeq2SeqLM
+    model = AutoModelForSeq2SeqLM.from_pretrained(model_name).eval()
+    return quantize_int8(model) if backend == "int8" else model
+
+
+def load_image_to_text_model(model_name: str, backend: str) -> Any:
+    """
+    Loads an image-to-text model with the given backend.
+
+    ONNX Runtime has no export for BLIP's generation loop, so only "torch" and "int8" are supported.
+    """
+    from transformers import AutoModelForImageTextToText
+    if backend == "onnx":
+        raise ValueError(f"ONNX export is not available for {model_name}; use the torch or int8 backend")
+    model = AutoModelForImageTextToText.from_pretrained(model_name).eval()
+    return quantize_int8(model) if backend == "int8" else model
+
+
+def token_overlap(reference: str, candidate: str) -> float:
+    """Returns the unigram F1 overlap between two texts, as in ROUGE-1."""
+    reference_tokens, candidate_tokens = Counter(reference.lower().split()), Counter(candidate.lower().split())
+    common = sum((reference_tokens & candidate_tokens).values())
+    if not common:
+        return float(reference == candidate)
+    precision = common / sum(candidate_tokens.values())
+    recall = common / sum(reference_tokens.values())
+    return 2 * precision * recall / (precision + recall)
+
+
+def compare_backends(
+    load: Callable[[str], Any],
+    generate: Callable[[Any, Any], str],
+    inputs: list,
+    backend: str,
+    min_overlap: float = 0.8,
+) -> dict:
+    """
+    Checks that a backend produces outputs equivalent to the fp32 PyTorch model.
+
+    Both models are private copies loaded with load(), so the models registered for
+    live sessions and their selected backends are left untouched.
+
+    Args:
+        load (Callable[[str], Any]): Loads the model with a backend, e.g. load_summarizer.
+        generate (Callable[[Any, Any], str]): Runs a loaded model on one input.
+        inputs (list): Inputs to compare the backends on.
+        backend (str): The backend to check against "torch".
+        min_overlap (float): Lowest acceptable mean token overlap with the fp32 outputs.
+
+    Returns:
+        dict: Exact-match rate, mean and minimum token overlap, and whether the backend passed.
+    """
+    model = load("torch")
+    references = [generate(model, item) for item in inputs]
+    del model  # Release the fp32 copy before loading the other one
+    model = load(backend)
+    candidates = [generate(model, item) for item in inputs]
+    del model
+
+    overlaps = [token_overlap(reference, candidate) for reference, candidate in zip(references, candidates)]
+    mean_overlap = sum(overlaps) / len(overlaps) if overlaps else 1.0
+    return {
+        "backend": backend,
+        "exact_match": sum(r == c for r, c in zip(references, candidates)) / max(len(inputs), 1),
+        "mean_overlap": mean_overlap,
+        "min_overlap": min(overlaps, default=1.0),
+        "passed": mean_overlap >= min_overlap,
+    }
@@ -0,0 +1,171 @@
+import io
+import multiprocessing
+import os
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import islice
+from typing import Iterable, Iterator
+
+import PyPDF2
+import pandas as pd
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from streamlit.runtime.uploaded_file_manager import UploadedFile
+
+from Utils.utils import get_file_extension
+
+
+PAGES_PER_TASK = 16  # Pages extracted by a worker per task
+PARALLEL_PDF_MIN_PAGES = 32  # Smaller PDFs are not worth handing to the process pool
+PDF_WORKERS = int(os.environ.get("NISMOGEN_PDF_WORKERS", os.cpu_count() or 1))
+CSV_BATCH_ROWS = 500
+TEXT_BLOCK_CHARS = 64 * 1024
+EMBED_BATCH_SIZE = 64  # Chunks handed to the embedder at a time
+
+_pdf_pool: ProcessPoolExecutor | None = None
+_pdf_pool_pid: int | None = None
+_pdf_pool_lock = threading.Lock()
+_pdf_readers: dict[tuple, PyPDF2.PdfReader] = {}  # The PDF last opened by a worker process
+
+
+def _get_pdf_pool() -> ProcessPoolExecutor:
+    """
+    Returns the process-wide pool that extracts PDF pages, starting it on first use.
+
+    Workers are spawned rather than forked, so they do not inherit the models,
+    threads and locks of the app, and they are reused by every later PDF.
+    """
+    global _pdf_pool, _pdf_pool_pid
+    with _pdf_pool_lock:
+        if _pdf_pool is None or _pdf_pool_pid != os.getpid():
+            _pdf_pool = ProcessPoolExecutor(PDF_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+            _pdf_pool_pid = os.getpid()
+        return _pdf_pool
+
+
+def _reset_pdf_pool(pool: ProcessPoolExecutor) -> None:
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is pool:
+            _pdf_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _extract_pages(path: str, start: int, end: int) -> list[str]:
+    """Extracts a range of pages, opening the PDF only on a worker's first task for it."""
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime_ns)
+    if key not in _pdf_readers:
+        _pdf_readers.clear()
+        _pdf_readers[key] = PyPDF2.PdfReader(path)
+    pages = _pdf_readers[key].pages
+    return [pages[i].extract_text() or "" for i in range(start, end)]
+
+
+def _warn_if_empty(page_num: int, page_text: str) -> str:
+    if not page_text:
+        print(f"Warning: No text extracted from page {page_num}")
+    return page_text
+
+
+def iter_pdf_pages(uploaded_file: UploadedFile) -> Iterator[str]:
+    """
+    Yields the text of a PDF page by page, in order.
+
+    Large PDFs are written to a temporary file and their pages extracted by a
+    long-lived process pool. Tasks carry only the file's path and a page range, and
+    at most two tasks per worker are in flight, so pages are produced in parallel
+    while memory stays bounded.
+    """
+    data = uploaded_file.getvalue()
+    reader = PyPDF2.PdfReader(io.BytesIO(data))
+    num_pages = len(reader.pages)
+
+    if num_pages < PARALLEL_PDF_MIN_PAGES:
+        for page_num in range(num_pages):
+            yield _warn_if_empty(page_num, reader.pages[page_num].extract_text() or "")
+        return
+
+    handle, path = tempfile.mkstemp(suffix=".pdf")
+    try:
+        with os.fdopen(handle, "wb") as f:
+            f.write(data)
+        del data, reader
+
+        pool = _get_pdf_pool()
+        tasks = iter(range(0, num_pages, PAGES_PER_TASK))
+        in_flight = [
+            pool.submit(_extract_pages, path, start, min(start + PAGES_PER_TASK, num_pages))
+            for start in islice(tasks, 2 * PDF_WORKERS)
+        ]
+        page_num = 0
+        try:
+            while in_flight:
+                pages = in_flight.pop(0).result()
+                for start in islice(tasks, 1):
+                    in_flight.append(pool.submit(_extract_pages, path, start, min(start + PAGES_PER_TASK, num_pages)))
+                for page_text in pages:
+                    yield _warn_if_empty(page_num, page_text)
+                    page_num += 1
+        except BrokenProcessPool:
+            _reset_pdf_pool(pool)  # The next PDF starts a fresh pool
+            raise
+        finally:
+            for future in in_flight:
+                future.cancel()
+    finally:
+        os.remove(path)
+
+
+def iter_csv_rows(uploaded_file: UploadedFile, batch_rows: int = CSV_BATCH_ROWS) -> Iterator[str]:
+    """Yields a CSV file as text, one batch of rows at a time, each with the column header."""
+    for frame in pd.read_csv(uploaded_file, chunksize=batch_rows):
+        yield frame.to_string()
+
+
+def iter_text_blocks(uploaded_file: UploadedFile, block_chars: int = TEXT_BLOCK_CHARS) -> Iterator[str]:
+    """Yields a text file in fixed-size blocks."""
+    reader = io.TextIOWrapper(io.BytesIO(uploaded_file.getvalue()), encoding="utf-8")
+    while block := reader.read(block_chars):
+        yield block
+
+
+def iter_file_texts(uploaded_file: UploadedFile) -> Iterator[str]:
+    """Yields the text of an uploaded file piece by piece: pages, row batches or blocks."""
+    extension = get_file_extension(uploaded_file.name).lower()
+    if extension in ("pdf", "arxiv"):
+        return iter_pdf_pages(uploaded_file)
+    elif extension == "csv":
+        return iter_csv_rows(uploaded_file)
+    elif extension in ("txt", "md"):
+        return iter_text_blocks(uploaded_file)
+    else:
+        return iter(["Not supported file type."])
+
+
+def iter_chunks(uploaded_file: UploadedFile, chunk_size: int = 1000, chunk_overlap: int = 100) -> Iterator[str]:
+    """
+    Yields the chunks of an uploaded file without holding the whole document in memory.
+
+    Each piece of text is split as soon as it is read. The last chunk of a piece is
+    held back and split again together with the next piece, so chunks can still
+    span page and block boundaries.
+    """
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    carry = ""
+    for text in iter_file_texts(uploaded_file):
+        chunks = text_splitter.split_text(carry + text)
+        if not chunks:
+            continue
+        yield from chunks[:-1]
+        carry = chunks[-1]
+    if carry:
+        yield carry
+
+
+def batched(iterable: Iterable, size: int = EMBED_BATCH_SIZE) -> Iterator[list]:
+    """Groups an iterable into lists of at most size items."""
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
@@ -0,0 +1,467 @@
+import asyncio
+import hashlib
+import json
+import os
+import queue
+import random
+import threading
+import time
+from typing import Any, AsyncIterator, Iterator
+
+import aiohttp
+from langchain_core.callbacks import CallbackManagerForLLMRun
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, SystemMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+from Utils import tracing
+
+GEMINI_BASE_URL = os.environ.get("NISMOGEN_GEMINI_BASE_URL", "https://generativelanguage.googleapis.com")
+GEMINI_MODEL = os.environ.get("NISMOGEN_GEMINI_MODEL", "gemini-1.5-flash")
+REQUESTS_PER_MINUTE = float(os.environ.get("NISMOGEN_LLM_RPM", 15))  # The Gemini 1.5 Flash free-tier quota
+BURST = int(os.environ.get("NISMOGEN_LLM_BURST", 4))  # Requests that may go out back to back after a quiet period
+HEDGE_AFTER_S = float(os.environ.get("NISMOGEN_LLM_HEDGE_S", 4.0))  # 0 disables hedged requests
+MAX_ATTEMPTS = 3
+MAX_BACKOFF_S = 8.0  # Longest wait between attempts, also when the API asks for a longer Retry-After
+DEADLINE_S = float(os.environ.get("NISMOGEN_LLM_DEADLINE_S", 180.0))  # For a whole request, with throttling and retries
+MAX_CONNECTIONS = 32
+CONNECT_TIMEOUT_S = 5.0
+READ_TIMEOUT_S = 30.0  # Longest wait for the first chunk, and between chunks
+REQUEST_TIMEOUT_S = 120.0
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class LLMGatewayError(RuntimeError):
+    """A failed Gemini request; retryable errors are retried by the gateway before they are raised."""
+
+    def __init__(self, message: str, retryable: bool = False, retry_after: float | None = None):
+        super().__init__(message)
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """
+    Spaces requests out to a steady rate while allowing short bursts.
+
+    Waiters reserve a token before sleeping, so they are served in arrival order
+    and a burst of callers is spread out instead of retrying all at once. Only
+    used from the gateway's event loop, so it needs no lock.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate  # Tokens per second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.waiting = 0
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self) -> bool:
+        """Takes a token if one is available right now."""
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    async def acquire(self) -> float:
+        """Takes a token, waiting for it if needed, and returns the seconds waited."""
+        self._refill()
+        self.tokens -= 1
+        wait = max(-self.tokens / self.rate, 0.0)
+        if wait:
+            self.waiting += 1
+            try:
+                await asyncio.sleep(wait)
+            except asyncio.CancelledError:
+                self.tokens += 1  # Give back the reservation
+                raise
+            finally:
+                self.waiting -= 1
+        return wait
+
+    def available(self) -> float:
+        """Returns the tokens that could be taken right now, without taking any."""
+        return max(min(self.capacity, self.tokens + (time.monotonic() - self.updated) * self.rate), 0.0)
+
+    def drain(self) -> None:
+        """Empties the bucket, e.g. after the API answered 429, so that callers back off together."""
+        self._refill()
+        self.tokens = min(self.tokens, 0.0)
+
+
+class _SharedResponse:
+    """One upstream response, read by every caller that asked for the same prompt while it was in flight."""
+
+    def __init__(self):
+        self.chunks: list[str] = []
+        self.done = False
+        self.error: BaseException | None = None
+        self.readers = 0
+        self.task: asyncio.Task | None = None
+        self._changed = asyncio.Event()
+
+    def publish(self, chunk: str) -> None:
+        self.chunks.append(chunk)
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def finish(self, error: BaseException | None = None) -> None:
+        self.done, self.error = True, error
+        self._changed.set()
+
+    async def read(self) -> AsyncIterator[str]:
+        """Yields every chunk from the start, so late readers get the whole response."""
+        i = 0
+        while True:
+            if i < len(self.chunks):
+                yield self.chunks[i]
+                i += 1
+            elif self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            else:
+                await self._changed.wait()
+
+
+def to_gemini_request(messages: list[BaseMessage], **generation_config) -> dict:
+    """
+    Converts chat messages to a Gemini generateContent request body.
+
+    System messages become the system instruction and consecutive messages of the
+    same role are merged, as the API expects user and model turns to alternate.
+    Generation settings that are None are left to the API's defaults.
+    """
+    system, contents = [], []
+    for message in messages:
+        part = {"text": str(message.content)}
+        if isinstance(message, SystemMessage):
+            system.append(part)
+            continue
+        role = "model" if message.type == "ai" else "user"
+        if contents and contents[-1]["role"] == role:
+            contents[-1]["parts"].append(part)
+        else:
+            contents.append({"role": role, "parts": [part]})
+
+    request = {"contents": contents}
+    if system:
+        request["systemInstruction"] = {"parts": system}
+    config = {key: value for key, value in generation_config.items() if value is not None}
+    if config:
+        request["generationConfig"] = config
+    return request
+
+
+def _response_text(data: dict) -> str:
+    candidates = data.get("candidates") or [{}]
+    parts = candidates[0].get("content", {}).get("parts", [])
+    return "".join(part.get("text", "") for part in parts)
+
+
+def _retry_after(response: aiohttp.ClientResponse) -> float | None:
+    try:
+        return float(response.headers["Retry-After"])
+    except (KeyError, ValueError):
+        return None
+
+
+class LLMGateway:
+    """
+    Shared asynchronous client for the Gemini REST API.
+
+    Every model call in the process goes through one event loop thread, one pooled
+    HTTP session and one token bucket matched to the API quota, so concurrent
+    sessions share the quota instead of each running into 429s on its own.
+    Identical prompts that are in flight at the same time are sent once and the
+    response is streamed to all callers. Connection errors, timeouts, 429 and 5xx
+    are retried with capped, jittered backoff as long as no text has been streamed
+    yet and deadline_s has not passed, and a request that has produced nothing
+    after hedge_after_s is raced against a second one when the quota allows it.
+    """
+
+    def __init__(
+        self,
+        base_url: str = GEMINI_BASE_URL,
+        api_key: str | None = None,
+        requests_per_minute: float = REQUESTS_PER_MINUTE,
+        burst: int = BURST,
+        hedge_after_s: float = HEDGE_AFTER_S,
+        max_attempts: int = MAX_ATTEMPTS,
+        max_backoff_s: float = MAX_BACKOFF_S,
+        deadline_s: float = DEADLINE_S,
+        max_connections: int = MAX_CONNECTIONS,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key
+        self.requests_per_minute = requests_per_minute
+        self.burst = burst
+        self.hedge_after_s = hedge_after_s
+        self.max_attempts = max_attempts
+        self.max_backoff_s = max_backoff_s
+        self.deadline_s = deadline_s
+        self.max_connections = max_connections
+        self.bucket = TokenBucket(requests_per_minute / 60, burst)
+        self._inflight: dict[str, _SharedResponse] = {}
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._session: aiohttp.ClientSession | None = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _event_loop(self) -> asyncio.AbstractEventLoop:
+        """Starts the gateway's event loop thread on first use, and again in a forked child."""
+        with self._lock:
+            if self._loop is None or self._pid != os.getpid():
+                self._loop = asyncio.new_event_loop()
+                self._session = None
+                self._inflight = {}
+                self.bucket = TokenBucket(self.requests_per_minute / 60, self.burst)
+                self._pid = os.getpid()
+                threading.Thread(target=self._loop.run_forever, name="llm-gateway", daemon=True).start()
+            return self._loop
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=60, ttl_dns_cache=300),
+                timeout=aiohttp.ClientTimeout(
+                    total=REQUEST_TIMEOUT_S, sock_connect=CONNECT_TIMEOUT_S, sock_read=READ_TIMEOUT_S
+                ),
+            )
+        return self._session
+
+    def stream(self, model: str, request: dict, info: dict | None = None) -> Iterator[str]:
+        """
+        Yields the text of a response as it streams in; can be called from any thread.
+
+        Args:
+            model (str): The Gemini model, e.g. "gemini-1.5-flash".
+            request (dict): The generateContent request body, see to_gemini_request.
+            info (dict, optional): Filled with how the request was served: coalesced, attempts, hedged and throttle_ms.
+        """
+        chunks: queue.Queue = queue.Queue()
+
+        async def pump():
+            try:
+                async for chunk in self.astream(model, request, info):
+                    chunks.put((chunk, None))
+                chunks.put((None, None))
+            except Exception as e:
+                chunks.put((None, e))
+
+        future = asyncio.run_coroutine_threadsafe(pump(), self._event_loop())
+        try:
+            while True:
+                chunk, error = chunks.get()
+                if error is not None:
+                    raise error
+                if chunk is None:
+                    return
+                yield chunk
+        finally:
+            future.cancel()  # The caller stopped reading; the upstream request ends once nobody else reads it
+
+    async def astream(self, model: str, request: dict, info: dict | None = None) -> AsyncIterator[str]:
+        """Yields the text of a response; must run on the gateway's event loop."""
+        info = {} if info is None else info
+        key = hashlib.sha256(json.dumps([model, request], sort_keys=True).encode("utf-8")).hexdigest()
+        shared = self._inflight.get(key)
+        info["coalesced"] = shared is not None
+        tracing.increment("llm_requests", coalesced=str(shared is not None).lower())
+        if shared is None:
+            shared = self._inflight[key] = _SharedResponse()
+            shared.task = asyncio.ensure_future(self._fetch(key, model, request, shared, info))
+
+        shared.readers += 1
+        try:
+            async for chunk in shared.read():
+                yield chunk
+        finally:
+            shared.readers -= 1
+            if shared.readers == 0 and not shared.done:
+                shared.task.cancel()
+
+    async def _fetch(self, key: str, model: str, request: dict, shared: _SharedResponse, info: dict) -> None:
+        deadline = time.monotonic() + self.deadline_s
+        try:
+            for attempt in range(1, self.max_attempts + 1):
+                info["attempts"] = attempt
+                try:
+                    await asyncio.wait_for(self._hedged(model, request, shared, info), deadline - time.monotonic())
+                    break
+                except asyncio.TimeoutError:  # Timeouts of a single attempt arrive as LLMGatewayError
+                    raise LLMGatewayError(f"Gemini request did not finish within {self.deadline_s:g}s") from None
+                except LLMGatewayError as e:
+                    if not e.retryable or shared.chunks or attempt == self.max_attempts:
+                        raise
+                    backoff = min(e.retry_after or 0.5 * 2 ** attempt * random.uniform(0.5, 1.5), self.max_backoff_s)
+                    if time.monotonic() + backoff >= deadline:
+                        raise
+                    tracing.increment("llm_retries")
+                    await asyncio.sleep(backoff)
+            shared.finish()
+        except asyncio.CancelledError:
+            shared.finish(LLMGatewayError("Request cancelled"))
+            raise
+        except Exception as e:
+            tracing.increment("llm_failures")
+            shared.finish(e)
+        finally:
+            if self._inflight.get(key) is shared:
+                del self._inflight[key]
+
+    async def _hedged(self, model: str, request: dict, shared: _SharedResponse, info: dict) -> None:
+        """Sends the request, and a second copy if the first is slow; the first to produce text wins."""
+        waited = await self.bucket.acquire()
+        info["throttle_ms"] = info.get("throttle_ms", 0.0) + waited * 1000
+        if waited:
+            tracing.increment("llm_throttle_seconds", waited)
+
+        claim: dict = {}  # "owner": the index of the attempt whose text is streamed
+        first_text = asyncio.Event()
+        attempts = [asyncio.ensure_future(self._attempt(model, request, shared, claim, 0, first_text))]
+        try:
+            if self.hedge_after_s:
+                started = asyncio.ensure_future(first_text.wait())
+                done, _ = await asyncio.wait(
+                    [attempts[0], started], timeout=self.hedge_after_s, return_when=asyncio.FIRST_COMPLETED
+                )
+                started.cancel()
+                if not done and self.bucket.try_acquire():  # Hedge only with spare quota
+                    info["hedged"] = True
+                    tracing.increment("llm_hedges")
+                    attempts.append(asyncio.ensure_future(self._attempt(model, request, shared, claim, 1, first_text)))
+
+            pending = set(attempts)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in sorted(done, key=lambda task: task.exception() is not None):
+                    index = attempts.index(task)
+                    owner = claim.get("owner")
+                    if owner not in (None, index):
+                        continue  # Lost the race to the other attempt
+                    if task.exception() is None:
+                        if index:
+                            tracing.increment("llm_hedge_wins")
+                        return
+                    if owner == index or not pending:
+                        raise task.exception()
+        finally:
+            for task in attempts:
+                task.cancel()
+
+    async def _attempt(
+        self, model: str, request: dict, shared: _SharedResponse, claim: dict, index: int, first_text: asyncio.Event
+    ) -> None:
+        session = await self._get_session()
+        api_key = self.api_key or os.environ.get("GOOGLE_API_KEY", "")
+        url = f"{self.base_url}/v1beta/models/{model}:streamGenerateContent"
+        try:
+            async with session.post(url, params={"alt": "sse"}, json=request, headers={"x-goog-api-key": api_key}) as response:
+                if response.status != 200:
+                    if response.status == 429:
+                        self.bucket.drain()
+                    tracing.increment("llm_errors", status=response.status)
+                    raise LLMGatewayError(
+                        f"Gemini returned {response.status}: {(await response.text())[:200]}",
+                        retryable=response.status in RETRY_STATUSES,
+                        retry_after=_retry_after(response),
+                    )
+                async for line in response.content:  # Server-sent events, one JSON object per "data:" line
+                    if not line.startswith(b"data:"):
+                        continue
+                    data = json.loads(line[5:])
+                    if "error" in data:
+                        raise LLMGatewayError(f"Gemini error: {data['error'].get('message', data['error'])}")
+                    text = _response_text(data)
+                    if not text:
+                        continue
+                    if claim.setdefault("owner", index) != index:
+                        return
+                    first_text.set()
+                    shared.publish(text)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            tracing.increment("llm_errors", status=type(e).__name__)
+            raise LLMGatewayError(f"Gemini request failed: {type(e).__name__}: {e}", retryable=True) from e
+
+    def stats(self) -> dict:
+        """Returns the requests in flight, the tokens left in the bucket and the callers waiting for one."""
+        return {
+            "inflight": len(self._inflight),
+            "tokens_available": self.bucket.available(),
+            "throttled_waiting": self.bucket.waiting,
+        }
+
+    def close(self) -> None:
+        """Closes the HTTP session and stops the event loop thread."""
+        with self._lock:
+            loop, self._loop = self._loop, None
+        if loop is None or self._pid != os.getpid():
+            return
+        if self._session is not None:
+            asyncio.run_coroutine_threadsafe(self._session.close(), loop).result()
+            self._session = None
+        loop.call_soon_threadsafe(loop.stop)
+
+
+gateway = LLMGateway()
+
+
+def _gateway_metrics():
+    stats = gateway.stats()
+    yield "llm_inflight", {}, stats["inflight"]
+    yield "llm_rate_limit_tokens", {}, stats["tokens_available"]
+    yield "llm_rate_limit_waiting", {}, stats["throttled_waiting"]
+
+
+tracing.register_collector(_gateway_metrics)
+
+
+class GatewayChatModel(BaseChatModel):
+    """Gemini chat model that sends every request through the shared LLMGateway."""
+
+    model: str = GEMINI_MODEL
+    temperature: float = 0.1
+    max_output_tokens: int | None = None
+
+    @property
+    def _llm_type(self) -> str:
+        return "gemini-gateway"
+
+    @property
+    def _identifying_params(self) -> dict:
+        return {"model": self.model, "temperature": self.temperature, "max_output_tokens": self.max_output_tokens}
+
+    def _stream(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: CallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        request = to_gemini_request(
+            messages, temperature=self.temperature, maxOutputTokens=self.max_output_tokens, stopSequences=stop
+        )
+        info = {}
+        with tracing.span("llm_call", model=self.model) as call_span:
+            for text in gateway.stream(self.model, request, info):
+                if run_manager:
+                    run_manager.on_llm_new_token(text)
+                yield ChatGenerationChunk(message=AIMessageChunk(content=text))
+            call_span.set(**info)
+
+    def _generate(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: CallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        text = "".join(chunk.message.content for chunk in self._stream(messages, stop, run_manager, **kwargs))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
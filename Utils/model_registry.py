@@ -0,0 +1,185 @@
+import gc
+import os
+import threading
+import time
+from typing import Any, Callable
+
+from Utils import tracing
+
+
+def resident_memory() -> int:
+    """Returns the resident set size of the current process in bytes, or 0 if unknown."""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return 0
+
+
+def _tensors(value: Any):
+    if isinstance(value, (tuple, list)):
+        for item in value:
+            yield from _tensors(item)
+    elif hasattr(value, "numel") and hasattr(value, "element_size"):
+        yield value
+
+
+def model_memory(model: Any) -> int:
+    """
+    Returns the bytes held by the weights of a model, or of the models in a tuple.
+
+    Weights are counted from the state dict, which unlike parameters() also holds the
+    packed weights of int8-quantized layers. Tensors shared by tied weights count once.
+    """
+    if isinstance(model, (tuple, list)):
+        return sum(model_memory(part) for part in model)
+    if not hasattr(model, "state_dict"):
+        return 0
+    seen, total = set(), 0
+    for value in model.state_dict(keep_vars=True).values():
+        for tensor in _tensors(value):
+            if tensor.data_ptr() not in seen:
+                seen.add(tensor.data_ptr())
+                total += tensor.numel() * tensor.element_size()
+    return total
+
+
+class ModelRegistry:
+    """
+    Process-wide registry of lazily loaded models.
+
+    Each model is loaded on first use and then shared by every Streamlit session
+    and thread in the process. Models can be preloaded, unloaded after a period of
+    inactivity, and report how long they took to load and how much memory they use.
+
+    Unloading only frees a model that nothing else refers to, so callers should call
+    get() on each use, or hold a proxy that does, rather than keep the model itself.
+    """
+
+    def __init__(self):
+        self._loaders: dict[str, Callable[[], Any]] = {}
+        self._models: dict[str, Any] = {}
+        self._stats: dict[str, dict] = {}
+        self._locks: dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+        self._unloader: threading.Thread | None = None
+
+    def register(self, name: str, loader: Callable[[], Any]) -> None:
+        """Registers the function that loads a model; nothing is loaded yet."""
+        with self._lock:
+            self._loaders[name] = loader
+            self._locks.setdefault(name, threading.Lock())
+            self._stats.setdefault(name, {"loaded": False, "loads": 0, "load_seconds": 0.0, "memory_bytes": 0, "last_used": None})
+
+    def get(self, name: str) -> Any:
+        """Returns a model, loading it first if needed. Concurrent first calls load it only once."""
+        if name not in self._loaders:
+            raise KeyError(f"Unknown model: {name}")
+        with self._locks[name]:
+            if name not in self._models:
+                rss_before = resident_memory()
+                start = time.perf_counter()
+                with tracing.span("model_load", model=name) as load_span:
+                    model = self._loaders[name]()
+                    load_seconds = time.perf_counter() - start
+                    memory_bytes = model_memory(model) or max(resident_memory() - rss_before, 0)
+                    load_span.set(memory_bytes=memory_bytes)
+                with self._lock:
+                    self._models[name] = model
+                    self._stats[name].update(loaded=True, load_seconds=load_seconds, memory_bytes=memory_bytes)
+                    self._stats[name]["loads"] += 1
+                print(f"Loaded model {name} in {load_seconds:.1f}s ({memory_bytes / 2**20:.0f} MiB)")
+            self._stats[name]["last_used"] = time.time()
+            return self._models[name]
+
+    def warm_up(self, names: list[str] | None = None, background: bool = False) -> None:
+        """Preloads the given models, or all registered models, optionally in a background thread."""
+        names = list(self._loaders) if names is None else names
+        if background:
+            threading.Thread(target=self.warm_up, args=(names,), name="model-warm-up", daemon=True).start()
+            return
+        for name in names:
+            self.get(name)
+
+    def unload(self, name: str) -> None:
+        """Drops the registry's reference to a model so its memory can be reclaimed."""
+        with self._locks[name]:
+            with self._lock:
+                model = self._models.pop(name, None)
+                if model is not None:
+                    self._stats[name].update(loaded=False, memory_bytes=0)
+            if model is not None:
+                del model
+                print(f"Unloaded model {name}")
+        gc.collect()
+
+    def unload_idle(self, max_idle_seconds: float) -> list[str]:
+        """Unloads every model not used in the last max_idle_seconds and returns their names."""
+        now = time.time()
+        with self._lock:
+            idle = [
+                name for name in self._models
+                if now - (self._stats[name]["last_used"] or now) > max_idle_seconds
+            ]
+        for name in idle:
+            self.unload(name)
+        return idle
+
+    def start_idle_unloader(self, max_idle_seconds: float, interval_seconds: float = 60.0) -> None:
+        """Starts a daemon thread that periodically unloads idle models. Later calls are no-ops."""
+        with self._lock:
+            if self._unloader is not None:
+                return
+
+            def run():
+                while True:
+                    time.sleep(interval_seconds)
+                    self.unload_idle(max_idle_seconds)
+
+            self._unloader = threading.Thread(target=run, name="model-idle-unloader", daemon=True)
+            self._unloader.start()
+
+    def stats(self) -> dict[str, dict]:
+        """Returns load state, load time, memory and last use of every registered model."""
+        with self._lock:
+            return {name: dict(stats) for name, stats in self._stats.items()}
+
+
+registry = ModelRegistry()
+
+
+def _registry_metrics():
+    for name, stats in registry.stats().items():
+        yield "model_loaded", {"model": name}, int(stats["loaded"])
+        yield "model_load_seconds", {"model": name}, stats["load_seconds"]
+        yield "model_memory_bytes", {"model": name}, stats["memory_bytes"]
+    yield "process_resident_bytes", {}, resident_memory()
+
+
+tracing.register_collector(_registry_metrics)
+
+_configured = False
+_configured_lock = threading.Lock()
+
+
+def configure_from_env() -> None:
+    """
+    Applies the preload and idle-unload settings from the environment once per process.
+
+    NISMOGEN_PRELOAD_MODELS is a comma-separated list of model names to load in the
+    background (or "all"); NISMOGEN_MODEL_IDLE_SECONDS unloads models unused for that long.
+    """
+    global _configured
+    with _configured_lock:
+        if _configured:
+            return
+        _configured = True
+
+    preload = os.environ.get("NISMOGEN_PRELOAD_MODELS", "").strip()
+    if preload:
+        names = None if preload == "all" else [name.strip() for name in preload.split(",") if name.strip()]
+        registry.warm_up(names, background=True)
+
+    idle_seconds = os.environ.get("NISMOGEN_MODEL_IDLE_SECONDS")
+    if idle_seconds:
+        registry.start_idle_unloader(float(idle_seconds))
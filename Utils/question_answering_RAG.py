@@ -1,19 +1,40 @@
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_community.vectorstores import FAISS
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_huggingface import HuggingFaceEmbeddings
 from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain.chains.history_aware_retriever import create_history_aware_retriever
 from langchain.chains.retrieval import create_retrieval_chain
 from langchain.chains.combine_documents import create_stuff_documents_chain
-from langchain_core.runnables import Runnable
+from langchain_core.runnables import Runnable, RunnableConfig, RunnableLambda
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
 from langchain_core.messages import HumanMessage, SystemMessage, AIMessage
-
-from Utils.utils import read_file
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.vectorstores import VectorStoreRetriever
+
+from Utils.ingestion import batched, iter_chunks
+from Utils.embedding_cache import CachedEmbeddings
+from Utils.bm25 import BM25Index, tokenize
+from Utils.context_budget import compress_context, estimate_tokens, window_history
+from Utils.model_registry import registry
+from Utils.batching import BatchedEmbeddings
+from Utils.llm_gateway import GEMINI_MODEL, GatewayChatModel
+from Utils import tracing
 from dotenv import dotenv_values, find_dotenv
 import os
+import numpy as np
 from streamlit.runtime.uploaded_file_manager import UploadedFile
 from typing import Generator
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import contextvars
+import hashlib
+import json
+import re
+import threading
 import time
 
 
@@ -24,16 +45,46 @@ os.environ["HuggingFace_API"] = dotenv_values(find_dotenv())[
 os.environ["GOOGLE_API_KEY"] = dotenv_values(find_dotenv())["gemini_api_key"]
 
 
-def init_llm_model() -> ChatGoogleGenerativeAI:
-    """Initializes the ChatGoogleGenerativeAI model."""
-    return ChatGoogleGenerativeAI(
-        model="gemini-1.5-flash", temperature=0.1, max_tokens=None, timeout=None, max_retries=2
-    )
+def init_llm_model() -> BaseChatModel:
+    """Returns the shared Gemini chat model, which sends its requests through the LLM gateway."""
+    return registry.get("llm")
+
+
+EMBEDDING_MODEL_NAME = "BAAI/bge-small-en-v1.5"
+
+
+class RegisteredEmbeddings(Embeddings):
+    """
+    Embeds with the model registered under a name, fetched from the registry on every call.
+
+    Vector stores and QA chains hold this instead of the model, so the registry can
+    free the model when it unloads it; the next call loads it again.
+    """
+
+    def __init__(self, name: str = "embeddings"):
+        self.name = name
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return registry.get(self.name).embed_documents(texts)
 
+    def embed_query(self, text: str) -> list[float]:
+        return registry.get(self.name).embed_query(text)
 
-def init_embeddings_model() -> HuggingFaceEmbeddings:
-    """Initializes the Hugging Face embeddings model."""
-    return HuggingFaceEmbeddings(model_name="BAAI/bge-small-en-v1.5")
+
+def init_embeddings_model() -> Embeddings:
+    """Returns the Hugging Face embeddings model behind the on-disk embedding cache, loaded on first use."""
+    return RegisteredEmbeddings("embeddings")
+
+
+def load_embeddings_model() -> CachedEmbeddings:
+    """Loads the Hugging Face embeddings model; imported here so that importing this module stays cheap."""
+    from langchain_huggingface import HuggingFaceEmbeddings
+    embeddings = BatchedEmbeddings(HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL_NAME))
+    return CachedEmbeddings(embeddings, EMBEDDING_MODEL_NAME)
+
+
+registry.register("llm", lambda: GatewayChatModel(model=GEMINI_MODEL, temperature=0.1))
+registry.register("embeddings", load_embeddings_model)
 
 
 
@@ -43,32 +94,360 @@ def split_text(text: str, chunk_size: int = 1000, chunk_overlap: int = 100) -> l
     return text_splitter.split_text(text)
 
 
+def file_digest(uploaded_file: UploadedFile) -> str:
+    """Returns the SHA-256 digest of the uploaded file's content."""
+    return hashlib.sha256(uploaded_file.getvalue()).hexdigest()
+
+
+class IncrementalVectorStore:
+    """
+    Keeps a FAISS vector store in sync with a changing set of uploaded files.
+
+    Every file is keyed by the hash of its content, so only files that have not
+    been seen before are read, split and embedded. Files that disappear from the
+    upload list have their vectors evicted, and an unchanged upload list costs
+    nothing but hashing.
+    """
+
+    def __init__(self, embedding_model: Embeddings):
+        self.embedding_model = embedding_model
+        self.vector_store: FAISS | None = None
+        self.lexical_index: BM25Index | None = None
+        self.chunk_ids: dict[str, list[str]] = {}  # File digest -> ids of its chunks in the docstore
+        self.fingerprint = corpus_fingerprint(None)  # Identifies the documents indexed; updated by sync()
+
+    def _add_file(self, digest: str, uploaded_file: UploadedFile) -> None:
+        # Chunks stream out of the file and are embedded a fixed-size batch at a time
+        # Parsing and splitting are timed apart from the embedding and indexing that consume them
+        ids = []
+        with tracing.span("ingest", file=uploaded_file.name, size_bytes=len(uploaded_file.getvalue())) as ingest_span:
+            for texts in batched(tracing.traced_iter("parse_split", iter_chunks(uploaded_file))):
+                batch_ids = [f"{digest}:{i}" for i in range(len(ids), len(ids) + len(texts))]
+                metadatas = [{"source": uploaded_file.name, "chunk_id": chunk_id} for chunk_id in batch_ids]
+                with tracing.span("index_add", chunks=len(texts)):
+                    if self.vector_store is None:
+                        self.vector_store = FAISS.from_texts(texts, self.embedding_model, metadatas=metadatas, ids=batch_ids)
+                    else:
+                        self.vector_store.add_texts(texts, metadatas=metadatas, ids=batch_ids)
+                with tracing.span("lexical_index_add", chunks=len(texts)):
+                    if self.lexical_index is None:
+                        self.lexical_index = BM25Index(batch_ids, texts)
+                    else:
+                        self.lexical_index.add(batch_ids, texts)
+                ids.extend(batch_ids)
+            ingest_span.set(chunks=len(ids))
+        self.chunk_ids[digest] = ids
+
+    def _remove_file(self, digest: str) -> None:
+        ids = self.chunk_ids.pop(digest)
+        if ids and self.vector_store is not None:
+            self.vector_store.delete(ids)
+            self.lexical_index.remove(ids)
+        if not any(self.chunk_ids.values()):
+            self.vector_store = None
+            self.lexical_index = None
+
+    def sync(self, uploaded_files: list[UploadedFile]) -> bool:
+        """
+        Brings the index in line with the given files.
+
+        Returns:
+            bool: True if any file was added or evicted, False if nothing changed.
+        """
+        current = {file_digest(uploaded_file): uploaded_file for uploaded_file in uploaded_files}
+        removed = [digest for digest in self.chunk_ids if digest not in current]
+        added = [digest for digest in current if digest not in self.chunk_ids]
+
+        if not (removed or added):
+            return False
+
+        for digest in removed:
+            self._remove_file(digest)
+        for digest in added:
+            self._add_file(digest, current[digest])
+
+        # Cached answers about the old document set are keyed by the old fingerprint and no longer match
+        self.fingerprint = corpus_fingerprint(self.vector_store)
+        return True
+
+
+def corpus_fingerprint(vector_store: FAISS | None) -> str:
+    """
+    Identifies the exact set of chunks in a vector store.
+
+    Chunk ids are derived from the content hash of their file, so the same documents
+    give the same fingerprint whether they were uploaded or loaded as a saved corpus.
+    """
+    if vector_store is None:
+        return hashlib.sha256(b"").hexdigest()
+    ids = sorted(vector_store.index_to_docstore_id.values())
+    return hashlib.sha256("\n".join(ids).encode("utf-8")).hexdigest()
+
+
+ANSWER_CACHE_THRESHOLD = float(os.environ.get("NISMOGEN_ANSWER_CACHE_THRESHOLD", 0.95))
+ANSWER_CACHE_TTL_S = float(os.environ.get("NISMOGEN_ANSWER_CACHE_TTL_S", 3600))
+ANSWER_CACHE_ENTRIES = int(os.environ.get("NISMOGEN_ANSWER_CACHE_ENTRIES", 1000))
+
+
+def identifiers(text: str) -> frozenset[str]:
+    """Returns the terms of a text that contain digits, such as part numbers and error codes."""
+    return frozenset(term for term in tokenize(text) if any(char.isdigit() for char in term))
+
+
+class AnswerCache:
+    """
+    Caches answers so repeated questions skip retrieval and both LLM calls.
+
+    QA answers are looked up semantically: a question hits when its embedding has a
+    cosine similarity of at least threshold with a cached question asked about a
+    corpus with the same fingerprint, and both mention exactly the same identifiers,
+    as embeddings barely tell "error AB-1234" from "error AB-1235". Chat responses use an exact-match tier keyed
+    by the whole conversation. Entries expire after ttl_seconds and the least
+    recently used are evicted beyond max_entries.
+    """
+
+    def __init__(
+        self,
+        threshold: float = ANSWER_CACHE_THRESHOLD,
+        ttl_seconds: float = ANSWER_CACHE_TTL_S,
+        max_entries: int = ANSWER_CACHE_ENTRIES,
+    ):
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        # Id -> (fingerprint, identifiers, normalized question vector, answer, created at)
+        self.semantic: OrderedDict[int, tuple[str, frozenset, np.ndarray, str, float]] = OrderedDict()
+        self.exact: OrderedDict[str, tuple[str, float]] = OrderedDict()
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def _expire(self) -> None:
+        oldest = time.time() - self.ttl_seconds
+        for entries, created_at in ((self.semantic, lambda e: e[4]), (self.exact, lambda e: e[1])):
+            for key in [key for key, entry in entries.items() if created_at(entry) < oldest]:
+                del entries[key]
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+
+    def lookup(self, fingerprint: str, question: str, question_vector: list[float]) -> str | None:
+        """Returns the answer to the most similar cached question about the same corpus, if similar enough."""
+        vector = np.asarray(question_vector, dtype=np.float32)
+        vector /= np.linalg.norm(vector) or 1.0
+        terms = identifiers(question)
+        with self._lock:
+            self._expire()
+            best_key, best_score = None, self.threshold
+            for key, (entry_fingerprint, entry_terms, entry_vector, _, _) in self.semantic.items():
+                if entry_fingerprint != fingerprint or entry_terms != terms:
+                    continue
+                if (score := float(entry_vector @ vector)) >= best_score:
+                    best_key, best_score = key, score
+            if best_key is None:
+                tracing.increment("cache_misses", cache="answer_semantic")
+                return None
+            self.semantic.move_to_end(best_key)
+            tracing.increment("cache_hits", cache="answer_semantic")
+            return self.semantic[best_key][3]
+
+    def store(self, fingerprint: str, question: str, question_vector: list[float], answer: str) -> None:
+        """Caches the answer to a question about a corpus."""
+        vector = np.asarray(question_vector, dtype=np.float32)
+        vector /= np.linalg.norm(vector) or 1.0
+        with self._lock:
+            self.semantic[self._next_id] = (fingerprint, identifiers(question), vector, answer, time.time())
+            self._next_id += 1
+            self._expire()
+
+    def lookup_exact(self, key: str) -> str | None:
+        """Returns the cached response for exactly the same conversation, if any."""
+        with self._lock:
+            self._expire()
+            if key not in self.exact:
+                tracing.increment("cache_misses", cache="answer_exact")
+                return None
+            self.exact.move_to_end(key)
+            tracing.increment("cache_hits", cache="answer_exact")
+            return self.exact[key][0]
+
+    def store_exact(self, key: str, response: str) -> None:
+        """Caches the response to a conversation."""
+        with self._lock:
+            self.exact[key] = (response, time.time())
+            self._expire()
+
+    def invalidate(self, fingerprint: str) -> None:
+        """Drops every answer about the corpus with the given fingerprint."""
+        with self._lock:
+            for key in [key for key, entry in self.semantic.items() if entry[0] == fingerprint]:
+                del self.semantic[key]
+
+
+answer_cache = AnswerCache()
+
+
+def _answer_cache_metrics():
+    yield "answer_cache_entries", {"tier": "semantic"}, len(answer_cache.semantic)
+    yield "answer_cache_entries", {"tier": "exact"}, len(answer_cache.exact)
+
+
+tracing.register_collector(_answer_cache_metrics)
+
+
 def create_vector_store(
-    uploaded_files: list[UploadedFile], embedding_model: HuggingFaceEmbeddings
+    uploaded_files: list[UploadedFile], embedding_model: Embeddings
 ) -> FAISS:
     """Creates a FAISS vector store from uploaded files."""
-    all_split_texts = []
+    store = IncrementalVectorStore(embedding_model)
+    store.sync(uploaded_files)
+    return store.vector_store
+
+
+_search_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="hybrid-search")
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    Runs dense (FAISS) and lexical (BM25) search concurrently and fuses the rankings.
+
+    Results are combined with weighted reciprocal-rank fusion, so exact matches on
+    part numbers or error codes surface even when the embeddings miss them.
+    """
+
+    vector_store: FAISS
+    lexical_index: BM25Index
+    k: int = 6
+    fetch_k: int = 20  # Candidates taken from each source before fusion
+    dense_weight: float = 1.0
+    lexical_weight: float = 1.0
+    rrf_k: int = 60
+
+    def _dense_search(self, query: str, query_vector: list[float] | None = None) -> list[str]:
+        if query_vector is None:
+            with tracing.span("embed_query"):
+                query_vector = self.vector_store.embedding_function.embed_query(query)
+        embedding = np.asarray([query_vector], dtype=np.float32)
+        with tracing.span("faiss_search", k=self.fetch_k):
+            _, positions = self.vector_store.index.search(embedding, self.fetch_k)
+        return [self.vector_store.index_to_docstore_id[i] for i in positions[0] if i != -1]
+
+    def _lexical_search(self, query: str) -> list[str]:
+        with tracing.span("bm25_search", k=self.fetch_k):
+            return [doc_id for doc_id, _ in self.lexical_index.search(query, self.fetch_k)]
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        return self.search(query)
+
+    def search(self, query: str, query_vector: list[float] | None = None) -> list[Document]:
+        """Returns the fused top-k documents; query_vector, if given, saves embedding the query again."""
+        # Each search runs in a copy of the caller's context so its spans nest under the caller's
+        dense = _search_executor.submit(contextvars.copy_context().run, self._dense_search, query, query_vector)
+        lexical = _search_executor.submit(contextvars.copy_context().run, self._lexical_search, query)
+
+        scores: dict[str, float] = {}
+        for ranking, weight in ((dense.result(), self.dense_weight), (lexical.result(), self.lexical_weight)):
+            for rank, doc_id in enumerate(ranking):
+                scores[doc_id] = scores.get(doc_id, 0.0) + weight / (self.rrf_k + rank + 1)
+
+        best = sorted(scores, key=scores.get, reverse=True)[: self.k]
+        documents = [self.vector_store.docstore.search(doc_id) for doc_id in best]
+        return [document for document in documents if isinstance(document, Document)]  # Skip unknown ids
+
+# Words that usually refer back to earlier turns, so the question cannot be searched on its own
+CONTEXT_DEPENDENT_WORDS = {
+    "it", "its", "it's", "this", "that", "these", "those", "they", "them", "their", "theirs",
+    "he", "him", "his", "she", "her", "hers", "there", "then", "former", "latter", "above",
+    "previous", "earlier", "same", "else", "again", "more", "another", "other", "one", "ones",
+}
+
+def needs_rephrase(question: str, chat_history: list) -> bool:
+    """
+    Cheap local check for whether a question depends on the chat history.
+
+    Only such questions are worth an extra LLM round trip to rewrite them into a
+    standalone question before retrieval.
+    """
+    if not chat_history:
+        return False
+    words = re.findall(r"[a-z']+", question.lower())
+    if len(words) <= 3:  # Follow-ups like "why?" or "and the second?" rarely stand alone
+        return True
+    return any(word in CONTEXT_DEPENDENT_WORDS for word in words)
 
-    for uploaded_file in uploaded_files:
-        texts = read_file(uploaded_file)
-        split_texts = split_text(texts)
-        all_split_texts.extend(split_texts)
-        print(f"Processed {len(split_texts)} chunks from {uploaded_file.name}")
 
-    return FAISS.from_texts(all_split_texts, embedding_model)
+def retrieve_by_vector(retriever: Runnable, query: str, query_vector: list[float]) -> list[Document]:
+    """Retrieves with the query's embedding when it is already known, e.g. from the answer cache lookup."""
+    if isinstance(retriever, HybridRetriever):
+        return retriever.search(query, query_vector)
+    if isinstance(retriever, VectorStoreRetriever) and retriever.search_type == "similarity":
+        return retriever.vectorstore.similarity_search_by_vector(query_vector, **retriever.search_kwargs)
+    return retriever.invoke(query)
+
+
+def create_fast_path_retriever(
+    llm: BaseChatModel, retriever: Runnable, qa_prompt: ChatPromptTemplate
+) -> Runnable:
+    """
+    Retrieves on the raw question unless it needs the chat history to be understood.
+
+    Questions that do are rephrased by the LLM first, as in create_history_aware_retriever.
+    Questions that do not are searched with inputs["query_vector"] when qa() has already
+    embedded them.
+    """
+    rephrase_chain = qa_prompt | llm | StrOutputParser()
+
+    def route(inputs: dict, config: RunnableConfig) -> list[Document]:
+        path = "rephrase" if needs_rephrase(inputs["input"], inputs.get("chat_history", [])) else "direct"
+        tracing.increment("retrieval_path", path=path)  # How often each path is taken: "direct" or "rephrase"
+        query = inputs["input"]
+        if path == "rephrase":
+            with tracing.span("rephrase"):
+                query = rephrase_chain.invoke(inputs, config)
+        with tracing.span("retrieve", path=path) as retrieve_span:
+            if path == "direct" and inputs.get("query_vector") is not None:
+                documents = retrieve_by_vector(retriever, query, inputs["query_vector"])
+            else:
+                documents = retriever.invoke(query, config)
+            retrieve_span.set(documents=len(documents))
+        return documents
+
+    return RunnableLambda(route).with_config(run_name="fast_path_retriever")
+
 
 def create_qa_model(
     vector_store: FAISS,
-    llm: ChatGoogleGenerativeAI,
+    llm: BaseChatModel,
     prompt: ChatPromptTemplate,
-    qa_prompt: ChatPromptTemplate
+    qa_prompt: ChatPromptTemplate,
+    fast_path: bool = True,
+    lexical_index: BM25Index | None = None,
+    k: int = 6,
+    dense_weight: float = 1.0,
+    lexical_weight: float = 1.0,
+    context_budget: int = 1500
 ) -> Runnable:
-    """Initializes the QA model with memory."""
-    history_aware_retriever = create_history_aware_retriever(
-        llm, vector_store.as_retriever(kwargs={"k": 6}), qa_prompt
-    )
+    """
+    Initializes the QA model with memory.
+
+    Retrieval is hybrid dense + BM25 when a lexical index over the same chunks is
+    given, and dense only otherwise. Retrieved chunks are deduplicated and trimmed
+    to context_budget tokens before they are stuffed into the prompt.
+    """
+    if lexical_index is not None:
+        retriever = HybridRetriever(
+            vector_store=vector_store, lexical_index=lexical_index, k=k,
+            dense_weight=dense_weight, lexical_weight=lexical_weight
+        )
+    else:
+        retriever = vector_store.as_retriever(search_kwargs={"k": k})
+    if fast_path:
+        history_aware_retriever = create_fast_path_retriever(llm, retriever, qa_prompt)
+    else:
+        history_aware_retriever = create_history_aware_retriever(llm, retriever, qa_prompt)
+    budgeted_retriever = history_aware_retriever | RunnableLambda(partial(compress_context, max_tokens=context_budget))
     question_answer_chain = create_stuff_documents_chain(llm, prompt)
-    return create_retrieval_chain(history_aware_retriever, question_answer_chain)
+    return create_retrieval_chain(budgeted_retriever, question_answer_chain)
 
 
 
@@ -109,68 +488,107 @@ def init_prompt() -> tuple[ChatPromptTemplate, ChatPromptTemplate]:
 
     return prompt, qa_prompt
 
-def gemini_generate_response(prompt_text: str, gemini_model: ChatGoogleGenerativeAI, chat_history: list) -> str:
-    """Generates response using the Gemini model."""
-    # Ensure the prompt is wrapped in a HumanMessage
-    messages = [SystemMessage(content="You are a helpful assistant.")]  # Add a system message for context
-    
-    # Convert chat history to message objects
-    for message in chat_history:
-        if message["role"] == "user":
-            messages.append(HumanMessage(content=message["content"]))
-        elif message["role"] == "assistant":
-            messages.append(AIMessage(content=message["content"]))
-
-    messages.append(HumanMessage(content=prompt_text))  # Add the current user input
+def to_chat_history(messages: list, current_input: str) -> list:
+    """
+    Converts Streamlit chat messages to LangChain messages.
 
-    response = gemini_model(messages)
-    return response.content.strip()
+    The app appends the user's question to the messages before answering it, so
+    a trailing copy of the current input is dropped rather than sent twice.
+    """
+    if messages and messages[-1]["role"] == "user" and messages[-1]["content"] == current_input:
+        messages = messages[:-1]
 
-def qa(text: str, qa_model: Runnable, messages: list) -> Generator[str, str, str]:
-    """Generates answers to questions based on the given text."""
     chat_history = []
-
     for message in messages:
         if message["role"] == "user":
             chat_history.append(HumanMessage(content=message["content"]))
         elif message["role"] == "assistant":
             chat_history.append(AIMessage(content=message["content"]))
+    return chat_history
 
-    try:
-        response = qa_model.invoke({"chat_history": chat_history, "input": text}) # Invoke the QA model with the chat history and the user input
-        answer = response["answer"].strip()
-        print(f"Retrieved answer: {answer}")
-    except Exception as e:
-        print(f"Error during QA model invocation: {e}")
-        return None
-
-    for word in answer.split(" "):
-        yield word + " "
-        time.sleep(0.1)
-
-
-def init_gemini_model() -> ChatGoogleGenerativeAI:
-    """Initializes the Gemini model."""
-    return ChatGoogleGenerativeAI(
-        model="gemini-1.5-flash", temperature=0.1, max_tokens=None, timeout=None, max_retries=2
-    )
-
-
-
-
-def gemini_generate_response(prompt_text: str, gemini_model: ChatGoogleGenerativeAI, chat_history: list) -> str:
-    """Generates response using the Gemini model."""
+def gemini_generate_response(
+    prompt_text: str, gemini_model: BaseChatModel, chat_history: list, history_budget: int = 2000
+) -> Generator[str, None, None]:
+    """Streams the response of the Gemini model as it is generated."""
     # Ensure the prompt is wrapped in a HumanMessage
     messages = [SystemMessage(content="You are a helpful assistant.")]  # Add a system message for context
     
-    # Convert chat history to message objects
-    for message in chat_history:
-        if message["role"] == "user":
-            messages.append(HumanMessage(content=message["content"]))
-        elif message["role"] == "assistant":
-            messages.append(AIMessage(content=message["content"]))
-
+    # Convert chat history to message objects, keeping it within the token budget
+    messages.extend(window_history(to_chat_history(chat_history, prompt_text), history_budget))
     messages.append(HumanMessage(content=prompt_text))  # Add the current user input
 
-    response = gemini_model(messages)
-    return response.content.strip()
\ No newline at end of file
+    cache_key = hashlib.sha256(
+        json.dumps([(message.type, message.content) for message in messages]).encode("utf-8")
+    ).hexdigest()
+    with tracing.span("chat", prompt_tokens=sum(estimate_tokens(m.content) for m in messages)) as chat_span:
+        if (cached := answer_cache.lookup_exact(cache_key)) is not None:
+            chat_span.set(cache_hit=True)
+            yield cached
+            return
+
+        response = ""
+        started = time.perf_counter()
+        for chunk in gemini_model.stream(messages):
+            if chunk.content:
+                if not response:
+                    chat_span.set(first_token_ms=(time.perf_counter() - started) * 1000)
+                response += chunk.content
+                yield chunk.content
+        chat_span.set(cache_hit=False, response_tokens=estimate_tokens(response))
+        answer_cache.store_exact(cache_key, response)
+
+def qa(
+    text: str,
+    qa_model: Runnable,
+    messages: list,
+    history_budget: int = 1000,
+    vector_store: FAISS | None = None,
+    fingerprint: str | None = None,
+) -> Generator[str, None, None]:
+    """
+    Streams the answer to a question about the uploaded documents as it is generated.
+
+    When the vector store the QA model searches is given, standalone questions are
+    first looked up in the semantic answer cache for that corpus. Callers asking
+    many questions should pass the corpus fingerprint, computed once per change of
+    the store, rather than have it recomputed from every chunk id on each call.
+    """
+    with tracing.span("qa", question_tokens=estimate_tokens(text)) as qa_span:
+        chat_history = window_history(to_chat_history(messages, text), history_budget)
+
+        question_vector = None
+        if vector_store is not None and not needs_rephrase(text, chat_history):
+            fingerprint = fingerprint or corpus_fingerprint(vector_store)
+            with tracing.span("embed_query"):
+                question_vector = vector_store.embedding_function.embed_query(text)
+            if (cached := answer_cache.lookup(fingerprint, text, question_vector)) is not None:
+                qa_span.set(cache_hit=True)
+                yield cached
+                return
+
+        answer = ""
+        started = time.perf_counter()
+        try:
+            # The retrieval chain streams dict chunks; only the "answer" key carries generated tokens
+            inputs = {"chat_history": chat_history, "input": text}
+            if question_vector is not None:
+                inputs["query_vector"] = question_vector  # Retrieval reuses it instead of embedding again
+            for chunk in qa_model.stream(inputs):
+                token = chunk.get("answer")
+                if token:
+                    if not answer:
+                        qa_span.set(first_token_ms=(time.perf_counter() - started) * 1000)
+                    answer += token
+                    yield token
+        except Exception as e:
+            qa_span.set(error=str(e))
+            print(f"Error during QA model invocation: {e}")
+            raise
+        qa_span.set(cache_hit=False, answer_tokens=estimate_tokens(answer))
+
+        if question_vector is not None and answer.strip():
+            answer_cache.store(fingerprint, text, question_vector, answer)
+
+def init_gemini_model() -> BaseChatModel:
+    """Returns the shared Gemini chat model; the same instance as init_llm_model."""
+    return registry.get("llm")
@@ -1,9 +1,147 @@
-from transformers import AutoTokenizer, AutoModelForSeq2SeqLM
 from Utils.utils import read_pdf
+from Utils.model_registry import registry
+from Utils.inference_backend import backend_for, load_seq2seq_model
+from Utils.batching import get_batcher
+from Utils import tracing
 from streamlit.runtime.uploaded_file_manager import UploadedFile
+from typing import Callable
 
-tokenizer = AutoTokenizer.from_pretrained("facebook/bart-large-cnn")
-model = AutoModelForSeq2SeqLM.from_pretrained("facebook/bart-large-cnn")
+SUMMARIZATION_MODEL_NAME = "facebook/bart-large-cnn"
+MAX_INPUT_TOKENS = 1024  # BART's position embedding limit, including <s> and </s>
+CHUNK_OVERLAP_TOKENS = 64
+
+def load_summarizer(backend: str | None = None):
+    """Loads the summarization tokenizer and model with a backend, by default the one selected for "summarizer"."""
+    from transformers import AutoTokenizer
+    tokenizer = AutoTokenizer.from_pretrained(SUMMARIZATION_MODEL_NAME)
+    model = load_seq2seq_model(SUMMARIZATION_MODEL_NAME, backend or backend_for("summarizer"))
+    return tokenizer, model
+
+registry.register("summarizer", load_summarizer)
+
+def chunk_token_ids(tokenizer, text: str, overlap: int = CHUNK_OVERLAP_TOKENS) -> list[list[int]]:
+    """
+    Splits text into token-aligned chunks that each fit the model's input window.
+
+    Args:
+        tokenizer: The summarization tokenizer.
+        text (str): The text to be split.
+        overlap (int): Number of tokens shared by consecutive chunks.
+
+    Returns:
+        list[list[int]]: Input ids of every chunk, with special tokens added.
+    """
+    ids = tokenizer(text, add_special_tokens=False)["input_ids"]
+    window = MAX_INPUT_TOKENS - 2  # Room for <s> and </s>
+    step = window - overlap
+    starts = range(0, max(len(ids) - overlap, 1), step)
+    return [[tokenizer.bos_token_id] + ids[start:start + window] + [tokenizer.eos_token_id] for start in starts]
+
+def generate_summaries(chunks: list[list[int]], summarizer: tuple | None = None) -> list[str]:
+    """
+    Summarizes a batch of tokenized chunks with a single padded generate call.
+
+    Args:
+        chunks (list[list[int]]): Input ids of every chunk.
+        summarizer (tuple, optional): A (tokenizer, model) pair to use instead of the registered one.
+
+    Returns:
+        list[str]: One summary per chunk.
+    """
+    import torch
+
+    tokenizer, model = summarizer or registry.get("summarizer")
+    with tracing.span("summarize_generate", chunks=len(chunks), input_tokens=sum(map(len, chunks))):
+        inputs = tokenizer.pad({"input_ids": chunks}, return_tensors="pt")
+        with torch.inference_mode():
+            summary_ids = model.generate(**inputs)
+    return tokenizer.batch_decode(summary_ids, skip_special_tokens=True)
+
+def summarize_chunks(
+    chunks: list[list[int]],
+    batch_size: int | None = None,
+    progress_callback: Callable[[int, int], None] | None = None,
+) -> list[str]:
+    """
+    Summarizes tokenized chunks in padded batches.
+
+    By default chunks go through the process-wide "summarizer" micro-batcher, so
+    chunks of concurrent requests share generate calls. With an explicit batch_size
+    the chunks are batched locally instead, grouped by length so that each batch
+    pads as little as possible.
+
+    Args:
+        chunks (list[list[int]]): Input ids of every chunk.
+        batch_size (int, optional): Number of chunks passed to a single generate call.
+        progress_callback (Callable[[int, int], None], optional): Called with the number of
+            chunks done and the total as chunks complete.
+
+    Returns:
+        list[str]: One summary per chunk, in the original order.
+    """
+    summaries = [""] * len(chunks)
+
+    if batch_size is None:
+        batcher = get_batcher("summarizer", generate_summaries, max_batch_size=4)
+        futures = [batcher.submit(chunk) for chunk in chunks]
+        for i, future in enumerate(futures):
+            summaries[i] = future.result()
+            if progress_callback:
+                progress_callback(i + 1, len(chunks))
+        return summaries
+
+    order = sorted(range(len(chunks)), key=lambda i: len(chunks[i]))
+    for start in range(0, len(order), batch_size):
+        batch = order[start:start + batch_size]
+        for i, summary in zip(batch, generate_summaries([chunks[i] for i in batch])):
+            summaries[i] = summary
+        if progress_callback:
+            progress_callback(min(start + batch_size, len(order)), len(order))
+    return summaries
+
+def summarize_long(
+    text: str,
+    batch_size: int | None = None,
+    num_threads: int | None = None,
+    progress_callback: Callable[[int, int, int], None] | None = None,
+) -> str:
+    """
+    Summarizes text of any length with map-reduce.
+
+    The text is split into chunks that fit the model, the chunks are summarized in
+    batches, and the joined partial summaries are summarized again until they fit
+    into a single chunk.
+
+    Args:
+        text (str): The text to be summarized.
+        batch_size (int, optional): Number of chunks passed to a single generate call.
+            When not given, chunks are batched together with those of concurrent requests.
+        num_threads (int, optional): Number of CPU threads PyTorch may use. This is a
+            process-wide setting; it is left unchanged when not given.
+        progress_callback (Callable[[int, int, int], None], optional): Called with the
+            reduction level, the number of chunks done and the total at that level.
+
+    Returns:
+        str: The summarized version of the input text.
+    """
+    if num_threads:
+        import torch
+        torch.set_num_threads(num_threads)
+
+    with tracing.span("summarize", chars=len(text)) as summarize_span:
+        tokenizer, _ = registry.get("summarizer")
+        level, total_chunks = 0, 0
+        while True:
+            with tracing.span("tokenize", level=level):
+                chunks = chunk_token_ids(tokenizer, text)
+            total_chunks += len(chunks)
+            level_callback = (lambda done, total: progress_callback(level, done, total)) if progress_callback else None
+            summaries = summarize_chunks(chunks, batch_size, level_callback)
+            if len(chunks) == 1:
+                summarize_span.set(levels=level + 1, chunks=total_chunks)
+                return summaries[0]
+            text = " ".join(summaries)
+            level += 1
 
 def summarize(text: str) -> str:
     """
@@ -15,22 +153,25 @@ def summarize(text: str) -> str:
     Returns:
         str: The summarized version of the input text.
     """
-    inputs = tokenizer(text, return_tensors="pt", max_length=1024, truncation=True)
-    summary_ids = model.generate(**inputs)
-    return tokenizer.decode(summary_ids[0], skip_special_tokens=True)
+    return summarize_long(text)
 
-def summarize_pdf(uploaded_file: UploadedFile) -> str:
+def summarize_pdf(
+    uploaded_file: UploadedFile,
+    progress_callback: Callable[[int, int, int], None] | None = None,
+) -> str:
     """
     Summarizes the content of a PDF file.
 
     Args:
         uploaded_file (UploadedFile): The PDF file to be summarized.
+        progress_callback (Callable[[int, int, int], None], optional): Passed on to summarize_long.
 
     Returns:
         str: The summarized version of the PDF content.
     """
-    text = read_pdf(uploaded_file)
+    with tracing.span("pdf_parse", file=getattr(uploaded_file, "name", "<upload>")) as parse_span:
+        text = read_pdf(uploaded_file)
+        parse_span.set(chars=len(text))
     if not text:
         return "No text could be extracted from the PDF."
-    print(f"Extracted text from PDF: {text[:500]}...")  # Print the first 500 characters for debugging
-    return summarize(text)
+    return summarize_long(text, progress_callback=progress_callback)
@@ -0,0 +1,249 @@
+import cProfile
+import contextvars
+import io
+import json
+import os
+import pstats
+import threading
+import time
+import uuid
+from collections import Counter, deque
+from contextlib import contextmanager
+from typing import Callable, Iterable, Iterator
+
+
+TRACE_LOG = os.environ.get("NISMOGEN_TRACE_LOG")  # JSONL file that receives every finished span
+PROFILE_SLOW_MS = float(os.environ.get("NISMOGEN_PROFILE_SLOW_MS", 0))  # 0 disables profiling
+PROFILE_DIR = os.environ.get("NISMOGEN_PROFILE_DIR", os.path.join(
+    os.environ.get("NISMOGEN_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "nismogen")), "profiles"
+))
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+RECENT_DURATIONS = 1024  # Durations kept per stage for percentiles
+
+_lock = threading.Lock()
+# The innermost open span; LangChain copies the context into its worker threads, so nesting survives them
+_current_span: contextvars.ContextVar["Span | None"] = contextvars.ContextVar("current_span", default=None)
+_profiler_lock = threading.Lock()  # cProfile can only profile one request at a time
+
+bucket_counts: dict[str, list[int]] = {}  # Stage -> observations per bucket, the last one being +Inf
+duration_sums: dict[str, float] = {}
+errors = Counter()  # Stage -> spans that raised
+attribute_totals = Counter()  # (stage, attribute) -> sum of the numeric span attribute
+counters = Counter()  # (name, sorted label items) -> value
+recent: dict[str, deque] = {}  # Stage -> recent durations in seconds
+
+collectors: list[Callable[[], Iterable[tuple[str, dict, float]]]] = []
+
+
+class Span:
+    """A timed stage of a request, with attributes such as chunk, token or cache-hit counts."""
+
+    def __init__(self, name: str, parent: "Span | None", attrs: dict):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else uuid.uuid4().hex[:16]
+        self.span_id = uuid.uuid4().hex[:8]
+        self.parent_id = parent.span_id if parent else None
+        self.attrs = attrs
+        self.start = time.time()
+        self.duration = 0.0
+
+    def set(self, **attrs) -> None:
+        """Adds or updates attributes of the span."""
+        self.attrs.update(attrs)
+
+
+def observe(name: str, seconds: float, attrs: dict | None = None, error: bool = False) -> None:
+    """Records the duration of one stage in the latency histogram."""
+    with _lock:
+        if name not in bucket_counts:
+            bucket_counts[name] = [0] * (len(LATENCY_BUCKETS) + 1)
+            duration_sums[name] = 0.0
+            recent[name] = deque(maxlen=RECENT_DURATIONS)
+        index = next((i for i, bound in enumerate(LATENCY_BUCKETS) if seconds <= bound), len(LATENCY_BUCKETS))
+        bucket_counts[name][index] += 1
+        duration_sums[name] += seconds
+        recent[name].append(seconds)
+        if error:
+            errors[name] += 1
+        for key, value in (attrs or {}).items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                attribute_totals[(name, key)] += value
+
+
+def increment(name: str, value: float = 1, **labels) -> None:
+    """Adds to a counter, e.g. increment("cache_hits", 3, cache="embedding")."""
+    with _lock:
+        counters[(name, tuple(sorted(labels.items())))] += value
+
+
+def register_collector(collector: Callable[[], Iterable[tuple[str, dict, float]]]) -> None:
+    """Registers a function returning (metric, labels, value) gauges to export with every scrape."""
+    collectors.append(collector)
+
+
+def _write_trace(span: Span, error: str | None) -> None:
+    record = {
+        "trace_id": span.trace_id, "span_id": span.span_id, "parent_id": span.parent_id, "name": span.name,
+        "start": span.start, "duration_ms": round(span.duration * 1000, 3), "attrs": span.attrs,
+    }
+    if error:
+        record["error"] = error
+    line = json.dumps(record, default=str)
+    with _lock, open(TRACE_LOG, "a", encoding="utf-8") as f:
+        f.write(line + "\n")
+
+
+def _save_profile(span: Span, profiler: cProfile.Profile) -> None:
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, f"{span.name}-{span.trace_id}.prof")
+    profiler.dump_stats(path)
+    summary = io.StringIO()
+    pstats.Stats(profiler, stream=summary).sort_stats("cumulative").print_stats(15)
+    print(f"Slow {span.name} ({span.duration * 1000:.0f} ms), profile saved to {path}\n{summary.getvalue()}")
+
+
+@contextmanager
+def span(name: str, **attrs) -> Iterator[Span]:
+    """
+    Times a stage of a request.
+
+    Spans nest within a context and share the trace id of the outermost one. Every
+    span is recorded in the latency histogram and, when NISMOGEN_TRACE_LOG is set,
+    appended to the trace log. When NISMOGEN_PROFILE_SLOW_MS is set, outermost spans
+    run under cProfile and the profile is kept if the span took longer than that.
+    """
+    parent = _current_span.get()
+    current = Span(name, parent, attrs)
+    profiler = None
+    if PROFILE_SLOW_MS and parent is None and _profiler_lock.acquire(blocking=False):
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    token = _current_span.set(current)
+    started = time.perf_counter()
+    error = None
+    try:
+        yield current
+    except BaseException as e:
+        error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        current.duration = time.perf_counter() - started
+        try:
+            _current_span.reset(token)
+        except ValueError:  # A generator holding the span was closed from another context
+            pass
+        if profiler is not None:
+            profiler.disable()
+            _profiler_lock.release()
+            if current.duration * 1000 >= PROFILE_SLOW_MS:
+                _save_profile(current, profiler)
+        observe(name, current.duration, current.attrs, error is not None)
+        if TRACE_LOG:
+            _write_trace(current, error)
+
+
+def traced_iter(name: str, iterable: Iterable, **attrs) -> Iterator:
+    """
+    Yields from an iterable and records the time spent producing its items as one span.
+
+    Time the consumer spends between items is not counted, so lazy pipelines such as
+    parsing and splitting can be timed separately from the embedding that consumes them.
+    """
+    iterator = iter(iterable)
+    elapsed, items = 0.0, 0
+    try:
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                elapsed += time.perf_counter() - started
+            items += 1
+            yield item
+    finally:
+        attrs["items"] = items
+        observe(name, elapsed, attrs)
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    """Returns the value below which the given fraction of sorted values fall."""
+    if not values:
+        return 0.0
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+def summary() -> dict[str, dict]:
+    """Returns count, p50, p95 and p99 in milliseconds of the recent spans of every stage."""
+    with _lock:
+        snapshot = {name: sorted(durations) for name, durations in recent.items()}
+        counts = {name: sum(buckets) for name, buckets in bucket_counts.items()}
+    return {
+        name: {
+            "count": counts[name],
+            "p50_ms": percentile(durations, 0.5) * 1000,
+            "p95_ms": percentile(durations, 0.95) * 1000,
+            "p99_ms": percentile(durations, 0.99) * 1000,
+        }
+        for name, durations in snapshot.items()
+    }
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"') for value in labels.values())
+    return "{" + ",".join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + "}"
+
+
+def render_prometheus() -> str:
+    """Renders every metric in the Prometheus text exposition format."""
+    lines = [
+        "# HELP nismogen_stage_seconds Duration of each stage of a request.",
+        "# TYPE nismogen_stage_seconds histogram",
+    ]
+    with _lock:
+        for name, buckets in sorted(bucket_counts.items()):
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + (float("inf"),), buckets):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"nismogen_stage_seconds_bucket{_format_labels({'stage': name, 'le': le})} {cumulative}")
+            lines.append(f"nismogen_stage_seconds_sum{_format_labels({'stage': name})} {duration_sums[name]}")
+            lines.append(f"nismogen_stage_seconds_count{_format_labels({'stage': name})} {cumulative}")
+
+        lines += [
+            "# HELP nismogen_stage_errors_total Spans of each stage that raised.",
+            "# TYPE nismogen_stage_errors_total counter",
+        ]
+        lines += [f"nismogen_stage_errors_total{_format_labels({'stage': name})} {count}" for name, count in sorted(errors.items())]
+
+        lines += [
+            "# HELP nismogen_stage_attribute_total Sum of each numeric span attribute, per stage.",
+            "# TYPE nismogen_stage_attribute_total counter",
+        ]
+        lines += [
+            f"nismogen_stage_attribute_total{_format_labels({'stage': name, 'attribute': key})} {value}"
+            for (name, key), value in sorted(attribute_totals.items())
+        ]
+
+        counter_samples: dict[str, list[str]] = {}
+        for (name, labels), value in sorted(counters.items()):
+            counter_samples.setdefault(name, []).append(f"nismogen_{name}_total{_format_labels(dict(labels))} {value}")
+
+    # Collectors yield the gauges of several batchers and models interleaved; the text format
+    # needs every sample of a metric after its one HELP and TYPE line
+    gauge_samples: dict[str, list[str]] = {}
+    for collector in collectors:
+        for name, labels, value in collector():
+            gauge_samples.setdefault(name, []).append(f"nismogen_{name}{_format_labels(labels)} {value}")
+
+    for kind, suffix, samples in (("counter", "_total", counter_samples), ("gauge", "", gauge_samples)):
+        for name, family in samples.items():
+            metric = f"nismogen_{name}{suffix}"
+            lines += [f"# HELP {metric} {name.replace('_', ' ').capitalize()}.", f"# TYPE {metric} {kind}", *family]
+    return "\n".join(lines) + "\n"
@@ -1,7 +1,25 @@
+import io
+import os
+
 import PyPDF2
 import pandas as pd
 from streamlit.runtime.uploaded_file_manager import UploadedFile
 
+
+class NamedBytesIO(io.BytesIO):
+    """In-memory file with a name, standing in for a Streamlit UploadedFile."""
+
+    def __init__(self, data: bytes, name: str):
+        super().__init__(data)
+        self.name = name
+
+
+def open_local_file(path: str) -> NamedBytesIO:
+    """Reads a file from disk so that it can be passed to the readers like an uploaded file."""
+    with open(path, "rb") as f:
+        return NamedBytesIO(f.read(), os.path.basename(path))
+
+
 def read_text(uploaded_file: UploadedFile) -> str:
     """Reads a text file and returns its text content."""
     return uploaded_file.getvalue().decode("utf-8") # Read the file as a string
@@ -9,15 +27,15 @@ def read_text(uploaded_file: UploadedFile) -> str:
 def read_pdf(uploaded_file: UploadedFile) -> str:
     """Reads a PDF file and returns its text content."""
     pdf_reader = PyPDF2.PdfReader(uploaded_file)
-    text = ""
+    pages = []
     for page_num in range(len(pdf_reader.pages)):
         page = pdf_reader.pages[page_num]
         page_text = page.extract_text()
         if page_text:
-            text += page_text
+            pages.append(page_text)
         else:
             print(f"Warning: No text extracted from page {page_num}")
-    return text
+    return "".join(pages)
 
 def read_csv(uploaded_file: UploadedFile) -> str:
     """Reads a CSV file and returns its text content."""
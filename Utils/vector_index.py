@@ -0,0 +1,382 @@
+import json
+import mmap
+import os
+import re
+import shutil
+import threading
+import time
+
+import faiss
+import numpy as np
+from langchain_community.docstore.base import Docstore
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+from Utils.bm25 import BM25Index
+from Utils.embedding_cache import DEFAULT_CACHE_DIR
+from Utils import tracing
+
+
+CORPUS_DIR = os.environ.get("NISMOGEN_CORPUS_DIR", os.path.join(DEFAULT_CACHE_DIR, "corpora"))
+
+# Map the index file instead of reading it into RAM; older FAISS builds only know IO_FLAG_MMAP
+MMAP_FLAGS = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP) | faiss.IO_FLAG_READ_ONLY
+
+# "flat":  exact search over float32 vectors
+# "hnsw":  graph search over float32 vectors; sublinear, but the graph adds memory
+# "ivfpq": inverted lists of product-quantized codes; the smallest and fastest on large corpora, needs training
+# "sq8":   exact scan over vectors quantized to 8 bits per dimension (4x smaller)
+# "fp16":  exact scan over float16 vectors (2x smaller)
+INDEX_TYPES = ("flat", "hnsw", "ivfpq", "sq8", "fp16")
+DEFAULT_INDEX_TYPE = os.environ.get("NISMOGEN_INDEX_TYPE", "flat")
+MIN_TRAINING_POINTS_PER_CENTROID = 39  # Below this, FAISS k-means gives poor centroids
+PQ_BITS = 8
+CURRENT_FILE = "CURRENT"  # Names the version directory of a corpus that readers open
+
+# Keyed by version directory, so a version saved by any process is picked up by the next load
+_open_corpora: dict[str, FAISS] = {}
+_open_lexical_indexes: dict[str, BM25Index | None] = {}
+_open_corpora_lock = threading.Lock()
+
+
+def corpus_path(name: str, corpus_dir: str = CORPUS_DIR) -> str:
+    """Returns the directory a named corpus is stored in."""
+    if not re.fullmatch(r"[A-Za-z0-9_.-]+", name):
+        raise ValueError(f"Invalid corpus name: {name!r}")
+    return os.path.join(corpus_dir, name)
+
+
+def _current_version(path: str) -> str | None:
+    try:
+        with open(os.path.join(path, CURRENT_FILE), "r", encoding="utf-8") as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def corpus_version_path(name: str, corpus_dir: str = CORPUS_DIR) -> str:
+    """
+    Returns the directory holding the current version of a named corpus.
+
+    Read every file of a corpus from this one directory, as save_corpus may swap in
+    a new version at any time. Corpora saved before versions existed keep their
+    files in the corpus directory itself.
+    """
+    path = corpus_path(name, corpus_dir)
+    version = _current_version(path)
+    return path if version is None else os.path.join(path, version)
+
+
+def list_corpora(corpus_dir: str = CORPUS_DIR) -> list[str]:
+    """Lists the names of all saved corpora."""
+    if not os.path.isdir(corpus_dir):
+        return []
+    return sorted(
+        name for name in os.listdir(corpus_dir)
+        if re.fullmatch(r"[A-Za-z0-9_.-]+", name)
+        and os.path.exists(os.path.join(corpus_version_path(name, corpus_dir), "index.faiss"))
+    )
+
+
+def _pq_subquantizers(dimensions: int) -> int:
+    """Returns the number of PQ sub-vectors: about one per 4 dimensions, dividing the dimensions evenly."""
+    return next(m for m in range(max(dimensions // 4, 1), 0, -1) if dimensions % m == 0)
+
+
+def build_faiss_index(vectors: np.ndarray, index_type: str = "flat", metric: int = faiss.METRIC_L2) -> tuple[faiss.Index, dict]:
+    """
+    Builds a FAISS index of the given type over the vectors, training it first if the type needs it.
+
+    Types that need more training data than there are vectors fall back to "flat".
+
+    Returns:
+        tuple[faiss.Index, dict]: The index and its build parameters, including the index type
+            actually built and the search parameters to apply when it is loaded.
+    """
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type {index_type!r}; expected one of {INDEX_TYPES}")
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    count, dimensions = vectors.shape
+    params = {"index_type": index_type}
+
+    if index_type == "ivfpq":
+        # About 4 * sqrt(n) lists, but never more than the data can train
+        nlist = max(min(int(4 * np.sqrt(count)), count // MIN_TRAINING_POINTS_PER_CENTROID), 1)
+        min_points = 2**PQ_BITS * MIN_TRAINING_POINTS_PER_CENTROID  # For the PQ codebooks
+        if count < min_points:
+            print(f"Not enough vectors to train ivfpq ({count} < {min_points}); building a flat index instead")
+            index_type = params["index_type"] = "flat"
+        else:
+            m = _pq_subquantizers(dimensions)
+            quantizer = faiss.IndexFlat(dimensions, metric)
+            index = faiss.IndexIVFPQ(quantizer, dimensions, nlist, m, PQ_BITS, metric)
+            params.update(nlist=nlist, m=m, nprobe=min(max(nlist // 16, 8), nlist))
+
+    if index_type == "flat":
+        index = faiss.IndexFlat(dimensions, metric)
+    elif index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dimensions, 32, metric)
+        index.hnsw.efConstruction = 80
+        params.update(M=32, efSearch=64)
+    elif index_type in ("sq8", "fp16"):
+        quantizer_type = faiss.ScalarQuantizer.QT_8bit if index_type == "sq8" else faiss.ScalarQuantizer.QT_fp16
+        index = faiss.IndexScalarQuantizer(dimensions, quantizer_type, metric)
+
+    with tracing.span("index_build", index_type=index_type, vectors=count):
+        if not index.is_trained:
+            index.train(vectors)
+        index.add(vectors)
+    apply_search_params(index, params)
+    return index, params
+
+
+def apply_search_params(index: faiss.Index, params: dict) -> None:
+    """Sets the search-time parameters recorded when the index was built."""
+    if "nprobe" in params:
+        faiss.extract_index_ivf(index).nprobe = params["nprobe"]
+    if "efSearch" in params:
+        index.hnsw.efSearch = params["efSearch"]
+
+
+def index_vectors(index: faiss.Index) -> np.ndarray:
+    """Returns the vectors stored in an index, decoded to float32."""
+    if isinstance(index, faiss.IndexIVF):
+        index.make_direct_map()  # IVF indexes can only reconstruct by id with a direct map
+    return index.reconstruct_n(0, index.ntotal)
+
+
+def evaluate_index_types(
+    vectors: np.ndarray,
+    queries: np.ndarray | None = None,
+    k: int = 10,
+    index_types: tuple[str, ...] = INDEX_TYPES,
+    metric: int = faiss.METRIC_L2,
+) -> list[dict]:
+    """
+    Measures recall and latency of every index type against exact flat search.
+
+    Args:
+        vectors (np.ndarray): The corpus vectors, e.g. index_vectors(vector_store.index).
+        queries (np.ndarray, optional): Query embeddings. Defaults to 200 corpus vectors with
+            noise added, which stand in for questions about the corpus.
+        k (int): Number of neighbours compared.
+        index_types (tuple[str, ...]): The types to evaluate.
+        metric (int): The FAISS metric of the corpus.
+
+    Returns:
+        list[dict]: Per index type, the type actually built, recall@k, mean query latency in ms,
+            index size in bytes and build time in seconds.
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    if queries is None:
+        rng = np.random.default_rng(0)
+        sample = vectors[rng.choice(len(vectors), min(200, len(vectors)), replace=False)]
+        queries = sample + rng.normal(0, 0.1 * vectors.std(), sample.shape).astype(np.float32)
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+    k = min(k, len(vectors))
+
+    exact, _ = build_faiss_index(vectors, "flat", metric)
+    _, truth = exact.search(queries, k)
+
+    results = []
+    for index_type in index_types:
+        started = time.perf_counter()
+        index, params = build_faiss_index(vectors, index_type, metric)
+        build_seconds = time.perf_counter() - started
+
+        started = time.perf_counter()
+        _, found = index.search(queries, k)
+        latency_ms = (time.perf_counter() - started) * 1000 / len(queries)
+
+        recall = np.mean([len(set(f) & set(t)) / k for f, t in zip(found, truth)])
+        results.append({
+            "index_type": index_type,
+            "built": params["index_type"],
+            "recall": float(recall),
+            "latency_ms": latency_ms,
+            "size_bytes": int(faiss.serialize_index(index).size),
+            "build_seconds": build_seconds,
+        })
+    return results
+
+
+def corpus_index_type(name: str, corpus_dir: str = CORPUS_DIR) -> str:
+    """Returns the index type a corpus was saved with."""
+    meta_path = os.path.join(corpus_version_path(name, corpus_dir), "meta.json")
+    if not os.path.exists(meta_path):
+        return "flat"  # Corpora saved before index types existed
+    with open(meta_path, "r", encoding="utf-8") as f:
+        return json.load(f)["index_type"]
+
+
+class ReadOnlyCorpusError(RuntimeError):
+    """Raised when a saved corpus is modified in place; rebuild and save it instead."""
+
+
+class MmapDocstore(Docstore):
+    """
+    Read-only docstore backed by memory-mapped files.
+
+    Chunk texts are stored back to back in ``texts.bin`` with their byte offsets
+    in ``offsets.npy``, so every process that opens the corpus shares the same
+    pages of the OS page cache instead of holding its own copy of the texts.
+    """
+
+    def __init__(self, path: str):
+        self._file = open(os.path.join(path, "texts.bin"), "rb")
+        size = os.fstat(self._file.fileno()).st_size
+        self._texts = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        self._offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode="r")
+        with open(os.path.join(path, "docstore.json"), "r", encoding="utf-8") as f:
+            docstore = json.load(f)
+        self._ids = docstore["ids"]
+        self._rows = {doc_id: row for row, doc_id in enumerate(self._ids)}
+        self._metadatas = docstore["metadatas"]
+
+    @property
+    def ids(self) -> list[str]:
+        """The ids of the stored documents, in the order of the corpus's index."""
+        return self._ids
+
+    def search(self, search: str) -> Document | None:
+        """Returns the document stored under the given id, or None if there is none."""
+        row = self._rows.get(search)
+        if row is None:
+            return None
+        start, end = int(self._offsets[row]), int(self._offsets[row + 1])
+        return Document(page_content=self._texts[start:end].decode("utf-8"), metadata=self._metadatas[row])
+
+    def add(self, texts: dict[str, Document]) -> None:
+        raise ReadOnlyCorpusError("Saved corpora are read-only; rebuild and save the corpus instead.")
+
+    def delete(self, ids: list) -> None:
+        raise ReadOnlyCorpusError("Saved corpora are read-only; rebuild and save the corpus instead.")
+
+
+def save_corpus(
+    name: str, vector_store: FAISS, corpus_dir: str = CORPUS_DIR, index_type: str | None = None
+) -> str:
+    """
+    Saves a vector store as a named corpus that can be memory-mapped by other processes.
+
+    Every save writes a new version directory inside the corpus directory and then
+    points the CURRENT file at it with an atomic rename, so readers always find
+    either the old or the new version complete. The previous version is kept until
+    the next save, for readers that were opening it during the swap. Its vectors
+    are re-indexed with index_type (NISMOGEN_INDEX_TYPE by default), which is
+    recorded with the corpus and used by every process that loads it.
+
+    Returns:
+        str: The directory of the saved version.
+    """
+    index_type = index_type or DEFAULT_INDEX_TYPE
+    index, params = build_faiss_index(index_vectors(vector_store.index), index_type, vector_store.index.metric_type)
+
+    path = corpus_path(name, corpus_dir)
+    previous = _current_version(path)
+    version = f"version-{time.time_ns()}"
+    version_path = os.path.join(path, version)
+    os.makedirs(version_path)
+
+    ids, texts, metadatas, offsets = [], [], [], [0]
+    with open(os.path.join(version_path, "texts.bin"), "wb") as f:
+        for position in range(vector_store.index.ntotal):
+            doc_id = vector_store.index_to_docstore_id[position]
+            document = vector_store.docstore.search(doc_id)
+            data = document.page_content.encode("utf-8")
+            f.write(data)
+            offsets.append(offsets[-1] + len(data))
+            ids.append(doc_id)
+            texts.append(document.page_content)
+            metadatas.append(document.metadata)
+    BM25Index(ids, texts).save(os.path.join(version_path, "bm25"))
+    np.save(os.path.join(version_path, "offsets.npy"), np.asarray(offsets, dtype=np.int64))
+    with open(os.path.join(version_path, "docstore.json"), "w", encoding="utf-8") as f:
+        json.dump({"ids": ids, "metadatas": metadatas}, f)
+    faiss.write_index(index, os.path.join(version_path, "index.faiss"))
+    with open(os.path.join(version_path, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump({**params, "dimensions": index.d, "chunks": index.ntotal}, f)
+
+    current_tmp = os.path.join(path, f"{CURRENT_FILE}.{os.getpid()}.tmp")
+    with open(current_tmp, "w", encoding="utf-8") as f:
+        f.write(version)
+    os.replace(current_tmp, os.path.join(path, CURRENT_FILE))
+
+    # Remove older versions, except the one just replaced; the files of a corpus saved
+    # before versions existed count as the previous version until the next save
+    for entry in os.listdir(path):
+        if entry in (CURRENT_FILE, version, previous) or previous is None and not entry.startswith("version-"):
+            continue
+        if entry.startswith("version-") and entry > version:
+            continue  # Saved concurrently by another process
+        entry_path = os.path.join(path, entry)
+        if os.path.isdir(entry_path):
+            shutil.rmtree(entry_path, ignore_errors=True)
+        else:
+            try:
+                os.remove(entry_path)
+            except OSError:
+                pass
+
+    return version_path
+
+
+def _forget_other_versions(path: str, version_path: str) -> None:
+    """Drops the cached opens of a corpus's older versions; callers holding them keep working."""
+    for cache in (_open_corpora, _open_lexical_indexes):
+        for key in [key for key in cache if key == path or key.startswith(path + os.sep)]:
+            if key != version_path:
+                del cache[key]
+
+
+def open_corpus(
+    name: str, embedding_model: Embeddings, corpus_dir: str = CORPUS_DIR
+) -> tuple[FAISS, BM25Index | None]:
+    """
+    Opens the current version of a saved corpus: its vector store and its BM25 index.
+
+    Both come from the same version directory, so lexical hits always exist in the
+    vector store. The current version is looked up on every call and an open copy
+    of it is shared by every caller in the process; a version saved by another
+    process is opened on the next call. The lexical index is None for corpora
+    saved before it existed.
+    """
+    path = corpus_path(name, corpus_dir)
+    version_path = corpus_version_path(name, corpus_dir)
+    with _open_corpora_lock:
+        if version_path not in _open_corpora:
+            if not os.path.exists(os.path.join(version_path, "index.faiss")):
+                raise FileNotFoundError(f"No saved corpus named {name!r}")
+            with tracing.span("corpus_load", corpus=name) as load_span:
+                index = faiss.read_index(os.path.join(version_path, "index.faiss"), MMAP_FLAGS)
+                meta_path = os.path.join(version_path, "meta.json")
+                if os.path.exists(meta_path):
+                    with open(meta_path, "r", encoding="utf-8") as f:
+                        apply_search_params(index, json.load(f))
+                docstore = MmapDocstore(version_path)
+                index_to_docstore_id = dict(enumerate(docstore.ids))
+                bm25_path = os.path.join(version_path, "bm25")
+                # Corpora saved before the lexical index existed search densely only
+                lexical_index = BM25Index.load(bm25_path) if os.path.isdir(bm25_path) else None
+                _forget_other_versions(path, version_path)
+                _open_corpora[version_path] = FAISS(embedding_model, index, docstore, index_to_docstore_id)
+                _open_lexical_indexes[version_path] = lexical_index
+                load_span.set(chunks=index.ntotal)
+            print(f"Opened corpus {name} with {index.ntotal} chunks ({type(index).__name__})")
+        return _open_corpora[version_path], _open_lexical_indexes[version_path]
+
+
+def load_corpus(name: str, embedding_model: Embeddings, corpus_dir: str = CORPUS_DIR) -> FAISS:
+    """
+    Opens a saved corpus read-only with its index and texts memory-mapped.
+
+    Use open_corpus when the BM25 index is needed as well, so both come from the same version.
+    """
+    return open_corpus(name, embedding_model, corpus_dir)[0]
+
+
+def corpus_chunk_ids(name: str, corpus_dir: str = CORPUS_DIR) -> list[str]:
+    """Returns the ids of the chunks in a saved corpus without opening its index."""
+    with open(os.path.join(corpus_version_path(name, corpus_dir), "docstore.json"), "r", encoding="utf-8") as f:
+        return json.load(f)["ids"]
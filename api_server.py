@@ -0,0 +1,319 @@
+import argparse
+import asyncio
+import io
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Callable, Iterator
+
+from aiohttp import web
+from PIL import Image
+
+from Utils.question_answering_RAG import (
+    qa, init_llm_model, init_embeddings_model, create_qa_model, init_prompt, gemini_generate_response, init_gemini_model,
+    corpus_fingerprint
+)
+from Utils.vector_index import open_corpus
+from Utils.summerization import summarize_long, summarize_pdf
+from Utils.Image_captioning import caption_images
+from Utils.model_registry import configure_from_env
+from Utils.utils import NamedBytesIO
+from Utils.llm_gateway import LLMGatewayError
+from Utils import batching, tracing
+
+STREAM_QUEUE_SIZE = 64  # Tokens buffered per response before the producer thread is paused
+
+
+class AdmissionController:
+    """
+    Limits how many requests of one kind run at once and how many may wait.
+
+    Requests beyond the queue limit are rejected immediately with 503 so that an
+    overloaded server sheds load instead of piling up latency.
+    """
+
+    def __init__(self, max_concurrent: int, max_queue: int):
+        self.semaphore = asyncio.Semaphore(max_concurrent)
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.waiting = 0
+
+    async def __aenter__(self):
+        if self.semaphore.locked() and self.waiting >= self.max_queue:
+            raise web.HTTPServiceUnavailable(text="Server busy, please retry.", headers={"Retry-After": "1"})
+        self.waiting += 1
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.semaphore.release()
+
+
+def json_error(error: type[web.HTTPException], message: str) -> web.HTTPException:
+    """Builds an HTTP error whose body is {"error": message}."""
+    return error(text=json.dumps({"error": message}), content_type="application/json")
+
+
+async def read_json(request: web.Request, *fields: str) -> dict:
+    """Parses a JSON object body that has the given string fields, answering 400 otherwise."""
+    try:
+        body = await request.json()
+    except ValueError:
+        raise json_error(web.HTTPBadRequest, "Request body is not valid JSON")
+    if not isinstance(body, dict):
+        raise json_error(web.HTTPBadRequest, "Request body must be a JSON object")
+    missing = [field for field in fields if not isinstance(body.get(field), str)]
+    if missing:
+        raise json_error(web.HTTPBadRequest, f"Missing or non-string fields: {', '.join(missing)}")
+    history = body.get("history", [])
+    if not isinstance(history, list) or not all(
+        isinstance(message, dict) and isinstance(message.get("role"), str) and isinstance(message.get("content"), str)
+        for message in history
+    ):
+        raise json_error(web.HTTPBadRequest, 'history must be a list of {"role": ..., "content": ...} messages')
+    return body
+
+
+class ClientGone(Exception):
+    """Raised inside a worker thread when the client has stopped reading the response."""
+
+
+async def iterate_in_thread(executor: ThreadPoolExecutor, run: Callable[[Callable], None]) -> AsyncIterator:
+    """
+    Calls run(emit) in a worker thread and yields everything it emits.
+
+    The queue between the thread and the event loop is bounded, so a slow client
+    pauses the work instead of letting output pile up in memory, and a client that
+    disconnects stops it at the next emit.
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue(STREAM_QUEUE_SIZE)
+    cancelled = threading.Event()
+    done = object()
+
+    def emit(item) -> None:
+        if cancelled.is_set():
+            raise ClientGone()
+        asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+    def produce():
+        try:
+            try:
+                run(emit)
+            except ClientGone:
+                raise
+            except Exception as e:
+                emit(e)
+            emit(done)
+        except ClientGone:
+            pass
+
+    producer = loop.run_in_executor(executor, produce)
+    try:
+        while (item := await queue.get()) is not done:
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        cancelled.set()
+        while not producer.done():  # Unblock a producer waiting on a full queue
+            while not queue.empty():
+                queue.get_nowait()
+            await asyncio.sleep(0.01)
+
+
+def emit_each(make_iterator: Callable[[], Iterator]) -> Callable[[Callable], None]:
+    """Adapts a blocking generator for iterate_in_thread."""
+    def run(emit: Callable) -> None:
+        for item in make_iterator():
+            emit(item)
+    return run
+
+
+def emit_summary(summarize_with_progress: Callable[[Callable], str]) -> Callable[[Callable], None]:
+    """Adapts a summarization for iterate_in_thread: progress events first, then the summary."""
+    def run(emit: Callable) -> None:
+        summary = summarize_with_progress(lambda level, done, total: emit({"level": level, "done": done, "total": total}))
+        emit({"summary": summary})
+    return run
+
+
+async def started(items: AsyncIterator) -> AsyncIterator:
+    """
+    Waits for the first item, so that a failure before any output still gets an error status.
+
+    Once streaming has begun the status has been sent; a later failure aborts the
+    response instead of ending it cleanly, so the client can tell it is incomplete.
+    """
+    try:
+        first = await anext(items)
+    except StopAsyncIteration:
+        return items
+    except LLMGatewayError as e:
+        raise json_error(web.HTTPBadGateway, str(e))
+    except Exception as e:
+        raise json_error(web.HTTPInternalServerError, str(e))
+
+    async def resumed():
+        yield first
+        async for item in items:
+            yield item
+    return resumed()
+
+
+async def stream_text(request: web.Request, tokens: AsyncIterator[str]) -> web.StreamResponse:
+    """Streams text tokens to the client as they are produced."""
+    tokens = await started(tokens)
+    response = web.StreamResponse(headers={"Content-Type": "text/plain; charset=utf-8"})
+    await response.prepare(request)
+    async for token in tokens:
+        await response.write(token.encode("utf-8"))
+    await response.write_eof()
+    return response
+
+
+async def stream_events(request: web.Request, events: AsyncIterator[dict]) -> web.StreamResponse:
+    """Streams JSON events to the client, one per line."""
+    events = await started(events)
+    response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+    await response.prepare(request)
+    async for event in events:
+        await response.write((json.dumps(event) + "\n").encode("utf-8"))
+    await response.write_eof()
+    return response
+
+
+class APIServer:
+    """Serves chat, QA, summarization and captioning over HTTP."""
+
+    def __init__(self, workers: int, max_concurrent: int, max_queue: int):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="api-worker")
+        self.admission = {
+            kind: AdmissionController(max_concurrent, max_queue)
+            for kind in ("chat", "qa", "summarize", "caption")
+        }
+        self.prompt, self.qa_prompt = init_prompt()
+        self.qa_models: dict = {}  # Corpus name -> (QA chain, vector store, fingerprint), shared by all requests
+        self.qa_model_locks: dict[str, threading.Lock] = {}
+        self.qa_model_locks_lock = threading.Lock()
+
+    def _qa_model(self, corpus: str):
+        with self.qa_model_locks_lock:
+            lock = self.qa_model_locks.setdefault(corpus, threading.Lock())
+        with lock:  # Concurrent first requests for a corpus build its QA chain once
+            vector_store, lexical_index = open_corpus(corpus, init_embeddings_model())
+            if corpus not in self.qa_models or self.qa_models[corpus][1] is not vector_store:  # New or re-saved
+                qa_model = create_qa_model(
+                    vector_store, init_llm_model(), self.prompt, self.qa_prompt, lexical_index=lexical_index
+                )
+                self.qa_models[corpus] = (qa_model, vector_store, corpus_fingerprint(vector_store))
+            return self.qa_models[corpus]
+
+    async def chat(self, request: web.Request) -> web.StreamResponse:
+        body = await read_json(request, "message")
+        async with self.admission["chat"]:
+            tokens = iterate_in_thread(self.executor, emit_each(
+                lambda: gemini_generate_response(body["message"], init_gemini_model(), body.get("history", []))
+            ))
+            return await stream_text(request, tokens)
+
+    async def qa(self, request: web.Request) -> web.StreamResponse:
+        body = await read_json(request, "corpus", "question")
+        async with self.admission["qa"]:
+            try:
+                qa_model, vector_store, fingerprint = await asyncio.get_running_loop().run_in_executor(
+                    self.executor, self._qa_model, body["corpus"]
+                )
+            except FileNotFoundError as e:
+                raise json_error(web.HTTPNotFound, str(e))
+            except ValueError as e:
+                raise json_error(web.HTTPBadRequest, str(e))
+            tokens = iterate_in_thread(self.executor, emit_each(
+                lambda: qa(
+                    body["question"], qa_model, body.get("history", []), vector_store=vector_store, fingerprint=fingerprint
+                )
+            ))
+            return await stream_text(request, tokens)
+
+    async def summarize(self, request: web.Request) -> web.StreamResponse:
+        body = await read_json(request, "text")
+        async with self.admission["summarize"]:
+            events = iterate_in_thread(self.executor, emit_summary(
+                lambda callback: summarize_long(body["text"], progress_callback=callback)
+            ))
+            return await stream_events(request, events)
+
+    async def summarize_pdf(self, request: web.Request) -> web.StreamResponse:
+        pdf_file = NamedBytesIO(await request.read(), "upload.pdf")
+        async with self.admission["summarize"]:
+            events = iterate_in_thread(self.executor, emit_summary(
+                lambda callback: summarize_pdf(pdf_file, progress_callback=callback)
+            ))
+            return await stream_events(request, events)
+
+    async def caption(self, request: web.Request) -> web.Response:
+        try:
+            if request.content_type.startswith("multipart/"):
+                data = []
+                reader = await request.multipart()
+                while part := await reader.next():
+                    data.append(await part.read())
+            else:
+                data = [await request.read()]
+            # Decoded here, not lazily in the model, so truncated files and odd modes are the client's error
+            images = [Image.open(io.BytesIO(item)).convert("RGB") for item in data]
+        except (OSError, ValueError):  # UnidentifiedImageError is an OSError too
+            raise json_error(web.HTTPBadRequest, "Request body is not a supported image")
+        async with self.admission["caption"]:
+            try:
+                captions = await asyncio.get_running_loop().run_in_executor(self.executor, caption_images, images)
+            except Exception as e:
+                raise json_error(web.HTTPInternalServerError, f"Captioning failed: {e}")
+        return web.json_response({"captions": captions})
+
+    async def health(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            "admission": {
+                kind: {"waiting": controller.waiting, "max_concurrent": controller.max_concurrent}
+                for kind, controller in self.admission.items()
+            },
+            "batchers": batching.stats(),
+            "stages": tracing.summary(),
+        })
+
+    async def metrics(self, request: web.Request) -> web.Response:
+        return web.Response(text=tracing.render_prometheus(), content_type="text/plain", charset="utf-8")
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 2**20)
+        app.add_routes([
+            web.post("/chat", self.chat),
+            web.post("/qa", self.qa),
+            web.post("/summarize", self.summarize),
+            web.post("/summarize/pdf", self.summarize_pdf),
+            web.post("/caption", self.caption),
+            web.get("/health", self.health),
+            web.get("/metrics", self.metrics),
+        ])
+        return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve NismoGen over HTTP.")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=8, help="Threads running model and LLM calls.")
+    parser.add_argument("--max-concurrent", type=int, default=4, help="Requests of each kind processed at once.")
+    parser.add_argument("--max-queue", type=int, default=32, help="Requests of each kind allowed to wait.")
+    args = parser.parse_args()
+
+    configure_from_env()
+    server = APIServer(args.workers, args.max_concurrent, args.max_queue)
+    web.run_app(server.app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,312 @@
+"""
+Summarizes, captions and indexes every file under a directory, without the Streamlit UI.
+
+    python batch_process.py documents/ --tasks summarize,caption,index --workers 4 --corpus handbook
+
+Files are shared out to a process pool in which every worker loads its own copy of
+the models once. Results are appended to a JSONL file as they finish, and that file
+doubles as the checkpoint: a rerun skips every file whose path and content hash
+already have a result, so an interrupted run resumes where it stopped. Indexed
+chunks are kept next to the results and saved as a corpus at the end of the run.
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from itertools import islice
+
+import numpy as np
+
+DOCUMENT_EXTENSIONS = ("pdf", "md", "txt", "csv", "arxiv")
+IMAGE_EXTENSIONS = ("jpg", "jpeg", "png")
+TASKS = ("summarize", "caption", "index")
+TASK_MODELS = {"summarize": "summarizer", "caption": "captioner", "index": "embeddings"}
+HASH_BLOCK_BYTES = 1 << 20
+PROGRESS_INTERVAL_S = 10.0
+
+
+def _init_worker(models: list[str], threads: int) -> None:
+    """Loads the models a worker needs once, before it takes any file."""
+    import torch
+    torch.set_num_threads(threads)  # Workers share the CPUs instead of each using all of them
+
+    import Utils.Image_captioning  # noqa: F401  Each module registers the loader of its model
+    import Utils.question_answering_RAG  # noqa: F401
+    import Utils.summerization  # noqa: F401
+    from Utils.model_registry import registry
+    registry.warm_up(models)
+
+
+def summarize_file(path: str) -> dict:
+    from Utils.summerization import summarize_long, summarize_pdf
+    from Utils.utils import get_file_extension, open_local_file, read_file
+
+    uploaded_file = open_local_file(path)
+    if get_file_extension(path).lower() == "pdf":
+        return {"summary": summarize_pdf(uploaded_file)}
+    text = read_file(uploaded_file)
+    return {"summary": summarize_long(text) if text.strip() else ""}
+
+
+def index_file(path: str, digest: str, chunk_dir: str) -> dict:
+    from Utils.ingestion import batched, iter_chunks
+    from Utils.question_answering_RAG import init_embeddings_model
+    from Utils.utils import open_local_file
+
+    embeddings = init_embeddings_model()
+    texts, vectors = [], []
+    for batch in batched(iter_chunks(open_local_file(path))):
+        texts.extend(batch)
+        vectors.extend(embeddings.embed_documents(batch))
+    save_chunks(chunk_dir, digest, texts, vectors)
+    return {"chunks": len(texts)}
+
+
+def caption_files(paths: list[str]) -> list[dict]:
+    from PIL import Image
+    from Utils.Image_captioning import caption_images
+
+    results, images = [], []
+    for path in paths:
+        try:
+            with Image.open(path) as image:
+                images.append(image.convert("RGB"))
+            results.append(None)
+        except Exception as e:  # An unreadable image fails alone, not its whole batch
+            results.append({"error": f"{type(e).__name__}: {e}"})
+    captions = iter(caption_images(images) if images else [])
+    return [result or {"caption": next(captions)} for result in results]
+
+
+def run_task(task: str, root: str, items: list[tuple[str, str]], chunk_dir: str) -> list[dict]:
+    """
+    Runs one task on a shard of files in a worker and returns one result record per file.
+
+    Args:
+        task (str): "summarize", "caption" or "index".
+        root (str): The directory being processed; record paths are relative to it.
+        items (list[tuple[str, str]]): The relative path and SHA-256 digest of each file.
+        chunk_dir (str): Where indexed chunks and their vectors are written.
+    """
+    started = time.perf_counter()
+    paths = [os.path.join(root, path) for path, _ in items]
+    if task == "caption":
+        try:
+            outputs = caption_files(paths)
+        except Exception as e:
+            outputs = [{"error": f"{type(e).__name__}: {e}"}] * len(items)
+    else:
+        outputs = []
+        for path, (_, digest) in zip(paths, items):
+            try:
+                outputs.append(summarize_file(path) if task == "summarize" else index_file(path, digest, chunk_dir))
+            except Exception as e:
+                outputs.append({"error": f"{type(e).__name__}: {e}"})
+    seconds = (time.perf_counter() - started) / len(items)
+    return [
+        {"path": path, "sha256": digest, "task": task, **output, "seconds": round(seconds, 3)}
+        for (path, digest), output in zip(items, outputs)
+    ]
+
+
+def hash_file(path: str) -> str:
+    """Returns the SHA-256 digest of a file, read in blocks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while block := f.read(HASH_BLOCK_BYTES):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def find_files(root: str, tasks: list[str]) -> dict[str, list[str]]:
+    """Walks a directory and returns the relative paths each task applies to, in a stable order."""
+    files = {task: [] for task in tasks}
+    for directory, subdirectories, names in os.walk(root):
+        subdirectories[:] = sorted(name for name in subdirectories if not name.startswith("."))
+        for name in sorted(names):
+            extension = name.rsplit(".", 1)[-1].lower() if "." in name else ""
+            path = os.path.relpath(os.path.join(directory, name), root)
+            for task in tasks:
+                if extension in (IMAGE_EXTENSIONS if task == "caption" else DOCUMENT_EXTENSIONS):
+                    files[task].append(path)
+    return files
+
+
+def load_checkpoint(output: str) -> dict[tuple[str, str, str], dict]:
+    """Reads the results of earlier runs, keyed by path, content hash and task."""
+    done = {}
+    if not os.path.exists(output):
+        return done
+    with open(output, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:  # The last line of a run that was killed mid-write
+                print(f"Ignoring unreadable line {line_number} of {output}")
+                continue
+            done[(record["path"], record["sha256"], record["task"])] = record
+    return done
+
+
+def terminate_last_line(output: str) -> None:
+    """Ends a line cut short by a crash, so that new results start on a line of their own."""
+    if not os.path.exists(output) or not os.path.getsize(output):
+        return
+    with open(output, "rb+") as f:
+        f.seek(-1, os.SEEK_END)
+        if f.read(1) != b"\n":
+            f.write(b"\n")
+
+
+def chunk_path(chunk_dir: str, digest: str) -> str:
+    return os.path.join(chunk_dir, f"{digest}.npz")
+
+
+def save_chunks(chunk_dir: str, digest: str, texts: list[str], vectors: list[list[float]]) -> None:
+    """Keeps the chunks and vectors of an indexed file until the corpus is saved."""
+    os.makedirs(chunk_dir, exist_ok=True)
+    tmp_path = f"{chunk_path(chunk_dir, digest)}.{os.getpid()}.tmp.npz"
+    np.savez(tmp_path, texts=np.asarray(texts, dtype=str), vectors=np.asarray(vectors, dtype=np.float32))
+    os.replace(tmp_path, chunk_path(chunk_dir, digest))
+
+
+def build_corpus(name: str, records: list[dict], chunk_dir: str, index_type: str | None) -> str:
+    """Saves the indexed chunks of the given files as a corpus that the app and API server can load."""
+    from langchain_community.vectorstores import FAISS
+    from Utils.question_answering_RAG import init_embeddings_model
+    from Utils.vector_index import save_corpus
+
+    text_embeddings, metadatas, ids = [], [], []
+    seen = set()
+    for record in sorted(records, key=lambda record: record["path"]):
+        digest = record["sha256"]
+        if digest in seen:  # Copies of a file are indexed once
+            continue
+        seen.add(digest)
+        with np.load(chunk_path(chunk_dir, digest)) as chunks:
+            for i, (text, vector) in enumerate(zip(chunks["texts"].tolist(), chunks["vectors"])):
+                chunk_id = f"{digest}:{i}"  # The same ids as uploads get, so the corpus fingerprint matches
+                text_embeddings.append((text, vector.tolist()))
+                metadatas.append({"source": os.path.basename(record["path"]), "chunk_id": chunk_id})
+                ids.append(chunk_id)
+    if not text_embeddings:
+        raise ValueError("No chunks were indexed, so there is no corpus to save.")
+
+    vector_store = FAISS.from_embeddings(text_embeddings, init_embeddings_model(), metadatas=metadatas, ids=ids)
+    return save_corpus(name, vector_store, index_type=index_type)
+
+
+def shards(task: str, items: list[tuple[str, str]], caption_batch: int):
+    """Splits a task's files into the units of work sent to the workers; images are captioned in batches."""
+    size = caption_batch if task == "caption" else 1
+    for start in range(0, len(items), size):
+        yield task, items[start:start + size]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize, caption and index every file under a directory.")
+    parser.add_argument("directory", help="Directory to process, including its subdirectories.")
+    parser.add_argument("--tasks", default=",".join(TASKS), help=f"Comma-separated subset of {TASKS}.")
+    parser.add_argument("--output", default="batch_results.jsonl", help="Results file, also used to resume.")
+    parser.add_argument("--workers", type=int, default=max((os.cpu_count() or 1) // 4, 1),
+                        help="Worker processes, each with its own copy of the models.")
+    parser.add_argument("--caption-batch", type=int, default=8, help="Images captioned per model call.")
+    parser.add_argument("--corpus", help="Name of the corpus to save the index as; defaults to the directory name.")
+    parser.add_argument("--index-type", help="FAISS index type of the corpus; defaults to NISMOGEN_INDEX_TYPE.")
+    parser.add_argument("--retry-errors", action="store_true", help="Process files that failed in an earlier run again.")
+    args = parser.parse_args()
+
+    tasks = [task for task in args.tasks.split(",") if task]
+    unknown = set(tasks) - set(TASKS)
+    if unknown:
+        parser.error(f"unknown tasks: {', '.join(sorted(unknown))}")
+    root = os.path.abspath(args.directory)
+    chunk_dir = f"{args.output}.chunks"
+    corpus = args.corpus or os.path.basename(root.rstrip(os.sep))
+
+    files = find_files(root, tasks)
+    digests = {path: hash_file(os.path.join(root, path)) for path in sorted(set().union(*files.values()))}
+    done = load_checkpoint(args.output)
+
+    pending = {task: [] for task in tasks}
+    for task, paths in files.items():
+        for path in paths:
+            record = done.get((path, digests[path], task))
+            if record is None or (args.retry_errors and "error" in record):
+                pending[task].append((path, digests[path]))
+    total = sum(map(len, pending.values()))
+    print(f"{len(digests)} files, {total} tasks to run, {sum(map(len, files.values())) - total} already done")
+
+    completed, errors, task_seconds = {task: 0 for task in tasks}, 0, {task: 0.0 for task in tasks}
+    started = last_report = time.perf_counter()
+    if total:
+        models = [TASK_MODELS[task] for task in tasks if pending[task]]
+        threads = max((os.cpu_count() or 1) // args.workers, 1)
+        work = (shard for task in tasks for shard in shards(task, pending[task], args.caption_batch))
+        terminate_last_line(args.output)
+        with open(args.output, "a", encoding="utf-8") as results, ProcessPoolExecutor(
+            args.workers, initializer=_init_worker, initargs=(models, threads)
+        ) as pool:
+            # At most two shards per worker are queued, so thousands of files do not pile up in memory
+            in_flight = {pool.submit(run_task, task, root, items, chunk_dir) for task, items in islice(work, 2 * args.workers)}
+            try:
+                while in_flight:
+                    finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        for record in future.result():
+                            results.write(json.dumps(record) + "\n")
+                            done[(record["path"], record["sha256"], record["task"])] = record
+                            completed[record["task"]] += 1
+                            task_seconds[record["task"]] += record["seconds"]
+                            if "error" in record:
+                                errors += 1
+                                print(f"{record['task']} failed for {record['path']}: {record['error']}")
+                        results.flush()
+                        os.fsync(results.fileno())  # Every finished file survives a crash
+                        for task, items in islice(work, 1):
+                            in_flight.add(pool.submit(run_task, task, root, items, chunk_dir))
+
+                    now = time.perf_counter()
+                    if now - last_report >= PROGRESS_INTERVAL_S:
+                        finished_tasks = sum(completed.values())
+                        rate = finished_tasks / (now - started)
+                        print(f"{finished_tasks}/{total} tasks, {rate:.2f} files/s, about {(total - finished_tasks) / rate:.0f}s left")
+                        last_report = now
+            except KeyboardInterrupt:
+                pool.shutdown(wait=False, cancel_futures=True)
+                print(f"Interrupted; rerun the same command to resume from {args.output}")
+                raise
+            except BrokenProcessPool:  # A model failed to load, or a worker ran out of memory
+                print(f"A worker process failed, see above; rerun the same command to resume from {args.output}")
+                sys.exit(1)
+
+    elapsed = time.perf_counter() - started
+    for task in tasks:
+        if completed[task]:
+            print(
+                f"{task}: {completed[task]} files in {elapsed:.1f}s, {completed[task] / elapsed:.2f} files/s "
+                f"({task_seconds[task] / completed[task]:.2f}s per file in a worker)"
+            )
+    if total:
+        print(f"All tasks: {sum(completed.values()) / elapsed:.2f} files/s with {args.workers} workers, {errors} errors")
+
+    from Utils.vector_index import corpus_chunk_ids, list_corpora
+
+    if "index" in tasks:
+        indexed = [
+            done[(path, digests[path], "index")] for path in files["index"]
+            if "error" not in done.get((path, digests[path], "index"), {"error": None})
+        ]
+        # Rebuild whenever the files differ from the saved corpus: new, changed or deleted ones
+        saved = {chunk_id.rpartition(":")[0] for chunk_id in corpus_chunk_ids(corpus)} if corpus in list_corpora() else None
+        if indexed and saved != {record["sha256"] for record in indexed}:
+            print(f"Saved corpus {corpus} to {build_corpus(corpus, indexed, chunk_dir, args.index_type)}")
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
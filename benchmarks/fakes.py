@@ -0,0 +1,171 @@
+import hashlib
+import io
+import math
+import random
+import re
+import time
+import wave
+from typing import Any, Iterator
+
+from langchain_core.callbacks import CallbackManagerForLLMRun
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+
+def fake_tokens(prompt: str, count: int) -> list[str]:
+    """Draws count words from the prompt with a seed derived from it, so a prompt always gets the same answer."""
+    rng = random.Random(hashlib.sha1(prompt.encode("utf-8")).digest())
+    vocabulary = re.findall(r"[A-Za-z][A-Za-z'-]+", prompt) or ["answer"]
+    return [rng.choice(vocabulary) + " " for _ in range(count)]
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    Deterministic local stand-in for Gemini.
+
+    The response is drawn from the words of the prompt with a seed derived from the
+    prompt, so the same prompt always gets the same answer. It waits latency_ms
+    before the first token and then emits tokens_per_second tokens per second,
+    which makes time-to-first-token and streaming behave like a remote model.
+    """
+
+    latency_ms: float = 300.0
+    tokens_per_second: float = 50.0
+    response_tokens: int = 60
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    def _tokens(self, messages: list[BaseMessage]) -> list[str]:
+        return fake_tokens("\n".join(str(message.content) for message in messages), self.response_tokens)
+
+    def _stream(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: CallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        time.sleep(self.latency_ms / 1000)
+        for i, token in enumerate(self._tokens(messages)):
+            if i:
+                time.sleep(1 / self.tokens_per_second)
+            if run_manager:
+                run_manager.on_llm_new_token(token)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+
+    def _generate(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: CallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        text = "".join(chunk.message.content for chunk in self._stream(messages, stop, run_manager, **kwargs))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text.strip()))])
+
+
+class HashEmbeddings(Embeddings):
+    """Deterministic bag-of-words embeddings, for benchmarking everything but the embedding model."""
+
+    def __init__(self, dimensions: int = 384):
+        self.dimensions = dimensions
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        vector = [0.0] * self.dimensions
+        for word in re.findall(r"\w+", text.lower()):
+            vector[int.from_bytes(hashlib.md5(word.encode("utf-8")).digest()[:4], "little") % self.dimensions] += 1.0
+        norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+        return [value / norm for value in vector]
+
+
+def speech_fixture(seconds: float = 2.0, sample_rate: int = 16000, seed: int = 0) -> bytes:
+    """
+    Synthesizes a mono 16-bit WAV that looks like speech to an energy-based detector.
+
+    Tone bursts with syllable-like rhythm are surrounded by silence, so recognizers
+    that wait for a pause before finishing an utterance behave as with a real voice.
+    """
+    rng = random.Random(seed)
+    samples = []
+    silence = int(0.3 * sample_rate)
+    samples += [0] * silence
+    while len(samples) < silence + seconds * sample_rate:
+        frequency, length = rng.uniform(120, 300), int(rng.uniform(0.08, 0.25) * sample_rate)
+        samples += [int(8000 * math.sin(2 * math.pi * frequency * i / sample_rate)) for i in range(length)]
+        samples += [0] * int(rng.uniform(0.02, 0.08) * sample_rate)
+    samples += [0] * int(1.0 * sample_rate)
+
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes(b"".join(sample.to_bytes(2, "little", signed=True) for sample in samples))
+    return buffer.getvalue()
+
+
+def install_fake_llm(**kwargs) -> None:
+    """Makes init_llm_model and init_gemini_model return a FakeChatModel."""
+    import Utils.question_answering_RAG  # noqa: F401  Registers the real loader first, so ours replaces it
+    from Utils.model_registry import registry
+
+    registry.unload("llm")
+    registry.register("llm", lambda: FakeChatModel(**kwargs))
+
+
+def install_stub_gateway(base_url: str, **gateway_kwargs) -> None:
+    """Sends the real Gemini client, through a fresh LLM gateway, to a stub server such as benchmarks/gemini_stub.py."""
+    import Utils.question_answering_RAG  # noqa: F401
+    from Utils import llm_gateway
+    from Utils.model_registry import registry
+
+    llm_gateway.gateway.close()
+    llm_gateway.gateway = llm_gateway.LLMGateway(base_url=base_url, api_key="stub", **gateway_kwargs)
+    registry.unload("llm")
+    registry.register("llm", lambda: llm_gateway.GatewayChatModel())
+
+
+def install_fake_embeddings(dimensions: int = 384) -> None:
+    """Makes init_embeddings_model return HashEmbeddings behind the usual cache and batcher."""
+    import Utils.question_answering_RAG  # noqa: F401
+    from Utils.batching import BatchedEmbeddings
+    from Utils.embedding_cache import CachedEmbeddings
+    from Utils.model_registry import registry
+
+    registry.unload("embeddings")
+    registry.register("embeddings", lambda: CachedEmbeddings(
+        BatchedEmbeddings(HashEmbeddings(dimensions)), f"hash-{dimensions}"
+    ))
+
+
+def install_fake_speech(fixtures: list[tuple[bytes, str]], latency_ms: float = 200.0) -> None:
+    """
+    Replaces the microphone and the Google speech API used by listen().
+
+    Each time the microphone is opened it plays the next WAV fixture, and recognition
+    returns that fixture's transcript after latency_ms.
+    """
+    import speech_recognition as sr
+
+    playlist = list(fixtures)
+    playing = {}  # The transcript of the fixture played last
+
+    class FixtureMicrophone(sr.AudioFile):
+        def __init__(self, *args, **kwargs):
+            audio, playing["transcript"] = playlist.pop(0)
+            playlist.append((audio, playing["transcript"]))
+            super().__init__(io.BytesIO(audio))
+
+    def recognize_google(recognizer, audio_data, *args, **kwargs):
+        time.sleep(latency_ms / 1000)
+        return playing["transcript"]
+
+    sr.Microphone = FixtureMicrophone
+    sr.Recognizer.recognize_google = recognize_google
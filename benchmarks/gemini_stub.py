@@ -0,0 +1,146 @@
+"""
+Local stand-in for the Gemini streamGenerateContent endpoint, for exercising the LLM gateway.
+
+It streams the same deterministic answers as FakeChatModel as server-sent events and
+can enforce a requests-per-minute quota, fail a fraction of requests with 500 and
+delay the first token of a fraction of requests, so that rate limiting, retries and
+hedging can be observed without network access. Run it on its own with
+
+    python -m benchmarks.gemini_stub --port 8090 --rpm 60 --error-rate 0.05
+
+and point the app at it with NISMOGEN_GEMINI_BASE_URL=http://127.0.0.1:8090.
+"""
+import argparse
+import asyncio
+import json
+import random
+import threading
+import time
+from collections import Counter, deque
+from typing import Callable
+
+from aiohttp import web
+
+from benchmarks.fakes import fake_tokens
+
+
+class GeminiStub:
+    """Serves streamGenerateContent with configurable latency, streaming rate, quota and failures."""
+
+    def __init__(
+        self,
+        latency_ms: float = 300.0,
+        tokens_per_second: float = 50.0,
+        response_tokens: int = 60,
+        rpm: float = 0,
+        error_rate: float = 0.0,
+        slow_rate: float = 0.0,
+        slow_ms: float = 5000.0,
+        seed: int = 0,
+    ):
+        self.latency_ms = latency_ms
+        self.tokens_per_second = tokens_per_second
+        self.response_tokens = response_tokens
+        self.rpm = rpm  # 0 accepts every request
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.slow_ms = slow_ms
+        self.rng = random.Random(seed)
+        self.accepted = deque()  # Times of the requests accepted in the last minute
+        self.counts = Counter()
+
+    async def generate(self, request: web.Request) -> web.StreamResponse:
+        _, _, method = request.match_info["model_method"].partition(":")
+        if method != "streamGenerateContent":
+            raise web.HTTPNotFound(text=f"Unsupported method {method!r}")
+        self.counts["requests"] += 1
+
+        now = time.monotonic()
+        while self.accepted and now - self.accepted[0] > 60:
+            self.accepted.popleft()
+        if self.rpm and len(self.accepted) >= self.rpm:
+            self.counts["rate_limited"] += 1
+            retry_after = max(60 - (now - self.accepted[0]), 0.1)
+            return web.json_response(
+                {"error": {"code": 429, "message": "Resource has been exhausted (e.g. check quota)."}},
+                status=429, headers={"Retry-After": f"{retry_after:.1f}"},
+            )
+        self.accepted.append(now)
+        if self.rng.random() < self.error_rate:
+            self.counts["errors"] += 1
+            return web.json_response({"error": {"code": 500, "message": "Internal error"}}, status=500)
+
+        body = await request.json()
+        prompt = "\n".join(
+            part.get("text", "")
+            for content in [body.get("systemInstruction", {})] + body.get("contents", [])
+            for part in content.get("parts", [])
+        )
+        slow = self.rng.random() < self.slow_rate
+        self.counts["slow"] += slow
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        await asyncio.sleep((self.slow_ms if slow else self.latency_ms) / 1000)
+        tokens = fake_tokens(prompt, self.response_tokens)
+        try:
+            for i in range(0, len(tokens), 4):  # Gemini streams a few tokens per event
+                if i:
+                    await asyncio.sleep(4 / self.tokens_per_second)
+                event = {"candidates": [{"content": {"role": "model", "parts": [{"text": "".join(tokens[i:i + 4])}]}}]}
+                await response.write(f"data: {json.dumps(event)}\r\n\r\n".encode("utf-8"))
+        except ConnectionResetError:  # The client went away, e.g. a hedged request that lost
+            self.counts["disconnected"] += 1
+            return response
+        self.counts["completed"] += 1
+        await response.write_eof()
+        return response
+
+    async def stats(self, request: web.Request) -> web.Response:
+        return web.json_response(dict(self.counts))
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/v1beta/models/{model_method}", self.generate)
+        app.router.add_get("/stats", self.stats)
+        return app
+
+
+def start_stub_server(stub: GeminiStub, host: str = "127.0.0.1", port: int = 0) -> tuple[str, Callable[[], None]]:
+    """Serves the stub from a background thread and returns its base URL and a function that stops it."""
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(stub.app())
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, host, port)
+    loop.run_until_complete(site.start())
+    bound_port = runner.addresses[0][1]
+    threading.Thread(target=loop.run_forever, name="gemini-stub", daemon=True).start()
+
+    def stop():
+        asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+
+    return f"http://{host}:{bound_port}", stop
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a local stand-in for the Gemini streaming API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency-ms", type=float, default=300.0, help="Time to the first token.")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--rpm", type=float, default=0, help="Requests per minute before answering 429; 0 for no limit.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with 500.")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="Fraction of requests with a slow first token.")
+    parser.add_argument("--slow-ms", type=float, default=5000.0, help="Time to the first token of slow requests.")
+    args = parser.parse_args()
+
+    stub = GeminiStub(
+        latency_ms=args.latency_ms, tokens_per_second=args.tokens_per_second, rpm=args.rpm,
+        error_rate=args.error_rate, slow_rate=args.slow_rate, slow_ms=args.slow_ms,
+    )
+    web.run_app(stub.app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
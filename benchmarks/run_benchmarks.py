@@ -0,0 +1,467 @@
+"""
+Offline benchmarks for ingestion, retrieval, index types, QA, chat, the LLM gateway, summarization, captioning and ASR.
+
+Gemini and the speech API are replaced by the local fakes in benchmarks/fakes.py, so
+runs are repeatable and need no network. Run from the repository root:
+
+    python -m benchmarks.run_benchmarks --sizes 10,100 --concurrency 1,8
+    python -m benchmarks.run_benchmarks --compare benchmarks/results/<commit>.json
+
+With --llm-backend stub, Gemini requests go through the real LLM gateway to the local
+stub server in benchmarks/gemini_stub.py instead of the in-process fake model.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Callable
+
+import numpy as np
+
+from benchmarks.fakes import (
+    install_fake_embeddings, install_fake_llm, install_fake_speech, install_stub_gateway, speech_fixture
+)
+from benchmarks.gemini_stub import GeminiStub, start_stub_server
+from Utils.utils import NamedBytesIO
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SEED_DIR = os.path.join(REPO_DIR, "documents")
+RESULTS_DIR = os.path.join(REPO_DIR, "benchmarks", "results")
+WORKLOADS = ("ingest", "retrieval", "index_types", "qa", "qa_cached", "chat", "gateway", "summarize", "caption", "asr")
+
+
+def seed_passages() -> list[str]:
+    """Splits the text of every seed document into paragraphs."""
+    from Utils.utils import read_pdf
+
+    texts = []
+    for name in sorted(os.listdir(SEED_DIR)):
+        path = os.path.join(SEED_DIR, name)
+        if name.endswith((".txt", ".csv")):
+            with open(path, "r", encoding="utf-8") as f:
+                texts.append(f.read())
+        elif name.endswith(".pdf"):
+            with open(path, "rb") as f:
+                texts.append(read_pdf(NamedBytesIO(f.read(), name)))
+    passages = [p.strip() for text in texts for p in re.split(r"\n\s*\n|(?<=\.)\n", text)]
+    return [passage for passage in passages if len(passage) > 40]
+
+
+def synthetic_corpus(passages: list[str], size: int, file_chars: int = 6000, seed: int = 0) -> list[NamedBytesIO]:
+    """Builds size distinct text files from shuffled seed passages, each tagged with a unique code."""
+    rng = random.Random(seed)
+    files = []
+    for i in range(size):
+        body = [f"Document {i} has reference code DOC-{i:05d}."]
+        while sum(map(len, body)) < file_chars:
+            body.append(rng.choice(passages))
+        files.append(NamedBytesIO("\n\n".join(body).encode("utf-8"), f"doc_{i:05d}.txt"))
+    return files
+
+
+def sample_questions(passages: list[str], count: int, seed: int = 1) -> list[str]:
+    """Turns random seed sentences into questions."""
+    rng = random.Random(seed)
+    questions = []
+    for _ in range(count):
+        words = rng.choice(passages).split()
+        start = rng.randrange(max(len(words) - 8, 1))
+        questions.append("What does the document say about " + " ".join(words[start:start + 8]).rstrip(".,;:") + "?")
+    return questions
+
+
+def process_peak_rss_mb() -> float:
+    """Returns the peak resident set size of the process over its whole lifetime, in MiB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10  # Bytes on macOS, KiB elsewhere
+
+
+def proc_status_mb(field: str) -> float:
+    """Returns a memory field of /proc/self/status, such as VmRSS or VmHWM, in MiB."""
+    with open("/proc/self/status", "r", encoding="utf-8") as f:
+        for line in f:
+            if line.startswith(f"{field}:"):
+                return int(line.split()[1]) / 2**10  # Reported in kB
+    raise KeyError(field)
+
+
+def reset_peak_rss() -> float | None:
+    """
+    Restarts the kernel's peak RSS (VmHWM) from the current RSS and returns the current RSS in MiB.
+
+    Returns None where the peak cannot be reset (anything but Linux), in which case only
+    the lifetime peak of the process is available.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w", encoding="utf-8") as f:
+            f.write("5")
+        return proc_status_mb("VmRSS")
+    except OSError:
+        return None
+
+
+def run_concurrently(task: Callable[[object], object], inputs: list, concurrency: int) -> dict:
+    """
+    Runs task on every input with the given number of threads.
+
+    task may return a dict of extra per-request measurements such as {"first_token_ms": ...},
+    which are reported as percentiles next to the request latency. Other return values are ignored.
+    """
+    from Utils.tracing import percentile
+
+    def timed(item):
+        started = time.perf_counter()
+        extra = task(item)
+        return (time.perf_counter() - started) * 1000, extra if isinstance(extra, dict) else {}
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        outcomes = list(pool.map(timed, inputs))
+    seconds = time.perf_counter() - started
+
+    latencies = sorted(latency for latency, _ in outcomes)
+    result = {
+        "requests": len(inputs),
+        "seconds": seconds,
+        "throughput": len(inputs) / seconds if seconds else 0.0,
+        "p50_ms": percentile(latencies, 0.5),
+        "p95_ms": percentile(latencies, 0.95),
+        "p99_ms": percentile(latencies, 0.99),
+    }
+    for key in {key for _, extra in outcomes for key in extra}:
+        values = sorted(extra[key] for _, extra in outcomes if key in extra)
+        result[f"{key}_p50"] = percentile(values, 0.5)
+        result[f"{key}_p95"] = percentile(values, 0.95)
+    return result
+
+
+def consume_stream(tokens) -> dict:
+    """Reads a token stream to the end and returns the time to its first token."""
+    started = time.perf_counter()
+    first_token_ms = None
+    for _ in tokens:
+        if first_token_ms is None:
+            first_token_ms = (time.perf_counter() - started) * 1000
+    return {"first_token_ms": first_token_ms or 0.0}
+
+
+class Benchmarks:
+    """Runs each workload and collects one result row per configuration."""
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.passages = seed_passages()
+        self.questions = sample_questions(self.passages, args.requests)
+        self.indexes = {}  # Corpus size -> IncrementalVectorStore
+        self.results = []
+        self.rss_baseline_mb = reset_peak_rss()
+
+    def start_workload(self) -> None:
+        """Starts measuring memory from the current RSS, so a workload's peak excludes the ones before it."""
+        self.rss_baseline_mb = reset_peak_rss()
+
+    def record(self, workload: str, **row) -> None:
+        """
+        Adds a result row with the memory used since the previous row or the start of the workload.
+
+        peak_rss_delta_mb is the peak RSS in that window minus rss_baseline_mb, the RSS at
+        its start. Where the peak cannot be reset, process_peak_rss_mb, the lifetime peak
+        of the whole benchmark process, is reported instead.
+        """
+        row = {"workload": workload, **row}
+        if self.rss_baseline_mb is not None:
+            row["rss_baseline_mb"] = self.rss_baseline_mb
+            row["peak_rss_delta_mb"] = proc_status_mb("VmHWM") - self.rss_baseline_mb
+        else:
+            row["process_peak_rss_mb"] = process_peak_rss_mb()
+        self.results.append(row)
+        shown = {key: round(value, 2) if isinstance(value, float) else value for key, value in row.items()}
+        print(json.dumps(shown))
+        self.rss_baseline_mb = reset_peak_rss()
+
+    def index(self, size: int):
+        from Utils.question_answering_RAG import IncrementalVectorStore, init_embeddings_model
+
+        if size not in self.indexes:
+            manager = IncrementalVectorStore(init_embeddings_model())
+            manager.sync(synthetic_corpus(self.passages, size))
+            self.indexes[size] = manager
+        return self.indexes[size]
+
+    def ingest(self) -> None:
+        from Utils.question_answering_RAG import IncrementalVectorStore, init_embeddings_model
+
+        for size in self.args.sizes:
+            files = synthetic_corpus(self.passages, size)
+            manager = IncrementalVectorStore(init_embeddings_model())
+            started = time.perf_counter()
+            manager.sync(files)
+            seconds = time.perf_counter() - started
+            chunks = sum(map(len, manager.chunk_ids.values()))
+            self.indexes[size] = manager
+            self.record(
+                "ingest", corpus_size=size, concurrency=1, requests=size, seconds=seconds,
+                throughput=size / seconds, chunks=chunks, chunks_per_second=chunks / seconds,
+            )
+
+    def retrieval(self) -> None:
+        from Utils.question_answering_RAG import HybridRetriever
+
+        for size in self.args.sizes:
+            manager = self.index(size)
+            retriever = HybridRetriever(vector_store=manager.vector_store, lexical_index=manager.lexical_index)
+            for concurrency in self.args.concurrency:
+                result = run_concurrently(retriever.invoke, self.questions, concurrency)
+                self.record("retrieval", corpus_size=size, concurrency=concurrency, **result)
+
+    def index_types(self) -> None:
+        from Utils.vector_index import evaluate_index_types, index_vectors
+
+        for size in self.args.sizes:
+            manager = self.index(size)
+            embeddings = manager.vector_store.embedding_function
+            queries = [embeddings.embed_query(question) for question in self.questions]
+            vectors = index_vectors(manager.vector_store.index)
+            for result in evaluate_index_types(vectors, np.asarray(queries, dtype=np.float32)):
+                self.record("index_types", corpus_size=size, concurrency=1, **result)
+
+    def _qa(self, workload: str, questions: list[str], use_cache: bool) -> None:
+        from Utils.question_answering_RAG import answer_cache, create_qa_model, init_llm_model, init_prompt, qa
+
+        prompt, qa_prompt = init_prompt()
+        for size in self.args.sizes:
+            manager = self.index(size)
+            qa_model = create_qa_model(
+                manager.vector_store, init_llm_model(), prompt, qa_prompt, lexical_index=manager.lexical_index
+            )
+            vector_store = manager.vector_store if use_cache else None
+            for concurrency in self.args.concurrency:
+                answer_cache.invalidate(manager.fingerprint)
+                result = run_concurrently(
+                    lambda question: consume_stream(
+                        qa(question, qa_model, [], vector_store=vector_store, fingerprint=manager.fingerprint)
+                    ),
+                    questions, concurrency,
+                )
+                self.record(workload, corpus_size=size, concurrency=concurrency, **result)
+
+    def qa(self) -> None:
+        self._qa("qa", self.questions, use_cache=False)
+
+    def qa_cached(self) -> None:
+        # A few popular questions asked over and over, as on a shared corpus
+        popular = self.questions[: max(len(self.questions) // 8, 1)]
+        self._qa("qa_cached", [popular[i % len(popular)] for i in range(len(self.questions))], use_cache=True)
+
+    def chat(self) -> None:
+        from Utils.question_answering_RAG import gemini_generate_response, init_gemini_model
+
+        for concurrency in self.args.concurrency:
+            prompts = [f"[{concurrency}] {question}" for question in self.questions]  # Distinct, so nothing is cached
+            result = run_concurrently(
+                lambda prompt: consume_stream(gemini_generate_response(prompt, init_gemini_model(), [])),
+                prompts, concurrency,
+            )
+            self.record("chat", concurrency=concurrency, **result)
+
+    def gateway(self) -> None:
+        from Utils.llm_gateway import GEMINI_MODEL, LLMGateway, to_gemini_request
+        from langchain_core.messages import HumanMessage
+
+        args = self.args
+        stub = stub_server_for(args)
+        url, stop_stub = start_stub_server(stub)
+        # Many sessions asking a few popular questions at once, as when a class shares one corpus
+        popular = self.questions[: max(len(self.questions) // 4, 1)]
+        try:
+            for concurrency in args.concurrency:
+                gateway = LLMGateway(base_url=url, api_key="stub", **gateway_options(args))
+                prompts = [f"[{concurrency}] {popular[i % len(popular)]}" for i in range(len(self.questions))]
+                before = Counter(stub.counts)
+                try:
+                    result = run_concurrently(
+                        lambda prompt: consume_stream(
+                            gateway.stream(GEMINI_MODEL, to_gemini_request([HumanMessage(content=prompt)]))
+                        ),
+                        prompts, concurrency,
+                    )
+                finally:
+                    gateway.close()
+                upstream = Counter(stub.counts) - before
+                self.record(
+                    "gateway", concurrency=concurrency, upstream_requests=upstream["requests"],
+                    rate_limited=upstream["rate_limited"], upstream_errors=upstream["errors"], **result,
+                )
+        finally:
+            stop_stub()
+
+    def summarize(self) -> None:
+        from Utils.summerization import summarize_long
+
+        text = " ".join(self.passages)
+        window = 6000
+        documents = [text[i * 997 % max(len(text) - window, 1):][:window] for i in range(self.args.model_requests)]
+        for concurrency in self.args.concurrency:
+            result = run_concurrently(summarize_long, documents, concurrency)
+            self.record("summarize", concurrency=concurrency, **result)
+
+    def caption(self) -> None:
+        from PIL import Image
+        from Utils.Image_captioning import caption_images
+
+        seed_image = Image.open(os.path.join(SEED_DIR, "test.jpg")).convert("RGB")
+        width, height = seed_image.size
+        for concurrency in self.args.concurrency:
+            # Different crops hash differently, so every request reaches the model
+            images = [
+                seed_image.crop((i * 7 % (width // 4), i * 13 % (height // 4), width - i % 17, height - i % 11))
+                for i in range(concurrency * 1000, concurrency * 1000 + self.args.model_requests)
+            ]
+            result = run_concurrently(lambda image: caption_images([image]), images, concurrency)
+            self.record("caption", concurrency=concurrency, **result)
+
+    def asr(self) -> None:
+        fixtures = [(speech_fixture(seconds=2.0, seed=i), question) for i, question in enumerate(self.questions[:8])]
+        install_fake_speech(fixtures, latency_ms=self.args.speech_latency_ms)
+        from Utils.audio_input import VOSK_MODEL_PATH, listen
+
+        # The fake stands in for the Google API; Vosk runs for real when a model is configured
+        for engine in ["google"] + (["vosk"] if VOSK_MODEL_PATH else []):
+            # One microphone, so utterances are recognized one after another
+            result = run_concurrently(lambda _: listen(engine=engine), range(len(fixtures)), 1)
+            self.record("asr", engine=engine, concurrency=1, **result)
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(results: list[dict], baseline: dict, baseline_path: str) -> None:
+    """Prints the change in throughput and tail latency against an earlier run."""
+    key = lambda row: (
+        row["workload"], row.get("engine") or row.get("index_type"), row.get("corpus_size"), row.get("concurrency")
+    )
+    previous = {key(row): row for row in baseline["results"] if "error" not in row}
+
+    print(f"\nCompared with {baseline['commit']} ({baseline_path}):")
+    print(f"{'workload':<12}{'size':>6}{'conc':>6}{'throughput':>14}{'p95 ms':>14}")
+    for row in results:
+        old = previous.get(key(row))
+        if old is None or "error" in row:
+            continue
+        change = lambda name: f"{(row[name] / old[name] - 1) * 100:+.1f}%" if old.get(name) else "n/a"
+        size = row.get("corpus_size") or ""
+        p95 = change("p95_ms") if "p95_ms" in row else "n/a"
+        print(f"{row['workload']:<12}{size:>6}{row['concurrency']:>6}{change('throughput'):>14}{p95:>14}")
+
+
+def stub_server_for(args: argparse.Namespace) -> GeminiStub:
+    return GeminiStub(
+        latency_ms=args.llm_latency_ms, tokens_per_second=args.llm_tokens_per_second, rpm=args.stub_rpm,
+        error_rate=args.stub_error_rate, slow_rate=args.stub_slow_rate, slow_ms=args.stub_slow_ms,
+    )
+
+
+def gateway_options(args: argparse.Namespace) -> dict:
+    options = {"requests_per_minute": args.llm_rpm}
+    if args.llm_hedge_s is not None:
+        options["hedge_after_s"] = args.llm_hedge_s
+    return options
+
+
+def parse_list(value: str) -> list[int]:
+    return [int(item) for item in value.split(",") if item]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark NismoGen offline against local fakes.")
+    parser.add_argument("--workloads", default=",".join(WORKLOADS), help=f"Comma-separated subset of {WORKLOADS}.")
+    parser.add_argument("--sizes", type=parse_list, default=[10, 100], help="Corpus sizes in files.")
+    parser.add_argument("--concurrency", type=parse_list, default=[1, 4, 16], help="Concurrent requests.")
+    parser.add_argument("--requests", type=int, default=64, help="Requests per retrieval, QA and chat run.")
+    parser.add_argument("--model-requests", type=int, default=8, help="Requests per summarization and captioning run.")
+    parser.add_argument("--llm-latency-ms", type=float, default=300.0, help="Fake LLM time to first token.")
+    parser.add_argument("--llm-tokens-per-second", type=float, default=50.0, help="Fake LLM streaming rate.")
+    parser.add_argument("--llm-backend", choices=("fake", "stub"), default="fake",
+                        help="In-process fake model, or the LLM gateway against the local stub server.")
+    parser.add_argument("--llm-rpm", type=float, default=6000.0, help="Gateway rate limit, in requests per minute.")
+    parser.add_argument("--llm-hedge-s", type=float, help="Gateway hedging delay; 0 disables hedging.")
+    parser.add_argument("--stub-rpm", type=float, default=0, help="Stub server quota before it answers 429.")
+    parser.add_argument("--stub-error-rate", type=float, default=0.0, help="Fraction of stub requests failing with 500.")
+    parser.add_argument("--stub-slow-rate", type=float, default=0.0, help="Fraction of stub requests with a slow first token.")
+    parser.add_argument("--stub-slow-ms", type=float, default=5000.0, help="Time to the first token of slow stub requests.")
+    parser.add_argument("--speech-latency-ms", type=float, default=200.0, help="Fake speech API latency.")
+    parser.add_argument("--real-embeddings", action="store_true", help="Use the real embedding model instead of hashing.")
+    parser.add_argument("--keep-cache", action="store_true", help="Reuse the on-disk caches instead of a fresh directory.")
+    parser.add_argument("--output", help="Results file; defaults to benchmarks/results/<commit>.json.")
+    parser.add_argument("--compare", help="Earlier results file to compare against.")
+    args = parser.parse_args()
+
+    workloads = [name for name in args.workloads.split(",") if name]
+    unknown = set(workloads) - set(WORKLOADS)
+    if unknown:
+        parser.error(f"unknown workloads: {', '.join(sorted(unknown))}")
+
+    baseline = None
+    if args.compare:  # Read before the results are written, which may be to the same file
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    # Caches and corpora go to a scratch directory so earlier runs cannot turn misses into hits
+    if not args.keep_cache:
+        scratch = tempfile.mkdtemp(prefix="nismogen-bench-")
+        os.environ["NISMOGEN_CACHE_DIR"] = scratch
+        os.environ["NISMOGEN_CORPUS_DIR"] = os.path.join(scratch, "corpora")
+
+    if args.llm_backend == "stub":
+        url, _ = start_stub_server(stub_server_for(args))
+        install_stub_gateway(url, **gateway_options(args))
+    else:
+        install_fake_llm(latency_ms=args.llm_latency_ms, tokens_per_second=args.llm_tokens_per_second)
+    if not args.real_embeddings:
+        install_fake_embeddings()
+
+    benchmarks = Benchmarks(args)
+    for workload in workloads:
+        benchmarks.start_workload()
+        try:
+            getattr(benchmarks, workload)()
+        except Exception as e:  # A missing model or optional dependency skips only its workload
+            benchmarks.record(workload, error=f"{type(e).__name__}: {e}")
+
+    from Utils import tracing
+    commit = git_commit()
+    report = {
+        "commit": commit,
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "machine": {"platform": platform.platform(), "cpus": os.cpu_count()},
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        "results": benchmarks.results,
+        "stages": tracing.summary(),
+    }
+    output = args.output or os.path.join(RESULTS_DIR, f"{commit}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+
+    if baseline is not None:
+        compare(benchmarks.results, baseline, args.compare)
+
+
+if __name__ == "__main__":
+    main()
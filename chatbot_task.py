@@ -1,26 +1,32 @@
 import streamlit as st
 from langchain_core.runnables import Runnable
 from Utils.question_answering_RAG import (
-    qa, init_llm_model, init_embeddings_model, create_vector_store, create_qa_model, init_prompt, gemini_generate_response, init_gemini_model
+    qa, init_llm_model, init_embeddings_model, create_qa_model, init_prompt, gemini_generate_response, init_gemini_model,
+    IncrementalVectorStore, corpus_fingerprint, file_digest
+)
+from Utils.vector_index import (
+    DEFAULT_INDEX_TYPE, INDEX_TYPES, list_corpora, open_corpus, save_corpus
 )
 from Utils.summerization import summarize, summarize_pdf
-from Utils.Image_captioning import query
+from Utils.Image_captioning import caption_images
 from Utils.audio_input import listen
-from Utils.audio_output import speak
+from Utils.audio_output import speak, tts_service
+from Utils.model_registry import configure_from_env, registry
+from Utils import tracing
 from Utils.utils import read_file, read_text, read_pdf, read_csv, read_arxiv, read_markdown, get_file_extension 
 from streamlit.runtime.uploaded_file_manager import UploadedFile
 from PIL import Image
 
 #===========================================Session State================================================
-llm_model = init_llm_model()
-embedding_model = init_embeddings_model()
+# Models are loaded on first use and shared by all sessions; see Utils/model_registry.py
+configure_from_env()
 prompt, qa_prompt = init_prompt()
 
 if "messages" not in st.session_state:
     st.session_state.messages = []
 
-if "audio_file" not in st.session_state:
-    st.session_state.audio_file = ""
+if "recorded_audio" not in st.session_state:
+    st.session_state.recorded_audio = None  # WAV bytes of the last recording, kept in memory
 
 if "recognized_text" not in st.session_state:
     st.session_state.recognized_text = ""
@@ -31,6 +37,21 @@ if "qa_model" not in st.session_state:
 if "vector_store" not in st.session_state:
     st.session_state.vector_store = None
 
+if "corpus_fingerprint" not in st.session_state:
+    st.session_state.corpus_fingerprint = None
+
+if "index_manager" not in st.session_state:
+    st.session_state.index_manager = None
+
+if "corpus" not in st.session_state:
+    st.session_state.corpus = None
+
+if "summary" not in st.session_state:
+    st.session_state.summary = ""
+
+if "pdf_summary" not in st.session_state:
+    st.session_state.pdf_summary = (None, "")  # (content hash of the PDF, its summary)
+
 #==========================================Streamlit App=================================================
 # Add logo
 logo = Image.open("./documents/logo.png")
@@ -58,11 +79,33 @@ st.sidebar.markdown(
     "##### [Gitlab](https://github.com/adhamahmed46) | [Email](mailto:addham.taha@gmail.com)"
 )
 
+# Display the load state of the shared models
+with st.sidebar.expander("Model status"):
+    for name, stats in registry.stats().items():
+        if stats["loaded"]:
+            st.write(f"**{name}**: loaded in {stats['load_seconds']:.1f}s, {stats['memory_bytes'] / 2**20:.0f} MiB")
+        else:
+            st.write(f"**{name}**: not loaded")
+
+# Display per-stage latencies of recent requests in this process
+with st.sidebar.expander("Latency"):
+    for stage, stats in sorted(tracing.summary().items()):
+        st.write(f"**{stage}**: p50 {stats['p50_ms']:.0f} ms, p95 {stats['p95_ms']:.0f} ms ({stats['count']} calls)")
+
 #===========================================Question Answering===========================================
 if task_name == "Question Answering":
-    uploaded_files = st.file_uploader(
-        "Upload documents for context", type=["txt", "pdf", "csv"], accept_multiple_files=True
-    )
+    llm_model = init_llm_model()
+    embedding_model = init_embeddings_model()
+    if st.session_state.index_manager is None:
+        st.session_state.index_manager = IncrementalVectorStore(embedding_model)
+
+    # Choose between this session's uploads and a shared corpus saved on disk
+    corpus_name = st.selectbox("Document source:", ["Uploaded files"] + list_corpora())
+    uploaded_files = []
+    if corpus_name == "Uploaded files":
+        uploaded_files = st.file_uploader(
+            "Upload documents for context", type=["txt", "pdf", "csv"], accept_multiple_files=True
+        )
     st.divider()
 
     # Select input method (text or audio)
@@ -73,20 +116,45 @@ if task_name == "Question Answering":
     if input_method == "Audio":
         st.write("### Audio Input")
         if st.button("Record Audio"):
-            recognized_text, audio_file_path = listen()
-            st.session_state.audio_file = audio_file_path
-            st.session_state.recognized_text = recognized_text
-            st.write(f"Recognized text: **{recognized_text}**")
-            st.audio(st.session_state.audio_file)
-
-    # Process uploaded files
-    if uploaded_files:
-        st.write("Processing files...")
-        st.session_state.vector_store = create_vector_store(uploaded_files, embedding_model) # Create a vector store from the uploaded files
-        st.session_state.qa_model = create_qa_model(  # Create the QA model
-            st.session_state.vector_store, llm_model, prompt, qa_prompt
-        )
-        st.write("Files processed successfully!")
+            transcript = st.empty()  # Shows the partial transcript while the user is speaking
+            recognized_text, recorded_audio = listen(on_partial=lambda text: transcript.markdown(f"*{text}...*"))
+            transcript.write(f"Recognized text: **{recognized_text}**")
+            if recorded_audio is not None:
+                st.session_state.recorded_audio = recorded_audio
+                st.session_state.recognized_text = recognized_text  # Submitted as the query below, in this same run
+                st.audio(recorded_audio, format="audio/wav")
+
+    if corpus_name != "Uploaded files":
+        # Open the shared corpus memory-mapped; all sessions in the process reuse the same copy,
+        # and a version saved since the last rerun, by any process, replaces it
+        vector_store, lexical_index = open_corpus(corpus_name, embedding_model)
+        if st.session_state.corpus != corpus_name or st.session_state.vector_store is not vector_store:
+            st.session_state.vector_store = vector_store
+            st.session_state.corpus_fingerprint = corpus_fingerprint(vector_store)
+            st.session_state.qa_model = create_qa_model(
+                vector_store, llm_model, prompt, qa_prompt, lexical_index=lexical_index
+            )
+            st.session_state.corpus = corpus_name
+    # Process uploaded files, embedding only the ones not indexed yet
+    elif st.session_state.index_manager.sync(uploaded_files or []) or st.session_state.corpus is not None:
+        st.session_state.corpus = None
+        st.session_state.vector_store = st.session_state.index_manager.vector_store
+        st.session_state.corpus_fingerprint = st.session_state.index_manager.fingerprint
+        st.session_state.qa_model = None
+        if st.session_state.vector_store is not None:
+            st.session_state.qa_model = create_qa_model(  # Rebuild the QA model only when the index changed
+                st.session_state.vector_store, llm_model, prompt, qa_prompt,
+                lexical_index=st.session_state.index_manager.lexical_index
+            )
+            st.write("Files processed successfully!")
+
+    # Save the uploaded files as a shared corpus for other sessions
+    if corpus_name == "Uploaded files" and st.session_state.index_manager.vector_store is not None:
+        new_corpus_name = st.text_input("Save as shared corpus:", placeholder="corpus-name")
+        index_type = st.selectbox("Index type:", INDEX_TYPES, index=INDEX_TYPES.index(DEFAULT_INDEX_TYPE))
+        if st.button("Save Corpus") and new_corpus_name:
+            save_corpus(new_corpus_name, st.session_state.index_manager.vector_store, index_type=index_type)
+            st.write(f"Saved corpus **{new_corpus_name}**.")
 
     # Button to start a new chat
     if st.button("Start New Chat"):
@@ -99,24 +167,35 @@ if task_name == "Question Answering":
             st.markdown(message["content"])
 
     # Input for user queries (Text and Audio both handled here)
-    if prompt_text := st.chat_input(placeholder="Ask a question...") or st.session_state.recognized_text:
+    if prompt_text := st.chat_input(placeholder="Ask a question...") or st.session_state.pop("recognized_text", ""):
         st.session_state.messages.append({"role": "user", "content": prompt_text})
         st.chat_message("user", avatar="🧑‍💻").markdown(prompt_text)
 
         # Generate response
         if st.session_state.qa_model:
             response = ""
-            with st.chat_message("assistant", avatar="🤖"):
-                with st.spinner("Generating response..."):
-                    generator = qa(prompt_text, st.session_state.qa_model, st.session_state.messages)
-                for chunk in generator:
-                    response += chunk
-                st.write(response)
+            with st.chat_message("assistant", avatar="🤖"), tracing.span("ui_turn", task="qa"):
+                placeholder = st.empty()
+                placeholder.markdown("Generating response...")
+                try:
+                    for chunk in qa(
+                        prompt_text, st.session_state.qa_model, st.session_state.messages,
+                        vector_store=st.session_state.vector_store, fingerprint=st.session_state.corpus_fingerprint
+                    ):
+                        response += chunk
+                        placeholder.markdown(response + "▌")  # Render tokens as they arrive
+                    placeholder.markdown(response)
+                except Exception as e:
+                    placeholder.error(f"Error answering the question: {str(e)}")
             
-            # Append and play the response
+            # Append the response and start rendering its audio in the background
             st.session_state.messages.append({"role": "assistant", "content": response})
-            if st.button("Play Response Audio"):
-                speak(response)
+            tts_service.prefetch(response)
+
+    # Play the last response; the button survives the rerun its click triggers
+    if st.session_state.messages and st.session_state.messages[-1]["role"] == "assistant":
+        if st.button("Play Response Audio"):
+            st.audio(speak(st.session_state.messages[-1]["content"]), format="audio/wav")
 
 #==========================================Normal Chatbot================================================
 elif task_name == "Normal Chatbot":
@@ -139,29 +218,36 @@ elif task_name == "Normal Chatbot":
     # Add audio input button
     st.write("### Audio Input")
     if st.button("Record Audio"):
-        recognized_text, audio_file_path = listen()
-        st.session_state.audio_file = audio_file_path
-        st.session_state.recognized_text = recognized_text
-        st.write(f"Recognized text: **{recognized_text}**")
-        st.audio(st.session_state.audio_file)
+        transcript = st.empty()  # Shows the partial transcript while the user is speaking
+        recognized_text, recorded_audio = listen(on_partial=lambda text: transcript.markdown(f"*{text}...*"))
+        transcript.write(f"Recognized text: **{recognized_text}**")
+        if recorded_audio is not None:
+            st.session_state.recorded_audio = recorded_audio
+            st.session_state.recognized_text = recognized_text  # Submitted as the query below, in this same run
+            st.audio(recorded_audio, format="audio/wav")
 
     # Input for user queries
-    if prompt_text := st.chat_input(placeholder="Ask a question...") or st.session_state.recognized_text:
+    if prompt_text := st.chat_input(placeholder="Ask a question...") or st.session_state.pop("recognized_text", ""):
         st.session_state.messages.append({"role": "user", "content": prompt_text})
         st.chat_message("user", avatar="🧑‍💻").markdown(prompt_text)
 
         # Generate response
         response = ""
-        with st.chat_message("assistant", avatar="🤖"):
-            with st.spinner("Generating response..."):
-                response = gemini_generate_response(prompt_text, st.session_state.gemini_model, st.session_state.messages)
-                st.write(response)
+        with st.chat_message("assistant", avatar="🤖"), tracing.span("ui_turn", task="chat"):
+            placeholder = st.empty()
+            placeholder.markdown("Generating response...")
+            for chunk in gemini_generate_response(prompt_text, st.session_state.gemini_model, st.session_state.messages):
+                response += chunk
+                placeholder.markdown(response + "▌")  # Render tokens as they arrive
+            placeholder.markdown(response)
 
         st.session_state.messages.append({"role": "assistant", "content": response})
+        tts_service.prefetch(response)  # Render the audio in the background
 
-        # Play response audio
+    # Play the last response; the button survives the rerun its click triggers
+    if st.session_state.messages and st.session_state.messages[-1]["role"] == "assistant":
         if st.button("Play Response Audio"):
-            speak(response)
+            st.audio(speak(st.session_state.messages[-1]["content"]), format="audio/wav")
 
 
 #===========================================Text Summarization===========================================   
@@ -178,24 +264,31 @@ elif task_name == "Text Summarization":
         file_extension = get_file_extension(uploaded_file.name).lower()
 
         try:
-            if file_extension == ".pdf":
-                st.write("Processing PDF...")
-                summary = summarize_pdf(uploaded_file)
+            if file_extension == "pdf":
+                digest = file_digest(uploaded_file)
+                if st.session_state.pdf_summary[0] != digest:  # Summarize once, not on every rerun
+                    st.write("Processing PDF...")
+                    progress_bar = st.progress(0)
+                    st.session_state.pdf_summary = (digest, summarize_pdf(
+                        uploaded_file, progress_callback=lambda level, done, total: progress_bar.progress(done / total)
+                    ))
+                summary = st.session_state.pdf_summary[1]
                 st.write("**Summary:**")
                 st.write(summary)
 
                 # Add Audio Output Button
-                if st.button("Play Summary Audio"):
-                    speak(summary)
-            elif file_extension == ".csv":
+                tts_service.prefetch(summary)
+                if st.button("Play Summary Audio", key="play_pdf_summary"):
+                    st.audio(speak(summary), format="audio/wav")
+            elif file_extension == "csv":
                 text = read_csv(uploaded_file)
-            elif file_extension == ".arxiv":
+            elif file_extension == "arxiv":
                 text = read_arxiv(uploaded_file)
-            elif file_extension == ".md":
+            elif file_extension == "md":
                 text = read_markdown(uploaded_file)
-            elif file_extension == ".docx":
+            elif file_extension == "docx":
                 text = read_file(uploaded_file)  # Add a specific function if `docx` handling is unique
-            elif file_extension == ".json":
+            elif file_extension == "json":
                 text = uploaded_file.read().decode("utf-8")  # Simple decoding for JSON files
             else:
                 st.error("Unsupported file type. Please upload a valid file.")
@@ -205,32 +298,38 @@ elif task_name == "Text Summarization":
     # Summarize the text
     if st.button("Summarize"):
         if text.strip():
-            summary = summarize(text)
-            st.write("**Summary:**")
-            st.write(summary)
-
-            # Add Audio Output Button
-            if st.button("Play Summary Audio"):
-                speak(summary)
+            st.session_state.summary = summarize(text)
+            tts_service.prefetch(st.session_state.summary)
         else:
             st.error("Please provide text or upload a file for summarization.")
 
+    # Kept in the session so the audio button still has it after the rerun its click triggers
+    if st.session_state.summary:
+        st.write("**Summary:**")
+        st.write(st.session_state.summary)
+
+        # Add Audio Output Button
+        if st.button("Play Summary Audio", key="play_text_summary"):
+            st.audio(speak(st.session_state.summary), format="audio/wav")
+
 
 #===========================================Image Captioning=============================================   
 elif task_name == "Image Captioning":
     # Streamlit file uploader
-    uploaded_file = st.file_uploader("Choose an image...", type=["jpg", "jpeg", "png"])
+    uploaded_files = st.file_uploader("Choose images...", type=["jpg", "jpeg", "png"], accept_multiple_files=True)
     
-    if uploaded_file is not None:
-        image = Image.open(uploaded_file)
-        caption = query(image)
-        col1, col2 = st.columns([1, 2])
-        with col1:
-            st.image(image, use_container_width=True, caption="Uploaded Image")
-        with col2:
-            st.write("**Caption:**")
-            st.write(caption)
-            
-            # Add Audio Output Button
-            if st.button("Play Caption Audio"):
-                speak(caption)
\ No newline at end of file
+    if uploaded_files:
+        images = [Image.open(uploaded_file) for uploaded_file in uploaded_files]
+        captions = caption_images(images)  # Batched; images captioned before come from the cache
+        for i, (image, caption) in enumerate(zip(images, captions)):
+            col1, col2 = st.columns([1, 2])
+            with col1:
+                st.image(image, use_container_width=True, caption="Uploaded Image")
+            with col2:
+                st.write("**Caption:**")
+                st.write(caption)
+                
+                # Add Audio Output Button
+                tts_service.prefetch(caption)
+                if st.button("Play Caption Audio", key=f"play_caption_{i}"):
+                    st.audio(speak(caption), format="audio/wav")
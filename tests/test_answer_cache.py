@@ -0,0 +1,51 @@
+import pytest
+
+pytest.importorskip("streamlit")
+pytest.importorskip("dotenv")
+from langchain_community.vectorstores import FAISS
+
+from benchmarks.fakes import FakeChatModel, HashEmbeddings
+from Utils.bm25 import BM25Index
+from Utils.question_answering_RAG import AnswerCache, create_qa_model, identifiers, init_prompt, qa
+
+
+class CountingEmbeddings(HashEmbeddings):
+    def __init__(self):
+        super().__init__()
+        self.queries = 0
+
+    def embed_query(self, text: str) -> list[float]:
+        self.queries += 1
+        return super().embed_query(text)
+
+
+def test_identifiers():
+    assert identifiers("What does error AB-1234 mean on the 2019 GT-R?") == {"ab-1234", "2019"}
+    assert identifiers("How do I change the oil?") == frozenset()
+
+
+def test_semantic_hit_requires_same_identifiers():
+    cache = AnswerCache(threshold=0.9)
+    vector = [1.0, 0.0]
+    cache.store("corpus", "What does error AB-1234 mean?", vector, "Low oil pressure")
+
+    assert cache.lookup("corpus", "what does error AB-1234 mean", vector) == "Low oil pressure"
+    assert cache.lookup("corpus", "What does error AB-1235 mean?", vector) is None
+    assert cache.lookup("other corpus", "What does error AB-1234 mean?", vector) is None
+
+
+@pytest.mark.parametrize("hybrid", [False, True])
+def test_question_is_embedded_once(hybrid):
+    texts = ["Error AB-1234 means low oil pressure.", "Rotate the tyres every 5000 miles."]
+    embeddings = CountingEmbeddings()
+    vector_store = FAISS.from_texts(texts, embeddings, ids=["a", "b"])
+    embeddings.queries = 0
+    lexical_index = BM25Index(["a", "b"], texts) if hybrid else None
+    prompt, qa_prompt = init_prompt()
+    qa_model = create_qa_model(
+        vector_store, FakeChatModel(latency_ms=0, tokens_per_second=10_000), prompt, qa_prompt,
+        lexical_index=lexical_index,
+    )
+
+    assert "".join(qa(f"What is error AB-1234? ({hybrid})", qa_model, [], vector_store=vector_store))
+    assert embeddings.queries == 1
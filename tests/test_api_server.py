@@ -0,0 +1,57 @@
+import asyncio
+import json
+import os
+
+import pytest
+
+pytest.importorskip("streamlit")
+from aiohttp.test_utils import TestClient, TestServer
+
+import api_server
+
+DOCUMENTS_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "documents")
+
+
+def request(method: str, path: str, **kwargs) -> tuple[int, str]:
+    """Sends one request to a fresh APIServer and returns the status and body."""
+    async def send():
+        async with TestClient(TestServer(api_server.APIServer(2, 2, 4).app())) as client:
+            response = await client.request(method, path, **kwargs)
+            return response.status, await response.text()
+    return asyncio.run(send())
+
+
+def test_summarize_pdf(monkeypatch):
+    monkeypatch.setattr("Utils.summerization.summarize_long", lambda text, progress_callback=None: text[:20])
+    with open(os.path.join(DOCUMENTS_DIR, "Towards understanding how attention mechanism works in deep learning.pdf"), "rb") as f:
+        status, body = request("POST", "/summarize/pdf", data=f.read())
+
+    assert status == 200
+    events = [json.loads(line) for line in body.splitlines()]
+    assert events[-1]["summary"]
+
+
+@pytest.mark.parametrize("history", [["hi"], [{"role": "user"}], [{"role": "user", "content": 1}], {"role": "user"}])
+def test_invalid_history_is_rejected(history):
+    status, body = request("POST", "/chat", json={"message": "hi", "history": history})
+    assert status == 400
+    assert "history" in json.loads(body)["error"]
+
+
+def test_truncated_image_is_rejected():
+    with open(os.path.join(DOCUMENTS_DIR, "test.jpg"), "rb") as f:
+        data = f.read()
+    status, body = request("POST", "/caption", data=data[: len(data) // 2])
+    assert status == 400
+    assert json.loads(body) == {"error": "Request body is not a supported image"}
+
+
+def test_captioning_failure_is_a_json_error(monkeypatch):
+    def fail(images):
+        raise RuntimeError("batcher stopped")
+
+    monkeypatch.setattr(api_server, "caption_images", fail)
+    with open(os.path.join(DOCUMENTS_DIR, "test.jpg"), "rb") as f:
+        status, body = request("POST", "/caption", data=f.read())
+    assert status == 500
+    assert json.loads(body) == {"error": "Captioning failed: batcher stopped"}
@@ -0,0 +1,84 @@
+import io
+import struct
+import threading
+import wave
+
+import numpy as np
+
+from Utils.audio_output import TTSService, aiff_to_wav
+
+
+def extended_float(value: int) -> bytes:
+    exponent = value.bit_length() - 1
+    return struct.pack(">HQ", exponent + 16383, value << (63 - exponent))
+
+
+def aiff(samples: np.ndarray, sample_rate: int = 22050) -> bytes:
+    comm = struct.pack(">hLh", 1, len(samples), 16) + extended_float(sample_rate)
+    ssnd = struct.pack(">LL", 0, 0) + samples.astype(">i2").tobytes()
+    body = b"AIFF" + b"COMM" + struct.pack(">L", len(comm)) + comm + b"SSND" + struct.pack(">L", len(ssnd)) + ssnd
+    return b"FORM" + struct.pack(">L", len(body)) + body
+
+
+def wav(text: str) -> bytes:
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as output:
+        output.setnchannels(1)
+        output.setsampwidth(2)
+        output.setframerate(8000)
+        output.writeframes(text.encode("utf-8"))
+    return buffer.getvalue()
+
+
+def test_aiff_to_wav():
+    samples = np.array([0, 1000, -1000, 32767], dtype=np.int16)
+    with wave.open(io.BytesIO(aiff_to_wav(aiff(samples))), "rb") as result:
+        assert (result.getnchannels(), result.getsampwidth(), result.getframerate()) == (1, 2, 22050)
+        assert np.array_equal(np.frombuffer(result.readframes(result.getnframes()), dtype="<i2"), samples)
+
+
+class Engine:
+    """Writes each sentence as a WAV; renders wait until released."""
+
+    def __init__(self, release: threading.Event, rendered: list):
+        self.release = release
+        self.rendered = rendered
+        self.started = threading.Event()
+        self.queued = []
+
+    def save_to_file(self, sentence, path):
+        self.started.set()
+        self.queued.append((sentence, path))
+
+    def runAndWait(self):
+        self.release.wait(5)
+        for sentence, path in self.queued:
+            self.rendered.append(sentence)
+            with open(path, "wb") as f:
+                f.write(wav(sentence))
+        self.queued.clear()
+
+
+def test_play_is_rendered_before_prefetch():
+    release, rendered = threading.Event(), []
+    engine = Engine(release, rendered)
+    service = TTSService(engine_factory=lambda: engine)
+    service.prefetch("First. Second. Third.")
+    assert engine.started.wait(5)  # "First." is being rendered
+    play = service.render("Play now.")
+    promoted = service.render("Third.")
+    release.set()
+
+    play.result(timeout=5)
+    promoted.result(timeout=5)
+    assert rendered[:3] == ["First.", "Play now.", "Third."]
+
+
+def test_prefetch_is_dropped_when_busy():
+    release, rendered = threading.Event(), []
+    service = TTSService(engine_factory=lambda: Engine(release, rendered), max_prefetch=2)
+    service.prefetch("One. Two. Three. Four. Five. Six.")
+    # At most one prefetch started rendering while the limit of two more waited; the rest were dropped
+    assert service.stats()["misses"] <= 3
+    release.set()
+    assert service.render("Seven.").result(timeout=5)
@@ -0,0 +1,40 @@
+import pytest
+
+from Utils.batching import MicroBatcher, get_batcher
+
+
+def test_results_returned_in_order():
+    batcher = MicroBatcher("double", lambda items: [item * 2 for item in items], max_batch_size=4)
+    assert batcher.map([1, 2, 3, 4, 5]) == [2, 4, 6, 8, 10]
+
+
+def test_result_count_mismatch_fails_every_future():
+    batcher = MicroBatcher("short", lambda items: items[:-1], max_batch_size=4, max_wait_ms=50)
+    futures = [batcher.submit(item) for item in range(3)]
+    for future in futures:
+        with pytest.raises(RuntimeError, match="2 results for 3 items"):
+            future.result(timeout=5)
+
+
+@pytest.mark.filterwarnings("ignore::pytest.PytestUnhandledThreadExceptionWarning")  # The SystemExit ends the first worker
+def test_worker_survives_base_exception():
+    calls = []
+
+    def process_batch(items):
+        calls.append(items)
+        if len(calls) == 1:
+            raise SystemExit
+        return items
+
+    batcher = MicroBatcher("exit", process_batch, max_batch_size=1)
+    with pytest.raises(RuntimeError, match="stopped"):
+        batcher.submit("first").result(timeout=5)
+    assert batcher.submit("second").result(timeout=5) == "second"
+
+
+def test_settings_are_part_of_the_key():
+    small = get_batcher("test-key", lambda items: items, max_batch_size=2)
+    large = get_batcher("test-key", lambda items: items, max_batch_size=16)
+    assert small is not large
+    assert (small.max_batch_size, large.max_batch_size) == (2, 16)
+    assert get_batcher("test-key", lambda items: items, max_batch_size=2) is small
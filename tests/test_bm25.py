@@ -0,0 +1,45 @@
+from Utils.bm25 import BM25Index, tokenize
+
+CHUNKS = {
+    "a:0": "Replace the AB-1234 oil filter every 5000 miles.",
+    "a:1": "Error code E_042.7 means the turbo pressure sensor failed.",
+    "b:0": "The Nismo GT-R has a twin-turbo V6 engine.",
+    "b:1": "Check the oil level before every track day.",
+    "c:0": "Tyre pressure should be checked when the tyres are cold.",
+}
+QUERIES = ["oil filter", "turbo", "AB-1234", "E_042.7 sensor", "tyre pressure", "engine"]
+
+
+def build(ids):
+    return BM25Index(ids, [CHUNKS[chunk_id] for chunk_id in ids])
+
+
+def assert_same_results(index, expected):
+    for query in QUERIES:
+        assert index.search(query) == expected.search(query), query
+
+
+def test_tokenize_keeps_identifiers():
+    assert tokenize("Part AB-1234, code E_042.7!") == ["part", "ab-1234", "code", "e_042.7"]
+
+
+def test_add_matches_full_build():
+    index = build(["a:0", "a:1"])
+    index.add(["b:0", "b:1", "c:0"], [CHUNKS["b:0"], CHUNKS["b:1"], CHUNKS["c:0"]])
+    assert_same_results(index, build(list(CHUNKS)))
+
+
+def test_remove_matches_full_build():
+    index = build(list(CHUNKS))
+    index.remove(["a:0", "a:1"])
+    assert len(index) == 3
+    assert_same_results(index, build(["b:0", "b:1", "c:0"]))
+    assert "ab-1234" not in index.postings
+
+
+def test_save_and_load(tmp_path):
+    index = build(list(CHUNKS))
+    index.save(str(tmp_path / "bm25"))
+    loaded = BM25Index.load(str(tmp_path / "bm25"))
+    assert loaded.ids == index.ids
+    assert_same_results(loaded, index)
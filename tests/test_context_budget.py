@@ -0,0 +1,28 @@
+import json
+
+from langchain_core.documents import Document
+from langchain_core.messages import AIMessage, HumanMessage
+
+from Utils import tracing
+from Utils.context_budget import compress_context, estimate_tokens, window_history
+
+
+def test_savings_are_recorded_per_request(tmp_path, monkeypatch):
+    trace_log = tmp_path / "trace.jsonl"
+    monkeypatch.setattr(tracing, "TRACE_LOG", str(trace_log))
+    documents = [Document(page_content=f"Passage {i}. " + "word " * 400, metadata={"source": str(i)}) for i in range(4)]
+    history = [
+        message for i in range(20)
+        for message in (HumanMessage(content=f"Question {i}? " + "a " * 100), AIMessage(content="b " * 200))
+    ]
+
+    with tracing.span("qa"):
+        kept = compress_context(documents, max_tokens=600)
+        window = window_history(history, max_tokens=300)
+
+    spans = {record["name"]: record for record in map(json.loads, trace_log.read_text().splitlines())}
+    assert spans["compress_context"]["parent_id"] == spans["window_history"]["parent_id"] == spans["qa"]["span_id"]
+    context, history_budget = spans["compress_context"]["attrs"], spans["window_history"]["attrs"]
+    assert context["tokens_before"] > context["tokens_after"] == sum(estimate_tokens(d.page_content) for d in kept)
+    assert history_budget["tokens_before"] > history_budget["tokens_after"]
+    assert len(window) < len(history)
@@ -0,0 +1,54 @@
+import numpy as np
+
+from Utils.embedding_cache import EmbeddingCache, text_digest
+
+
+def vector(value: float) -> np.ndarray:
+    return np.full(4, value, dtype=np.float32)
+
+
+def test_hit_protects_entry_from_eviction(tmp_path):
+    cache = EmbeddingCache("test-model", cache_dir=str(tmp_path), max_entries=2)
+    a, b, d = text_digest("a"), text_digest("b"), text_digest("d")
+
+    cache.put_many({a: vector(1)})
+    cache.put_many({b: vector(2)})
+    assert set(cache.get_many([a])) == {a}
+    cache.put_many({d: vector(4)})
+
+    found = cache.get_many([a, b, d])
+    assert set(found) == {a, d}
+    np.testing.assert_allclose(found[a], vector(1))
+
+
+def test_recency_survives_reopening(tmp_path):
+    cache = EmbeddingCache("test-model", cache_dir=str(tmp_path), max_entries=2)
+    a, b, d = text_digest("a"), text_digest("b"), text_digest("d")
+    cache.put_many({a: vector(1), b: vector(2)})
+    cache.get_many([a])
+    cache.put_many({d: vector(4)})
+
+    reopened = EmbeddingCache("test-model", cache_dir=str(tmp_path), max_entries=2)
+    assert set(reopened.get_many([a, b, d])) == {a, d}
+
+
+def test_rows_written_by_another_instance_are_found(tmp_path):
+    reader = EmbeddingCache("test-model", cache_dir=str(tmp_path), max_entries=4)
+    writer = EmbeddingCache("test-model", cache_dir=str(tmp_path), max_entries=4)
+    a, b = text_digest("a"), text_digest("b")
+
+    writer.put_many({a: vector(1)})
+    assert set(reader.get_many([a, b])) == {a}
+    writer.put_many({b: vector(2)})
+    np.testing.assert_allclose(reader.get_many([b])[b], vector(2))
+
+
+def test_rewritten_row_is_not_read_with_old_key(tmp_path):
+    cache = EmbeddingCache("test-model", cache_dir=str(tmp_path), max_entries=1)
+    a, b = text_digest("a"), text_digest("b")
+    cache.put_many({a: vector(1)})
+
+    cache.keys[0] = 0  # What a reader sees while another process rewrites the row
+    assert cache.get_many([a]) == {}
+    cache.put_many({b: vector(2)})
+    assert set(cache.get_many([a, b])) == {b}
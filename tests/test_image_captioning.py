@@ -0,0 +1,23 @@
+import io
+import os
+
+from PIL import Image
+
+from Utils.Image_captioning import image_hash
+
+IMAGE_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "documents", "test.jpg")
+
+
+def test_lossless_copy_has_same_hash():
+    image = Image.open(IMAGE_PATH)
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG")
+    assert image_hash(Image.open(io.BytesIO(buffer.getvalue()))) == image_hash(image)
+
+
+def test_one_changed_pixel_changes_hash():
+    image = Image.open(IMAGE_PATH).convert("RGB")
+    edited = image.copy()
+    r, g, b = edited.getpixel((0, 0))
+    edited.putpixel((0, 0), (255 - r, g, b))
+    assert image_hash(edited) != image_hash(image)
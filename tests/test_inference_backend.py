@@ -0,0 +1,77 @@
+"""
+Equivalence of the int8 and ONNX backends with the fp32 PyTorch models.
+
+These load the real models, so they are skipped unless the weights are already in
+the Hugging Face cache (and, for ONNX, unless optimum is installed).
+"""
+import os
+
+import pytest
+
+from Utils.inference_backend import compare_backends, token_overlap
+
+# Mean ROUGE-1 F1 between a backend's outputs and the fp32 outputs below which it fails
+MIN_OVERLAP = 0.8
+
+DOCUMENTS_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "documents")
+
+PASSAGES = [
+    "The Nissan GT-R is a high-performance sports car produced by Nissan since 2007. It is powered by a "
+    "twin-turbocharged 3.8 litre V6 engine and uses an all-wheel-drive system that sends power to the rear "
+    "wheels under normal driving and to the front wheels when the rear wheels slip. The Nismo version adds "
+    "larger turbochargers, a stiffer suspension and carbon-fibre body panels to reduce weight.",
+    "Regular maintenance keeps a car reliable. Engine oil should be changed every 5,000 to 7,500 miles, tyres "
+    "should be rotated at the same interval, and brake pads inspected at least once a year. Skipping these "
+    "checks can lead to worn components, lower fuel economy and expensive repairs later on.",
+]
+
+
+def require_weights(model_name: str) -> None:
+    pytest.importorskip("transformers")
+    huggingface_hub = pytest.importorskip("huggingface_hub")
+    if not isinstance(huggingface_hub.try_to_load_from_cache(model_name, "config.json"), str):
+        pytest.skip(f"{model_name} is not in the Hugging Face cache")
+
+
+def test_token_overlap():
+    assert token_overlap("the car is fast", "the car is fast") == 1.0
+    assert token_overlap("the car is fast", "a boat") == 0.0
+    assert 0 < token_overlap("the car is fast", "the car is red") < 1
+
+
+@pytest.mark.parametrize("backend", ["int8", "onnx"])
+def test_summarizer_backend_matches_fp32(backend):
+    pytest.importorskip("streamlit")
+    from Utils.summerization import SUMMARIZATION_MODEL_NAME, chunk_token_ids, generate_summaries, load_summarizer
+
+    require_weights(SUMMARIZATION_MODEL_NAME)
+    if backend == "onnx":
+        pytest.importorskip("optimum.onnxruntime")
+
+    def summarize(summarizer, passage):
+        return generate_summaries(chunk_token_ids(summarizer[0], passage), summarizer)[0]
+
+    result = compare_backends(load_summarizer, summarize, PASSAGES, backend, MIN_OVERLAP)
+    assert result["passed"], result
+
+
+def test_captioner_int8_matches_fp32():
+    from PIL import Image
+
+    from Utils.Image_captioning import CAPTIONING_MODEL_NAME, generate_captions, load_captioner
+
+    require_weights(CAPTIONING_MODEL_NAME)
+    images = [Image.open(os.path.join(DOCUMENTS_DIR, "test.jpg")).convert("RGB")]
+
+    def caption(captioner, image):
+        return generate_captions([image], captioner)[0]
+
+    result = compare_backends(load_captioner, caption, images, "int8", MIN_OVERLAP)
+    assert result["passed"], result
+
+
+def test_captioner_rejects_onnx():
+    from Utils.inference_backend import load_image_to_text_model
+
+    with pytest.raises(ValueError):
+        load_image_to_text_model("Salesforce/blip-image-captioning-large", "onnx")
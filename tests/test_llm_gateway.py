@@ -0,0 +1,122 @@
+import threading
+import time
+
+import pytest
+from aiohttp import web
+
+from benchmarks.gemini_stub import GeminiStub, start_stub_server
+from Utils.llm_gateway import LLMGateway, LLMGatewayError
+
+REQUEST = {"contents": [{"role": "user", "parts": [{"text": "How fast is the Nismo GT-R?"}]}]}
+
+
+class ScriptedStub(GeminiStub):
+    """Answers its first requests as scripted: an HTTP status to fail with, or "slow" for a slow first token."""
+
+    def __init__(self, script: list, **kwargs):
+        super().__init__(**kwargs)
+        self.script = list(script)
+
+    async def generate(self, request: web.Request) -> web.StreamResponse:
+        action = self.script.pop(0) if self.script else None
+        if isinstance(action, int):
+            self.counts["requests"] += 1
+            return web.json_response(
+                {"error": {"code": action, "message": "Scripted failure"}},
+                status=action, headers={"Retry-After": "60"} if action == 429 else None,
+            )
+        self.slow_rate = 1.0 if action == "slow" else 0.0
+        return await super().generate(request)
+
+
+@pytest.fixture
+def serve():
+    stops, gateways = [], []
+
+    def serve(stub: GeminiStub, **kwargs) -> LLMGateway:
+        url, stop = start_stub_server(stub)
+        stops.append(stop)
+        kwargs = {"requests_per_minute": 6000, "burst": 10, "hedge_after_s": 0, **kwargs}
+        gateways.append(LLMGateway(base_url=url, api_key="test", **kwargs))
+        return gateways[-1]
+
+    yield serve
+    for gateway in gateways:
+        gateway.close()
+    for stop in stops:
+        stop()
+
+
+def ask(gateway: LLMGateway, info: dict | None = None) -> str:
+    return "".join(gateway.stream("gemini-1.5-flash", REQUEST, info))
+
+
+def test_identical_prompts_are_coalesced(serve):
+    stub = GeminiStub(latency_ms=300, tokens_per_second=1000)
+    gateway = serve(stub)
+    answers, infos = [None, None], [{}, {}]
+
+    def worker(i):
+        answers[i] = ask(gateway, infos[i])
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(2)]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.05)
+    for thread in threads:
+        thread.join(10)
+
+    assert answers[0] and answers[0] == answers[1]
+    assert [info["coalesced"] for info in infos] == [False, True]
+    assert stub.counts["requests"] == 1
+
+
+def test_server_errors_are_retried(serve):
+    stub = ScriptedStub([500, 503], latency_ms=0, tokens_per_second=1000)
+    gateway = serve(stub, max_backoff_s=0.05)
+    info = {}
+
+    assert ask(gateway, info)
+    assert info["attempts"] == 3
+    assert stub.counts["requests"] == 3
+
+
+def test_rate_limit_backoff_is_capped(serve):
+    stub = ScriptedStub([429], latency_ms=0, tokens_per_second=1000)
+    gateway = serve(stub, max_backoff_s=0.2)
+    info = {}
+
+    started = time.monotonic()
+    assert ask(gateway, info)
+    assert time.monotonic() - started < 5  # Not the 60 seconds the Retry-After header asked for
+    assert info["attempts"] == 2
+
+
+def test_deadline_ends_retries(serve):
+    stub = ScriptedStub([503] * 10, latency_ms=0)
+    gateway = serve(stub, max_attempts=10, max_backoff_s=0.2, deadline_s=0.5)
+
+    started = time.monotonic()
+    with pytest.raises(LLMGatewayError):
+        ask(gateway)
+    assert time.monotonic() - started < 2
+
+
+def test_deadline_ends_slow_request(serve):
+    stub = GeminiStub(latency_ms=2000)
+    gateway = serve(stub, deadline_s=0.3)
+
+    with pytest.raises(LLMGatewayError, match="did not finish within 0.3s"):
+        ask(gateway)
+
+
+def test_slow_request_is_hedged(serve):
+    stub = ScriptedStub(["slow"], latency_ms=50, slow_ms=2000, tokens_per_second=1000)
+    gateway = serve(stub, hedge_after_s=0.2)
+    info = {}
+
+    started = time.monotonic()
+    assert ask(gateway, info)
+    assert time.monotonic() - started < 1.5
+    assert info["hedged"]
+    assert stub.counts["requests"] == 2
@@ -0,0 +1,59 @@
+import gc
+import time
+import weakref
+
+import pytest
+
+from Utils.batching import BatchedEmbeddings
+from Utils.model_registry import ModelRegistry, model_memory
+
+
+class Model:
+    def embed_documents(self, texts):
+        return [[float(len(text))] for text in texts]
+
+
+def test_unload_frees_model():
+    registry = ModelRegistry()
+    registry.register("model", Model)
+    model = weakref.ref(registry.get("model"))
+
+    registry.unload("model")
+    assert model() is None
+    assert not registry.stats()["model"]["loaded"]
+
+
+def test_batcher_does_not_keep_unloaded_model():
+    registry = ModelRegistry()
+    registry.register("embeddings", lambda: BatchedEmbeddings(Model(), name="test-embeddings"))
+    assert registry.get("embeddings").embed_documents(["ab", "c"]) == [[2.0], [1.0]]
+    model = weakref.ref(registry.get("embeddings").embeddings)
+
+    registry.unload("embeddings")
+    gc.collect()
+    assert model() is None
+    assert registry.get("embeddings").embed_query("abc") == [3.0]
+
+
+def test_unload_idle():
+    registry = ModelRegistry()
+    registry.register("idle", Model)
+    registry.register("busy", Model)
+    registry.get("idle")
+    time.sleep(0.05)
+    registry.get("busy")
+
+    assert registry.unload_idle(0.03) == ["idle"]
+    assert {name for name, stats in registry.stats().items() if stats["loaded"]} == {"busy"}
+
+
+def test_model_memory_counts_quantized_weights():
+    torch = pytest.importorskip("torch")
+    from Utils.inference_backend import quantize_int8
+
+    model = torch.nn.Sequential(torch.nn.Linear(256, 256), torch.nn.Linear(256, 16))
+    fp32_bytes = model_memory(model)
+    assert fp32_bytes == (256 * 256 + 256 + 256 * 16 + 16) * 4
+
+    int8_bytes = model_memory(quantize_int8(model))
+    assert 256 * 256 + 256 * 16 <= int8_bytes < fp32_bytes / 2
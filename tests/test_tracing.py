@@ -0,0 +1,48 @@
+import re
+
+import pytest
+
+from Utils import tracing
+
+
+@pytest.fixture
+def interleaved_gauges(monkeypatch):
+    def batchers():
+        for name in ("embeddings", "captions"):
+            yield "batcher_queue_depth", {"batcher": name}, 1
+            yield "batcher_max_batch_size", {"batcher": name}, 32
+
+    def models():
+        for name in ("llm", "summarizer"):
+            yield "model_loaded", {"model": name}, 1
+            yield "model_memory_bytes", {"model": name}, 1024
+
+    monkeypatch.setattr(tracing, "collectors", [batchers, models])
+    with tracing.span("test_stage", chunks=3):
+        tracing.increment("cache_hits", cache="test")
+    tracing.increment("cache_misses", 2, cache="test")
+
+
+def test_every_family_is_declared_once_before_its_samples(interleaved_gauges):
+    declared, finished, current = {}, set(), None
+    for line in tracing.render_prometheus().splitlines():
+        if line.startswith("# TYPE "):
+            _, _, family, kind = line.split()
+            assert family not in declared, f"{family} declared twice"
+            declared[family] = kind
+            finished.add(current)
+            current = family
+        elif not line.startswith("#"):
+            name = re.match(r"[a-zA-Z_:][a-zA-Z0-9_:]*", line).group()
+            family = re.sub(r"_(bucket|sum|count)$", "", name) if declared.get(current) == "histogram" else name
+            assert family == current, f"{name} is not under its own TYPE line"
+            assert family not in finished
+    assert declared["nismogen_batcher_queue_depth"] == "gauge"
+    assert declared["nismogen_cache_hits_total"] == "counter"
+
+
+def test_output_parses_with_prometheus_client(interleaved_gauges):
+    parser = pytest.importorskip("prometheus_client.parser")
+    families = {family.name: family for family in parser.text_string_to_metric_families(tracing.render_prometheus())}
+    assert len(families["nismogen_model_loaded"].samples) == 2
+    assert len(families["nismogen_batcher_queue_depth"].samples) == 2
@@ -0,0 +1,70 @@
+import os
+import shutil
+
+import pytest
+from langchain_community.vectorstores import FAISS
+
+from benchmarks.fakes import HashEmbeddings
+from Utils.vector_index import (
+    CURRENT_FILE, ReadOnlyCorpusError, corpus_chunk_ids, list_corpora, load_corpus, open_corpus, save_corpus
+)
+
+
+def vector_store(texts: list[str]) -> FAISS:
+    ids = [f"doc:{i}" for i in range(len(texts))]
+    return FAISS.from_texts(texts, HashEmbeddings(), metadatas=[{"source": "doc"}] * len(texts), ids=ids)
+
+
+def test_save_and_load(tmp_path):
+    corpus_dir = str(tmp_path)
+    save_corpus("manual", vector_store(["oil every 5000 miles", "rotate the tyres"]), corpus_dir)
+
+    assert list_corpora(corpus_dir) == ["manual"]
+    assert corpus_chunk_ids("manual", corpus_dir) == ["doc:0", "doc:1"]
+    loaded, lexical_index = open_corpus("manual", HashEmbeddings(), corpus_dir)
+    assert loaded.similarity_search("rotate the tyres", k=1)[0].page_content == "rotate the tyres"
+    assert lexical_index.search("tyres", 1)[0][0] == "doc:1"
+    assert loaded.docstore.search("doc:9") is None
+    with pytest.raises(ReadOnlyCorpusError):
+        loaded.docstore.delete(["doc:0"])
+
+
+def test_save_keeps_only_the_previous_version(tmp_path):
+    corpus_dir = str(tmp_path)
+    versions = [save_corpus("manual", vector_store(["text"] * size), corpus_dir) for size in (1, 2, 3)]
+
+    assert sorted(os.listdir(tmp_path / "manual")) == sorted([CURRENT_FILE] + [os.path.basename(v) for v in versions[1:]])
+    assert len(corpus_chunk_ids("manual", corpus_dir)) == 3
+    assert len(load_corpus("manual", HashEmbeddings(), corpus_dir).index_to_docstore_id) == 3
+
+
+def test_replaces_corpus_saved_before_versions(tmp_path):
+    corpus_dir = str(tmp_path)
+    legacy = tmp_path / "manual"
+    shutil.copytree(save_corpus("old", vector_store(["old text"]), corpus_dir), legacy)
+    assert corpus_chunk_ids("manual", corpus_dir) == ["doc:0"]
+
+    save_corpus("manual", vector_store(["new text", "more text"]), corpus_dir)
+    assert corpus_chunk_ids("manual", corpus_dir) == ["doc:0", "doc:1"]
+    assert (legacy / "index.faiss").exists()  # Kept as the previous version until the next save
+
+    save_corpus("manual", vector_store(["newest text"]), corpus_dir)
+    assert not (legacy / "index.faiss").exists()
+
+
+def test_version_saved_elsewhere_is_opened(tmp_path):
+    corpus_dir = str(tmp_path)
+    save_corpus("manual", vector_store(["old text"]), corpus_dir)
+    old_store, _ = open_corpus("manual", HashEmbeddings(), corpus_dir)
+    assert open_corpus("manual", HashEmbeddings(), corpus_dir)[0] is old_store
+
+    # Written by another process: only the CURRENT file tells this one about it
+    new_version = save_corpus("other", vector_store(["new text", "brake pads"]), corpus_dir)
+    os.rename(new_version, tmp_path / "manual" / os.path.basename(new_version))
+    with open(tmp_path / "manual" / CURRENT_FILE, "w", encoding="utf-8") as f:
+        f.write(os.path.basename(new_version))
+
+    new_store, lexical_index = open_corpus("manual", HashEmbeddings(), corpus_dir)
+    assert new_store is not old_store
+    doc_id, _ = lexical_index.search("brake pads", 1)[0]
+    assert new_store.docstore.search(doc_id).page_content == "brake pads"